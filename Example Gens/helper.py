@@ -1,10 +1,19 @@
 import re
+import sys
+import asyncio
 from typing import List, Tuple, Set, FrozenSet, Generator, Any, Dict, Literal
 import pandas as pd
 import itertools
+from collections import deque
 import openai
 import os
 from gensim.parsing.preprocessing import preprocess_string
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rule_index import RuleIndex, extract_rules_from_index, extract_rules_batch, compile_rules
+from rule_store import load_rule_store
+from gpt_client import AsyncGptClient, default_client
+from completion_cache import cached_completion, cached_completion_async
+from recipe_tokenizer import default_tokenizer
 
 class Choice:
     index: int
@@ -32,16 +41,314 @@ class GptResponse:
         self.choices = [Choice(choice) for choice in response['choices']]
         self.usage = response['usage']
 
+class RuleAutomaton:
+    """
+        An Aho-Corasick automaton over all the words of the rules, used by find_patterns instead of the RegEx permutations.
+
+        Building it is linear in the total size of the rules (no permutations), and matching a recipe is a single pass
+        over its characters followed by an order-insensitive containment check: a rule matches if all of its words occur
+        somewhere in the recipe without overlapping the other words, which is what the permutations joined with '.*' express.
+
+        Attributes:
+            words: The distinct words of the rules, word id -> word.
+            word_ids: The inverse of words, word -> word id.
+            rules: The rules as frozensets of words, rule id -> rule.
+            rule_lengths: The number of words of each rule.
+            word_rules: word id -> ids of the rules containing the word.
+            goto: The trie transitions, state -> {character: state}.
+            fail: The failure link of each state.
+            output: The ids of the words ending at each state (including the ones reached through failure links).
+    """
+    def __init__(self, rule_list: List[List[str]]):
+        self.words = []
+        self.word_ids = {}
+        self.rules = []
+        self.rule_lengths = []
+        self.word_rules = []
+        for rule in rule_list:
+            rule_words = frozenset(word for word in rule if word)
+            if not rule_words:
+                continue
+            for word in rule_words:
+                if word not in self.word_ids:
+                    self.word_ids[word] = len(self.words)
+                    self.words.append(word)
+                    self.word_rules.append([])
+                self.word_rules[self.word_ids[word]].append(len(self.rules))
+            self.rules.append(rule_words)
+            self.rule_lengths.append(len(rule_words))
+
+        # Build the trie
+        self.goto = [{}]
+        self.output = [[]]
+        for word_id, word in enumerate(self.words):
+            state = 0
+            for character in word:
+                if character not in self.goto[state]:
+                    self.goto[state][character] = len(self.goto)
+                    self.goto.append({})
+                    self.output.append([])
+                state = self.goto[state][character]
+            self.output[state].append(word_id)
+
+        # Breadth first traversal to compute the failure links, the states right below the root fail to the root
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and character not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(character, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def matched_words(self, text: str) -> Dict[int, List[Tuple[int, int]]]:
+        """
+            Returns, for every word occurring in the text, the (start, end) spans of its occurrences.
+        """
+        goto, fail, output, words = self.goto, self.fail, self.output, self.words
+        found = {}
+        state = 0
+        for position, character in enumerate(text):
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            for word_id in output[state]:
+                found.setdefault(word_id, []).append((position + 1 - len(words[word_id]), position + 1))
+        return found
+
+    def match(self, sample_recipe: List[str]) -> Set[FrozenSet[str]]:
+        """
+            Returns the set of rules (as frozensets of words) whose words all occur in the recipe.
+        """
+        occurrences = self.matched_words(' '.join(sample_recipe))
+        counts = {}
+        for word_id in occurrences:
+            for rule_id in self.word_rules[word_id]:
+                counts[rule_id] = counts.get(rule_id, 0) + 1
+        return {
+            self.rules[rule_id] for rule_id, count in counts.items()
+            if count == self.rule_lengths[rule_id]
+            and _disjoint_occurrences([occurrences[self.word_ids[word]] for word in self.rules[rule_id]])
+        }
+
+
+def _disjoint_occurrences(spans: List[List[Tuple[int, int]]], chosen: List[Tuple[int, int]] = None) -> bool:
+    # The permutations joined with '.*' need one occurrence of each word, none of them overlapping
+    # (e.g. 'boil' alone doesn't match oil.*boil|boil.*oil). Rules are short, so a depth first search is enough.
+    chosen = chosen or []
+    if len(chosen) == len(spans):
+        return True
+    for start, end in spans[len(chosen)]:
+        if all(end <= other_start or other_end <= start for other_start, other_end in chosen):
+            if _disjoint_occurrences(spans, chosen + [(start, end)]):
+                return True
+    return False
+
 openai.api_key = os.environ['OPENAI_APIKEY']
 
-def load_required_data_v2(DATA_DIR):
-    print('Starting to load rule data')
-    # import rules csv
-    ingredient_rules = pd.read_csv(f'{DATA_DIR}/ingredient_rules.csv')
-    rules = pd.read_csv(f'{DATA_DIR}/rules_recipe_scale.csv')
+def _read_rules(DATA_DIR, name):
+    # Prefer the binary rule store (see rule_store.convert_rule_data) if it has been created, it loads without eval
+    if os.path.isdir(f'{DATA_DIR}/{name}.rules'):
+        return load_rule_store(f'{DATA_DIR}/{name}.rules').to_dataframe()
+    rules = pd.read_csv(f'{DATA_DIR}/{name}.csv')
     # From the antecedents column, convert from frozenset to list of strings
     rules['antecedents'] = rules['antecedents'].apply(lambda x: list(eval(x)))
-    ingredient_rules['antecedents'] = ingredient_rules['antecedents'].apply(lambda x: list(eval(x)))
+    return rules
+
+# The system prompts of the prompt_gpt* functions, by function name
+SYSTEM_PROMPTS = {
+    'prompt_gpt': """
+            You are a cooking assistant. 
+            User will give you directions and the title of a recipe along with some rules that it has already fulfilled.
+            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe.
+            The user will also give you some new set of rules that it has not fulfilled yet.
+            Your job is to rewrite the recipe while keeping the following in mind:
+            1. Only change or add something in order to fulfill the new rules given by the user.
+            2. Make sure the fulfill all of the new rules. 
+            3. Do NOT ever add anything new unless it directly helps you fulfill the new rules.
+            4. Never ever remove any details(such as the temperature or time) or steps from the original instructions.
+            5. 
+            Give your new recipe between <RECIPE> and </RECIPE> tags.
+            After you have created the recipe, write between <EXPLANATION> and </EXPLANATION> tags why you made the changes you made.
+            """,
+    'prompt_gpt_2': """
+            You are a professor at a culinary school and you are teaching a class on how to write recipes.
+            You will be given a recipe and a set of rules that it has already fulfilled. Note that this will just be a subset of all the rules that the recipe fulfills.
+            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe.
+            The student will also give you some new set of rules that it has not fulfilled yet.
+            You are responsible for rewriting the recipe. You have to make sure that the new recipe you write fulfills all the new rules, while keeping all the details from the original recipe intact.
+            Thus, you are to only add upon the original recipe, and avoid removing anything from it. You are to only add something if it directly helps you fulfill the new rules.
+            Rewrite the recipe with the new steps you added and wrap it between <RECIPE> and </RECIPE> tags.
+            After writing the recipe, write between <EXPLANATION> and </EXPLANATION> tags why you made the changes you made.
+            So the output format is:
+            <RECIPE>
+            Your new recipe here
+            </RECIPE>
+            <EXPLANATION>
+            Your explanation here
+            </EXPLANATION>
+            """,
+    'prompt_gpt_3': """
+            You are a recipe improvement assistant. The improvement will be done ONLY in the scope of rules.
+            You will be givzen a recipe and a set of rules that it has already fulfilled. Note that this will just be a subset of all the rules that the recipe fulfills.
+            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe.
+            The user will also give you some new set of rules that it has not fulfilled yet.
+            
+            You are responsible for rewriting the recipe. You have to make sure that the new recipe you write fulfills all the new rules, while keeping all the details from the original recipe intact.
+            Thus, you are to only add upon the original recipe, and avoid removing anything from it. You are to only add something if it directly helps you fulfill the new rules.
+            
+            You'll write two parts, the first part is the Ingredients and Instructions. The second part is the explanation.
+            The first part will be wrapped between <RECIPE> and </RECIPE> tags. In this part include the ingredient portions in the list labelled Ingredients: and then the Instructions section as a numbered list
+            
+            The second part will be wrapped between <EXPLANATION> and </EXPLANATION> tags. In this part, explain why you made the changes you made.
+            
+            So the output format is:
+            <RECIPE>
+            Ingredients:
+            - Ingredient 1
+            - Ingredient 2
+            ...
+            Instructions:
+            1. Step 1
+            2. Step 2
+            ...
+            </RECIPE>
+            <EXPLANATION>
+            Your explanation here
+            </EXPLANATION>
+            """,
+    'prompt_gpt_3_extra_info': """
+            You are a recipe improvement assistant. The improvement will be done ONLY in the scope of rules.
+            You will be givzen a recipe and a set of rules that it has already fulfilled. Note that this will just be a subset of all the rules that the recipe fulfills.
+            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe. Note that, these words aren't dependent on each other. Thus they don't have to appear in the same sentence, or in the same order that they are given. It just means they have to appear at least once somewhere in the recipe.
+            The user will also give you some new set of rules that it has not fulfilled yet.
+            
+            You are responsible for rewriting the recipe. You have to make sure that the new recipe you write fulfills all the new rules, while keeping all the details from the original recipe intact.
+            Thus, you are to only add upon the original recipe, and avoid removing anything from it. You are to only add something if it directly helps you fulfill the new rules.
+            
+            You'll write two parts, the first part is the Ingredients and Instructions. The second part is the explanation.
+            The first part will be wrapped between <RECIPE> and </RECIPE> tags. In this part include the ingredient portions in the list labelled Ingredients: and then the Instructions section as a numbered list
+            
+            The second part will be wrapped between <EXPLANATION> and </EXPLANATION> tags. In this part, explain why you made the changes you made.
+            
+            So the output format is:
+            <RECIPE>
+            Ingredients:
+            - Ingredient 1
+            - Ingredient 2
+            ...
+            Instructions:
+            1. Step 1
+            2. Step 2
+            ...
+            </RECIPE>
+            <EXPLANATION>
+            Your explanation here
+            </EXPLANATION>
+            """,
+    'prompt_gpt_short': """
+        You are a recipe improvement assistant.
+        You will be given 3 things:
+        1. A recipe
+        2. A set of rules that it has already fulfilled.
+        3. A set of rules that it has not fulfilled yet.
+
+        The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe. 
+        
+        You'll write two parts:
+        1. The first part is the Ingredients and Instructions. First write the ingredients in a list labelled Ingredients:
+        Then in the label Instructions: write the new recipe by fulfilling all of the new rules, while changing as little as possible from the original recipe. Write the instructions as a numbered list.
+        Wrap this part between <RECIPE> and </RECIPE> tags.
+        2. The second part is the explanation part. In here write all the changes you have made and why made them. Wrap this part between <EXPLANATION> and </EXPLANATION> tags.
+        
+        So the output format is:
+        <RECIPE>
+        Ingredients:
+        - Ingredient 1
+        - Ingredient 2
+        ...
+        Instructions:
+        1. Step 1
+        2. Step 2
+        ...
+        </RECIPE>
+        <EXPLANATION>
+        Your explanation here
+        </EXPLANATION>
+        """,
+    'prompt_gpt_short_extra_info': """
+        You are a recipe improvement assistant.
+        You will be given 3 things:
+        1. A recipe
+        2. A set of rules that it has already fulfilled.
+        3. A set of rules that it has not fulfilled yet.
+
+        The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe. Note that, these words aren't dependent on each other. Thus they words don't have to appear in the same sentence, or in the same order that they are given. It just means they have to appear at least once somewhere in the recipe.
+        
+        You'll write two parts:
+        1. The first part is the Ingredients and Instructions. First write the ingredients in a list labelled Ingredients:
+        Then in the label Instructions: write the new recipe by fulfilling all of the new rules, while changing as little as possible from the original recipe. Write the instructions as a numbered list.
+        Wrap this part between <RECIPE> and </RECIPE> tags.
+        2. The second part is the explanation part. In here write all the changes you have made and why made them. Wrap this part between <EXPLANATION> and </EXPLANATION> tags.
+        
+        So the output format is:
+        <RECIPE>
+        Ingredients:
+        - Ingredient 1
+        - Ingredient 2
+        ...
+        Instructions:
+        1. Step 1
+        2. Step 2
+        ...
+        </RECIPE>
+        <EXPLANATION>
+        Your explanation here
+        </EXPLANATION>
+        """,
+    'prompt_gpt_with_ingredients': """
+            You are a recipe improvement assistant.
+            You will be given 5 things:
+            1. A recipe
+            2. For the Instructions: A set of rules that it has already fulfilled.
+            3. For the Instructions: A set of rules that it has not fulfilled yet.
+            4. For the Ingredients: A set of rules that it has already fulfilled.
+            5. For the Ingredients: A set of rules that it has not fulfilled yet.
+
+            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe. Note that, these words aren't dependent on each other. Thus they words don't have to appear in the same sentence, or in the same order that they are given. It just means they have to appear at least once somewhere in the directions for the rules of the directions and in ingredients for the rules for ingredients.
+            
+            You'll write two parts:
+            1. The first part is the Ingredients and Instructions. First write the ingredients in a list labelled Ingredients:
+            Then in the label Instructions: write the new recipe as a numbered list. For both the ingredients and instructions, make sure to fulfill all of the new rules, while changing as little as possible from the original recipe.
+            Make sure that each ingredient is used in the instructions. And all the ingredients are listed in the ingredients section.
+            Wrap this part between <RECIPE> and </RECIPE> tags.
+            2. The second part is the explanation part. In here write all the changes you have made and why made them. Wrap this part between <EXPLANATION> and </EXPLANATION> tags.
+            
+            So the output format is:
+            <RECIPE>
+            Ingredients:
+            - Ingredient 1
+            - Ingredient 2
+            ...
+            Instructions:
+            1. Step 1
+            2. Step 2
+            ...
+            </RECIPE>
+            <EXPLANATION>
+            Your explanation here
+            </EXPLANATION>
+            """,
+}
+
+def load_required_data_v2(DATA_DIR):
+    print('Starting to load rule data')
+    # import rules
+    ingredient_rules = _read_rules(DATA_DIR, 'ingredient_rules')
+    rules = _read_rules(DATA_DIR, 'rules_recipe_scale')
     print('Rule data loaded...')
     print()
     print('Starting rule extraction...')
@@ -53,12 +360,15 @@ def load_required_data_v2(DATA_DIR):
     print('_'*30)
     return extracted_rules,extracted_ingredient_rules
 
-def load_required_data(DATA_DIR):
+def load_required_data(DATA_DIR, automaton=False):
+    """
+        Loads the rules and prepares the patterns for find_patterns.
+        If automaton is True, a RuleAutomaton is returned instead of the list of RegEx patterns. find_patterns accepts both,
+        and the automaton avoids creating every permutation of every rule.
+    """
     print('Starting to load rule data')
-    # import rules csv
-    rules = pd.read_csv(f'{DATA_DIR}/rules_recipe_scale.csv')
-    # From the antecedents column, convert from frozenset to list of strings
-    rules['antecedents'] = rules['antecedents'].apply(lambda x: list(eval(x)))
+    # import rules
+    rules = _read_rules(DATA_DIR, 'rules_recipe_scale')
     print('Rule data loaded...')
     print()
     from tqdm import tqdm
@@ -76,6 +386,12 @@ def load_required_data(DATA_DIR):
     print('\t -> Done sorting rules...')
     print('_'*30)
 
+    if automaton:
+        print('\t -> Starting automaton creation')
+        rule_automaton = RuleAutomaton(extracted_rule_list)
+        print('\t -> Done creating automaton...')
+        return rules, rule_automaton, extracted_rules
+
     print('\t -> Starting RegEx pattern creation')
     # Initialize the list to store the regex patterns
     to_be_joined = []
@@ -98,6 +414,9 @@ def load_required_data(DATA_DIR):
     return rules, to_be_joined, extracted_rules
 
 def find_patterns(sample_recipe, to_be_joined):
+    # With a RuleAutomaton all the rules are matched in a single pass over the recipe
+    if isinstance(to_be_joined, RuleAutomaton):
+        return to_be_joined.match(sample_recipe)
     # preprocess recipe
     # Apply all the patterns in the be joined list
     set_to_return = set()
@@ -117,7 +436,7 @@ def find_patterns(sample_recipe, to_be_joined):
 
 def extract_rules(
     recipe: List[str],
-    rules: pd.DataFrame,
+    rules: pd.DataFrame | RuleIndex,
     rule_count = 3,
     metric='lift'
 ) -> Set[FrozenSet[str]]:
@@ -129,6 +448,7 @@ def extract_rules(
         Input: 
             - recipe: A list of tokens (i.e. a recipe preprocessed using gensim preprocess_string)
             - rules: A pd.DataFrame with columns: ['antecedents', 'consequents', 'confidence', 'lift'], should be sorted by lift.
+                     Can also be a RuleIndex compiled from such a DataFrame (see rule_index.py).
             - rule_count: The number of rules to be extracted
 
         Output:
@@ -136,6 +456,8 @@ def extract_rules(
                 - A set of frozensets, each frozenset is a rule.
                 - A dictionary with the rules as keys and the tuple (consequents, lift) as values.
     """
+    if isinstance(rules, RuleIndex):
+        return extract_rules_from_index(recipe, rules, rule_count, metric)
 
     # Initialize the list to be returned
     rules_to_return = set()
@@ -245,6 +567,7 @@ def prompt_gpt(
 ) -> GptResponse:
     """
         This function takes as input a prompt and returns the response from GPT-3.5.
+        Responses are cached (see completion_cache.py), so rerunning an experiment doesn't cost any tokens.
 
         Inputs:
             - prompt: The prompt to be sent to GPT-3.5.
@@ -253,24 +576,11 @@ def prompt_gpt(
         Output:
             - The response from GPT-3.5.
     """
-    response = openai.ChatCompletion.create(
+    response = cached_completion(
         model=model,
         messages = [
             {
-            "role": "system", "content": """
-            You are a cooking assistant. 
-            User will give you directions and the title of a recipe along with some rules that it has already fulfilled.
-            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe.
-            The user will also give you some new set of rules that it has not fulfilled yet.
-            Your job is to rewrite the recipe while keeping the following in mind:
-            1. Only change or add something in order to fulfill the new rules given by the user.
-            2. Make sure the fulfill all of the new rules. 
-            3. Do NOT ever add anything new unless it directly helps you fulfill the new rules.
-            4. Never ever remove any details(such as the temperature or time) or steps from the original instructions.
-            5. 
-            Give your new recipe between <RECIPE> and </RECIPE> tags.
-            After you have created the recipe, write between <EXPLANATION> and </EXPLANATION> tags why you made the changes you made.
-            """
+            "role": "system", "content": SYSTEM_PROMPTS['prompt_gpt']
             },
             {
             "role": "user", "content": prompt
@@ -293,27 +603,11 @@ def prompt_gpt_2(
         A really similar function to prompt_gpt, but we try a different system prompt.
         See the documentation for prompt_gpt for more details.
     """
-    response = openai.ChatCompletion.create(
+    response = cached_completion(
         model=model,
         messages = [
             {
-            "role": "system", "content": """
-            You are a professor at a culinary school and you are teaching a class on how to write recipes.
-            You will be given a recipe and a set of rules that it has already fulfilled. Note that this will just be a subset of all the rules that the recipe fulfills.
-            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe.
-            The student will also give you some new set of rules that it has not fulfilled yet.
-            You are responsible for rewriting the recipe. You have to make sure that the new recipe you write fulfills all the new rules, while keeping all the details from the original recipe intact.
-            Thus, you are to only add upon the original recipe, and avoid removing anything from it. You are to only add something if it directly helps you fulfill the new rules.
-            Rewrite the recipe with the new steps you added and wrap it between <RECIPE> and </RECIPE> tags.
-            After writing the recipe, write between <EXPLANATION> and </EXPLANATION> tags why you made the changes you made.
-            So the output format is:
-            <RECIPE>
-            Your new recipe here
-            </RECIPE>
-            <EXPLANATION>
-            Your explanation here
-            </EXPLANATION>
-            """
+            "role": "system", "content": SYSTEM_PROMPTS['prompt_gpt_2']
             },
             {
             "role": "user", "content": prompt
@@ -336,39 +630,11 @@ def prompt_gpt_3(
         A really similar function to prompt_gpt, but we try a different system prompt.
         See the documentation for prompt_gpt for more details.
     """
-    response = openai.ChatCompletion.create(
+    response = cached_completion(
         model=model,
         messages = [
             {
-            "role": "system", "content": """
-            You are a recipe improvement assistant. The improvement will be done ONLY in the scope of rules.
-            You will be givzen a recipe and a set of rules that it has already fulfilled. Note that this will just be a subset of all the rules that the recipe fulfills.
-            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe.
-            The user will also give you some new set of rules that it has not fulfilled yet.
-            
-            You are responsible for rewriting the recipe. You have to make sure that the new recipe you write fulfills all the new rules, while keeping all the details from the original recipe intact.
-            Thus, you are to only add upon the original recipe, and avoid removing anything from it. You are to only add something if it directly helps you fulfill the new rules.
-            
-            You'll write two parts, the first part is the Ingredients and Instructions. The second part is the explanation.
-            The first part will be wrapped between <RECIPE> and </RECIPE> tags. In this part include the ingredient portions in the list labelled Ingredients: and then the Instructions section as a numbered list
-            
-            The second part will be wrapped between <EXPLANATION> and </EXPLANATION> tags. In this part, explain why you made the changes you made.
-            
-            So the output format is:
-            <RECIPE>
-            Ingredients:
-            - Ingredient 1
-            - Ingredient 2
-            ...
-            Instructions:
-            1. Step 1
-            2. Step 2
-            ...
-            </RECIPE>
-            <EXPLANATION>
-            Your explanation here
-            </EXPLANATION>
-            """
+            "role": "system", "content": SYSTEM_PROMPTS['prompt_gpt_3']
             },
             {
             "role": "user", "content": prompt
@@ -391,39 +657,11 @@ def prompt_gpt_3_extra_info(
     A really similar function to prompt_gpt, but we try a different system prompt.
     See the documentation for prompt_gpt for more details.
     """
-    response = openai.ChatCompletion.create(
+    response = cached_completion(
         model=model,
         messages = [
             {
-            "role": "system", "content": """
-            You are a recipe improvement assistant. The improvement will be done ONLY in the scope of rules.
-            You will be givzen a recipe and a set of rules that it has already fulfilled. Note that this will just be a subset of all the rules that the recipe fulfills.
-            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe. Note that, these words aren't dependent on each other. Thus they don't have to appear in the same sentence, or in the same order that they are given. It just means they have to appear at least once somewhere in the recipe.
-            The user will also give you some new set of rules that it has not fulfilled yet.
-            
-            You are responsible for rewriting the recipe. You have to make sure that the new recipe you write fulfills all the new rules, while keeping all the details from the original recipe intact.
-            Thus, you are to only add upon the original recipe, and avoid removing anything from it. You are to only add something if it directly helps you fulfill the new rules.
-            
-            You'll write two parts, the first part is the Ingredients and Instructions. The second part is the explanation.
-            The first part will be wrapped between <RECIPE> and </RECIPE> tags. In this part include the ingredient portions in the list labelled Ingredients: and then the Instructions section as a numbered list
-            
-            The second part will be wrapped between <EXPLANATION> and </EXPLANATION> tags. In this part, explain why you made the changes you made.
-            
-            So the output format is:
-            <RECIPE>
-            Ingredients:
-            - Ingredient 1
-            - Ingredient 2
-            ...
-            Instructions:
-            1. Step 1
-            2. Step 2
-            ...
-            </RECIPE>
-            <EXPLANATION>
-            Your explanation here
-            </EXPLANATION>
-            """
+            "role": "system", "content": SYSTEM_PROMPTS['prompt_gpt_3_extra_info']
             },
             {
             "role": "user", "content": prompt
@@ -442,40 +680,11 @@ def prompt_gpt_short(
     print_response: bool = True,
     model="gpt-3.5-turbo",
 ) -> GptResponse:
-    response = openai.ChatCompletion.create(
+    response = cached_completion(
     model=model,
     messages = [
         {
-        "role": "system", "content": """
-        You are a recipe improvement assistant.
-        You will be given 3 things:
-        1. A recipe
-        2. A set of rules that it has already fulfilled.
-        3. A set of rules that it has not fulfilled yet.
-
-        The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe. 
-        
-        You'll write two parts:
-        1. The first part is the Ingredients and Instructions. First write the ingredients in a list labelled Ingredients:
-        Then in the label Instructions: write the new recipe by fulfilling all of the new rules, while changing as little as possible from the original recipe. Write the instructions as a numbered list.
-        Wrap this part between <RECIPE> and </RECIPE> tags.
-        2. The second part is the explanation part. In here write all the changes you have made and why made them. Wrap this part between <EXPLANATION> and </EXPLANATION> tags.
-        
-        So the output format is:
-        <RECIPE>
-        Ingredients:
-        - Ingredient 1
-        - Ingredient 2
-        ...
-        Instructions:
-        1. Step 1
-        2. Step 2
-        ...
-        </RECIPE>
-        <EXPLANATION>
-        Your explanation here
-        </EXPLANATION>
-        """
+        "role": "system", "content": SYSTEM_PROMPTS['prompt_gpt_short']
         },
         {
         "role": "user", "content": prompt
@@ -494,40 +703,11 @@ def prompt_gpt_short_extra_info(
     print_response: bool = True,
     model="gpt-3.5-turbo",
 ) -> GptResponse:
-    response = openai.ChatCompletion.create(
+    response = cached_completion(
     model=model,
     messages = [
         {
-        "role": "system", "content": """
-        You are a recipe improvement assistant.
-        You will be given 3 things:
-        1. A recipe
-        2. A set of rules that it has already fulfilled.
-        3. A set of rules that it has not fulfilled yet.
-
-        The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe. Note that, these words aren't dependent on each other. Thus they words don't have to appear in the same sentence, or in the same order that they are given. It just means they have to appear at least once somewhere in the recipe.
-        
-        You'll write two parts:
-        1. The first part is the Ingredients and Instructions. First write the ingredients in a list labelled Ingredients:
-        Then in the label Instructions: write the new recipe by fulfilling all of the new rules, while changing as little as possible from the original recipe. Write the instructions as a numbered list.
-        Wrap this part between <RECIPE> and </RECIPE> tags.
-        2. The second part is the explanation part. In here write all the changes you have made and why made them. Wrap this part between <EXPLANATION> and </EXPLANATION> tags.
-        
-        So the output format is:
-        <RECIPE>
-        Ingredients:
-        - Ingredient 1
-        - Ingredient 2
-        ...
-        Instructions:
-        1. Step 1
-        2. Step 2
-        ...
-        </RECIPE>
-        <EXPLANATION>
-        Your explanation here
-        </EXPLANATION>
-        """
+        "role": "system", "content": SYSTEM_PROMPTS['prompt_gpt_short_extra_info']
         },
         {
         "role": "user", "content": prompt
@@ -541,74 +721,45 @@ def prompt_gpt_short_extra_info(
         _print_response(response)
     return response
 
-def prompt_few_shot(
-    prompt: str,
-    print_response: bool = True,
-    model="gpt-3.5-turbo",
-) -> GptResponse:
+def _few_shot_content(prompt: str) -> str:
     # Read the examples from few_shots_gend_by_gp4.txt
     with open('./few_shots_gend_by_gpt4.txt', 'r') as f:
         examples = f.read()
-        response = openai.ChatCompletion.create(
-        model=model,
-        messages = [
-            {
-            "role": "user", "content": f"""
+    return f"""
             {examples}
             {prompt}
             """
-            }
-        ],
-        temperature=0,
-        )
-        if print_response:
-            # convert response to GptResponse
-            response = GptResponse(response)
-            _print_response(response)
-        return response
+
+def prompt_few_shot(
+    prompt: str,
+    print_response: bool = True,
+    model="gpt-3.5-turbo",
+) -> GptResponse:
+    response = cached_completion(
+    model=model,
+    messages = [
+        {
+        "role": "user", "content": _few_shot_content(prompt)
+        }
+    ],
+    temperature=0,
+    )
+    if print_response:
+        # convert response to GptResponse
+        response = GptResponse(response)
+        _print_response(response)
+    return response
         
 def prompt_gpt_with_ingredients(
     prompt: str,
     print_response: bool = True,
     model="gpt-3.5-turbo",
 ) -> GptResponse:
-    response = openai.ChatCompletion.create(
+    response = cached_completion(
         model=model,
         messages = [
             {
-            "role": "system", "content": """
-            You are a recipe improvement assistant.
-            You will be given 5 things:
-            1. A recipe
-            2. For the Instructions: A set of rules that it has already fulfilled.
-            3. For the Instructions: A set of rules that it has not fulfilled yet.
-            4. For the Ingredients: A set of rules that it has already fulfilled.
-            5. For the Ingredients: A set of rules that it has not fulfilled yet.
-
-            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe. Note that, these words aren't dependent on each other. Thus they words don't have to appear in the same sentence, or in the same order that they are given. It just means they have to appear at least once somewhere in the directions for the rules of the directions and in ingredients for the rules for ingredients.
-            
-            You'll write two parts:
-            1. The first part is the Ingredients and Instructions. First write the ingredients in a list labelled Ingredients:
-            Then in the label Instructions: write the new recipe as a numbered list. For both the ingredients and instructions, make sure to fulfill all of the new rules, while changing as little as possible from the original recipe.
-            Make sure that each ingredient is used in the instructions. And all the ingredients are listed in the ingredients section.
-            Wrap this part between <RECIPE> and </RECIPE> tags.
-            2. The second part is the explanation part. In here write all the changes you have made and why made them. Wrap this part between <EXPLANATION> and </EXPLANATION> tags.
-            
-            So the output format is:
-            <RECIPE>
-            Ingredients:
-            - Ingredient 1
-            - Ingredient 2
-            ...
-            Instructions:
-            1. Step 1
-            2. Step 2
-            ...
-            </RECIPE>
-            <EXPLANATION>
-            Your explanation here
-            </EXPLANATION>
-            """
+            "role": "system", "content": SYSTEM_PROMPTS['prompt_gpt_with_ingredients']
             },
             {
             "role": "user", "content": prompt
@@ -622,6 +773,52 @@ def prompt_gpt_with_ingredients(
         _print_response(response)
     return response
 
+def _prompt_messages(prompt_function: callable, prompt: str) -> List[Dict[str, str]]:
+    # The messages prompt_function sends for the prompt
+    if prompt_function.__name__ == 'prompt_few_shot':
+        return [{"role": "user", "content": _few_shot_content(prompt)}]
+    return [
+        {"role": "system", "content": SYSTEM_PROMPTS[prompt_function.__name__]},
+        {"role": "user", "content": prompt},
+    ]
+
+async def prompt_async(
+    prompt_function: callable,
+    prompt: str,
+    print_response: bool = False,
+    model="gpt-3.5-turbo",
+    client: AsyncGptClient | None = None,
+    timeout: float | None = None,
+) -> GptResponse:
+    """
+        Sends the same request as prompt_function (any of the prompt_gpt* functions or prompt_few_shot), but asynchronously
+        through a pooled AsyncGptClient, so that many prompts can be in flight at once (e.g. with asyncio.gather).
+
+        Inputs:
+            - prompt_function: The prompt function whose system prompt is used.
+            - prompt: The prompt to be sent to GPT.
+            - print_response: Whether to print the response or not.
+            - model: The model to use. Default is "gpt-3.5-turbo".
+            - client: The client to send the request with. Default is the client shared by the process.
+            - timeout: The timeout of the request in seconds. Default is the timeout of the client.
+
+        Output:
+            - The response from GPT.
+    """
+    client = client or default_client()
+    response = await cached_completion_async(
+        client,
+        messages=_prompt_messages(prompt_function, prompt),
+        model=model,
+        temperature=0,
+        timeout=timeout,
+    )
+    if print_response:
+        # convert response to GptResponse
+        response = GptResponse(response)
+        _print_response(response)
+    return response
+
 def calculate_similarity(
     original_recipe: str,
     gpt_response: GptResponse
@@ -644,8 +841,8 @@ def calculate_similarity(
     # The recipe written by chat gpt should be between <RECIPE> and </RECIPE> tags
     # Split on the tags and grab the second element
     new_recipe = new_recipe.split('<RECIPE>')[1].split('</RECIPE>')[0]
-    # Split the recipe into tokens
-    new_recipe = preprocess_string(new_recipe)
+    # Split the recipe into tokens, the same tokens as preprocess_string with the words memoized across calls
+    new_recipe = default_tokenizer()(new_recipe)
     # Calculate the similarity
     return(
         len(set(original_recipe).intersection(set(new_recipe))) / len(set(original_recipe)),
@@ -699,7 +896,8 @@ def complete_pipeline(
         recipe_row: pd.Series,
         extracted_rules: pd.DataFrame,
         prompt_function: callable = prompt_gpt_2,
-        model="gpt-3.5-turbo"
+        model="gpt-3.5-turbo",
+        extraction: Tuple[Set[FrozenSet[str]], Dict[FrozenSet[str], Tuple[str, float]]] | None = None,
 ) -> Dict[str, any]:
     
     """
@@ -709,6 +907,7 @@ def complete_pipeline(
             - recipe_row: A pandas dataframe row with a column called 'preprocessed' which is a list of tokens. Note: we assume this preprocessed column is created using gensim preprocess_string.
             - extracted_rules: A pandas dataframe with columns ['antecedents', 'consequents', 'confidence', 'lift'] sorted by lift.
             - prompt_function: The function to be used to send the prompt to GPT-3.5. The default is prompt_gpt_2.
+            - extraction: The (fulfilled_rules, suggestions) of the recipe if they were already extracted (e.g. by extract_rules_batch). Default is None, i.e. they are extracted here.
         
         Output:
             - A dictionary with the following keys:
@@ -720,7 +919,9 @@ def complete_pipeline(
     """
 
     # Generate the prompt
-    fulfilled_rules, suggestions = extract_rules(recipe_row['preprocessed'], extracted_rules)
+    if extraction is None:
+        extraction = extract_rules(recipe_row['preprocessed'], extracted_rules)
+    fulfilled_rules, suggestions = extraction
     # if the prompt function is prompt_few_shot, we need to create a different prompt
     if prompt_function == prompt_few_shot:
         prompt = create_fewshot_prompt(recipe_row['title'], recipe_row['directions'], fulfilled_rules, suggestions)
@@ -739,6 +940,35 @@ def complete_pipeline(
         'new_in_original': new_in_original
     })
 
+async def complete_pipeline_async(
+        recipe_row: pd.Series,
+        extracted_rules: pd.DataFrame,
+        prompt_function: callable = prompt_gpt_2,
+        model="gpt-3.5-turbo",
+        extraction: Tuple[Set[FrozenSet[str]], Dict[FrozenSet[str], Tuple[str, float]]] | None = None,
+        client: AsyncGptClient | None = None,
+) -> Dict[str, any]:
+    """
+        The asynchronous version of complete_pipeline, the request is sent with prompt_async. See complete_pipeline for the details.
+    """
+    if extraction is None:
+        extraction = extract_rules(recipe_row['preprocessed'], extracted_rules)
+    fulfilled_rules, suggestions = extraction
+    if prompt_function == prompt_few_shot:
+        prompt = create_fewshot_prompt(recipe_row['title'], recipe_row['directions'], fulfilled_rules, suggestions)
+    else:
+        prompt = create_prompt(recipe_row['title'], recipe_row['directions'], fulfilled_rules, suggestions)
+    resp = await prompt_async(prompt_function, prompt, print_response=False, model=model, client=client)
+    original_in_new, new_in_original = calculate_similarity(recipe_row['preprocessed'], resp)
+    return({
+        'index': recipe_row.name,
+        'original_recipe': recipe_row['directions'],
+        'new_recipe': resp.choices[0].message.content,
+        'rules': suggestions,
+        'original_in_new': original_in_new,
+        'new_in_original': new_in_original
+    })
+
 def complete_pipeline_2(
         recipe_row: pd.Series,
         extracted_rules: pd.DataFrame,
@@ -790,7 +1020,7 @@ def complete_pipeline_2(
 
 def pipeline_chunk(
         chunk: pd.DataFrame,
-        extracted_rules: pd.DataFrame,
+        extracted_rules: pd.DataFrame | RuleIndex,
         prompt_function: callable = prompt_gpt_2,
         model="gpt-3.5-turbo"
 ) -> List[Dict[str, any]]:
@@ -799,12 +1029,21 @@ def pipeline_chunk(
 
         Input:
             - chunk: A pandas dataframe with a column called 'preprocessed' which is a list of tokens. Note: we assume this preprocessed column is created using gensim preprocess_string.
-            - extracted_rules: A pandas dataframe with columns ['antecedents', 'consequents', 'confidence', 'lift'] sorted by lift.
+            - extracted_rules: A pandas dataframe with columns ['antecedents', 'consequents', 'confidence', 'lift'] sorted by lift,
+                               or the RuleIndex compiled from it. When the chunks are sent to a Pool, pass the RuleIndex
+                               (rule_index.compile_rules(extracted_rules)) so that it is compiled once instead of once per chunk.
         
         Output:
             - A list of dictionaries, each dictionary is the output of the complete_pipeline function.
     """
-    return [complete_pipeline(row, extracted_rules, prompt_function, model) for _, row in chunk.iterrows()]
+    # A DataFrame is compiled on the first chunk only (see compile_rules)
+    rules = compile_rules(extracted_rules, 'lift')
+    # Extract the rules of the whole chunk at once, with the defaults of complete_pipeline (3 rules, sorted by lift)
+    extractions = extract_rules_batch(chunk['preprocessed'].tolist(), rules, 3, 'lift')
+    return [
+        complete_pipeline(row, rules, prompt_function, model, extraction)
+        for (_, row), extraction in zip(chunk.iterrows(), extractions)
+    ]
 
 def pipeline_chunk_2(
         chunk: pd.DataFrame,
@@ -822,4 +1061,22 @@ def pipeline_chunk_2(
         Output:
             - A list of dictionaries, each dictionary is the output of the complete_pipeline function.
     """
-    return [complete_pipeline_2(row, extracted_rules, prompt_function, model) for _, row in chunk.iterrows()]
\ No newline at end of file
+    return [complete_pipeline_2(row, extracted_rules, prompt_function, model) for _, row in chunk.iterrows()]
+
+async def pipeline_chunk_async(
+        chunk: pd.DataFrame,
+        extracted_rules: pd.DataFrame | RuleIndex,
+        prompt_function: callable = prompt_gpt_2,
+        model="gpt-3.5-turbo",
+        client: AsyncGptClient | None = None,
+) -> List[Dict[str, any]]:
+    """
+        The asynchronous version of pipeline_chunk: all the recipes of the chunk are sent concurrently over the same client.
+        The number of requests in flight is bounded by the max_connections of the client.
+    """
+    rules = compile_rules(extracted_rules, 'lift')
+    extractions = extract_rules_batch(chunk['preprocessed'].tolist(), rules, 3, 'lift')
+    return list(await asyncio.gather(*[
+        complete_pipeline_async(row, rules, prompt_function, model, extraction, client)
+        for (_, row), extraction in zip(chunk.iterrows(), extractions)
+    ]))
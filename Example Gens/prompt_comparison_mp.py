@@ -1,10 +1,86 @@
+import os
 import sys
-sys.path.append('../')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import asyncio
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
 import helpers_for_backend as hfb
-from multiprocessing import Pool
-import time
-import random
-from urllib.error import HTTPError
+from request_scheduler import RequestScheduler, estimate_tokens
+
+def row_key(prompt_function_name, rule_count, i, model, recipe):
+    """
+        The key of a row in the log. A row is only resumed from a run with the same model and the same recipe at that position,
+        so that a log left by a run with another model or another recipe set is not taken for this run.
+    """
+    return (prompt_function_name, int(rule_count), int(i), model, hashlib.sha256(str(recipe).encode('utf-8')).hexdigest()[:16])
+
+class ResultLog:
+    """
+        Append-only log of the results, one json line per (prompt function, rule count, row), written as soon as the row is done.
+        If a run crashes (or is interrupted), the rows already in the log are not sent again on the next run.
+        When a key appears several times (e.g. a failed row that was retried), the last line wins.
+    """
+    def __init__(self, path):
+        self.path = path
+        # The lines are written (and fsynced) one at a time by this thread, off the event loop
+        self._executor = ThreadPoolExecutor(1)
+
+    def load(self):
+        # {row_key: (row, new recipe, fulfilled percentage)}
+        results = {}
+        if not os.path.exists(self.path):
+            return results
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut if the process was killed while writing it
+                    continue
+                fulfilled = tuple(record['fulfilled']) if record['fulfilled'] is not None else None
+                # The lines of older logs have no model nor recipe digest, they are never resumed
+                key = (record['prompt_function'], record['rule_count'], record['row'], record.get('model'), record.get('recipe_digest'))
+                results[key] = (record['row'], record['new_recipe'], fulfilled)
+        return results
+
+    def append(self, key, result):
+        prompt_function_name, rule_count, i, model, recipe_digest = key
+        _, new_recipe, fulfilled = result
+        record = {
+            'prompt_function': prompt_function_name,
+            'rule_count': int(rule_count),
+            'row': int(i),
+            'model': model,
+            'recipe_digest': recipe_digest,
+            'new_recipe': new_recipe,
+            'fulfilled': fulfilled,
+        }
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def append_async(self, key, result):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.append, key, result)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+def load_results(log_path, model=None):
+    """
+        Rebuilds the results of a run from its log, in the format returned by parallel_process merged into one dictionary:
+        {prompt function name: {rule count: [(row, new recipe, fulfilled percentage)]}}, the rows sorted.
+        If the log holds the runs of several models, pass the model of the run to load.
+    """
+    rows = {}
+    for (name, rule_count, i, row_model, _), result in ResultLog(log_path).load().items():
+        if model is None or row_model == model:
+            rows[(name, rule_count, i)] = result
+    results = {}
+    for (name, rule_count, _), result in sorted(rows.items()):
+        results.setdefault(name, {}).setdefault(rule_count, []).append(result)
+    return results
 
 def create_tasks(prompt_functions, rule_counts, relex_examples, extracted_rules):
     tasks = []
@@ -12,70 +88,104 @@ def create_tasks(prompt_functions, rule_counts, relex_examples, extracted_rules)
         tasks.append((i, prompt_function, rule_counts, relex_examples, extracted_rules))
     return tasks
 
-def process_prompt_fn(task_index, prompt_function, rule_counts, relex_examples, extracted_rules):
+async def process_row(scheduler, task_index, prompt_function, rule_count, i, row, extracted_rules, progress, log=None, done=None, model='gpt-4'):
+    key = row_key(prompt_function.__name__, rule_count, i, model, row['recipe'])
+    if done is not None and key in done:
+        progress['done'] += 1
+        return done[key]
+    fulfilled_rules, suggestions = hfb.extract_rules(
+        recipe=row['preprocessed'],
+        rules=extracted_rules,
+        rule_count=rule_count,
+        metric='lift',
+    )
+    prompt = hfb.create_prompt(
+        directions=row['recipe'],
+        fulfilled_rules=fulfilled_rules,
+        suggestions=suggestions,
+    )
+    # Transient errors (rate limits, connection errors, ...) are retried by the scheduler, a row that still fails is skipped
+    try:
+        response = await scheduler.run(
+            prompt_function,
+            prompt=prompt,
+            print_response=False,
+            model=model,
+            estimated_tokens=estimate_tokens(prompt),
+        )
+        fullfilled_percentage = hfb.get_fullfilled_percentage(response, suggestions)
+        result = (i, response.choices[0].message.content, fullfilled_percentage)
+    except Exception as e:
+        print(f"Task {task_index} row: {i}, rule count {rule_count}, failed due to {e}. Skipping...")
+        result = (i, None, None)
+    if log is not None:
+        await log.append_async(key, result)
+    # print progress at every 10%
+    progress['done'] += 1
+    if progress['done'] * 10 // progress['total'] != (progress['done'] - 1) * 10 // progress['total']:
+        print(f"Progress: {progress['done'] / progress['total']:.0%} {scheduler.stats()}")
+    return result
+
+async def process_prompt_fn(scheduler, task_index, prompt_function, rule_counts, relex_examples, extracted_rules, progress, log=None, done=None, model='gpt-4'):
     prompt_function_results = {}
     prompt_function_results[prompt_function.__name__] = {}
-    total_count = len(rule_counts) * len(relex_examples)
-    current_progress = 0
     print(f"Starting task {task_index}")
     for rule_count in rule_counts:
-        prompt_function_results[prompt_function.__name__][rule_count] = []
-        i = 0
-        retry_count = 0
-        while i < len(relex_examples):
-            try:
-                row = relex_examples.iloc[i]
-                fulfilled_rules, suggestions = hfb.extract_rules(
-                    recipe=row['preprocessed'],
-                    rules=extracted_rules,
-                    rule_count=rule_count,
-                    metric='lift',
-                )
-                prompt = hfb.create_prompt(
-                    directions=row['recipe'],
-                    fulfilled_rules=fulfilled_rules,
-                    suggestions=suggestions,
-                )
-                response = prompt_function(
-                    prompt=prompt,
-                    print_response=False,
-                    model='gpt-4'
-                )
-                fullfilled_percentage = hfb.get_fullfilled_percentage(response, suggestions)
-                prompt_function_results[prompt_function.__name__][rule_count].append((i,response.choices[0].message.content,fullfilled_percentage))
-            # Catch HTTP and Connection errors
-            except HTTPError as e:
-                # Sleep a little, then retry
-                print(f"Task {task_index} failed on row {i} due to HTTPError, rule count {rule_count}")
-                time.sleep(random.randint(1, 8))
-                continue
-            except ConnectionError as e:
-                # Sleep a little, then retry
-                print(f"Task {task_index} failed on row {i} due to ConnectionError, rule count {rule_count}")
-                time.sleep(random.randint(1, 8))
-                continue
-            except Exception as e:
-                retry_count += 1
-                if retry_count < 3:
-                    print(f"Task {task_index} row: {i}, rule count {rule_count} Retry count: {retry_count} failed due to {e}")
-                    print(f"Retrying...")
-                    continue
-                else:
-                    print(f"Task {task_index} row: {i}, rule count {rule_count}, failed due to {e}. Skipping...")
-                    prompt_function_results[prompt_function.__name__][rule_count].append((i,None,None))
-            current_progress += 1
-            # print progress at every 10%
-            progress_percentage = current_progress / total_count
-            if progress_percentage % 0.1 == 0:
-                print(f"Task {task_index} progress: {progress_percentage}")
-            i += 1
-            retry_count = 0
+        # Every row is sent at once, the scheduler decides when each request actually goes out
+        prompt_function_results[prompt_function.__name__][rule_count] = list(await asyncio.gather(*[
+            process_row(scheduler, task_index, prompt_function, rule_count, i, relex_examples.iloc[i], extracted_rules, progress, log, done, model)
+            for i in range(len(relex_examples))
+        ]))
     return prompt_function_results
 
+async def parallel_process_async(tasks, scheduler, log=None, done=None, model='gpt-4'):
+    progress = {'done': 0, 'total': sum(len(task[2]) * len(task[3]) for task in tasks)}
+    return list(await asyncio.gather(*[process_prompt_fn(scheduler, *task, progress, log, done, model) for task in tasks]))
+
+def _run(coroutine):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    # Jupyter already runs an event loop in the main thread, so ours runs in another thread
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+def parallel_process(tasks, scheduler=None, requests_per_minute=500, tokens_per_minute=40_000, max_concurrency=16, log_path=None, retry_failed=True, model='gpt-4'):
+    """
+        Runs all the tasks, every request of every prompt function going through one RequestScheduler.
+        The results are the same as before: one dictionary per task, {prompt function name: {rule count: [(row, new recipe, fulfilled percentage)]}}
+
+        With a log_path, every row is written to the log as soon as it is done, and the rows already in the log are
+        not sent again: rerunning the same call after a crash (or a Ctrl-C) only costs the missing rows. Only the rows
+        of the same model and the same recipes are resumed (see row_key).
 
-def parallel_process(tasks, cpu_count=10):
-    if(len(tasks) < cpu_count):
-        cpu_count = len(tasks)
-    with Pool(cpu_count) as pool:
-        results = pool.starmap(process_prompt_fn, tasks)
-    return results
\ No newline at end of file
+        Inputs:
+            - tasks: The tasks created by create_tasks.
+            - scheduler: The scheduler to use, e.g. to share one across runs: it is left open. Default is a new RequestScheduler
+                         with the limits below, closed at the end.
+            - requests_per_minute, tokens_per_minute: The limits of the account for the model (gpt-4).
+            - max_concurrency: The maximum number of requests in flight, whatever the number of prompt functions.
+            - log_path: The append-only log of the run (a .jsonl file). Default is None, i.e. nothing is written.
+            - retry_failed: Whether the rows that failed in a previous run (i.e. (row, None, None)) are sent again.
+            - model: The model the prompts are sent to. Default is 'gpt-4'.
+    """
+    owns_scheduler = scheduler is None
+    if owns_scheduler:
+        scheduler = RequestScheduler(requests_per_minute, tokens_per_minute, max_concurrency)
+    log, done = None, None
+    if log_path is not None:
+        log = ResultLog(log_path)
+        done = log.load()
+        if retry_failed:
+            done = {key: result for key, result in done.items() if result[1] is not None}
+        print(f"{len(done)} rows already done in {log_path}")
+    try:
+        results = _run(parallel_process_async(tasks, scheduler, log, done, model))
+    finally:
+        if owns_scheduler:
+            scheduler.close()
+        if log is not None:
+            log.close()
+    print(f"Done: {scheduler.stats()}")
+    return results
@@ -5,20 +5,30 @@
 # min_dist = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5]
 # min_cluster_size = [5, 10, 15, 20, 25, 50, 100, 250, 500, 1000]
 # min_samples= [5, 10, 15, 20, 25, 50, 100, 250, 500, 1000]
+import hashlib
+import os
+import pickle
+import time
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+from sklearn.model_selection import ParameterGrid
 from umap import UMAP
 from hdbscan import HDBSCAN
 from sklearn.feature_extraction.text import TfidfVectorizer
 from bertopic import BERTopic
-from sentence_transformers import SentenceTransformer
+from bertopic.dimensionality import BaseDimensionalityReduction
+from embedding_store import load_model, DEFAULT_MODEL
 
 
 # function for grid search to feed into multiprocessing
-def apply_bert_topic(grid, recipe_sentences, embeded_sentences):
+def apply_bert_topic(grid, recipe_sentences, embeded_sentences=None, model_name=DEFAULT_MODEL):
+    # With precomputed embeddings (e.g. EmbeddingStore.get) no model is needed, otherwise each worker loads it once
     print(grid)
     umap = UMAP(n_neighbors=grid['n_neighbors'], n_components=grid['n_components'], min_dist=grid['min_dist'], metric='cosine')
     hdbscan = HDBSCAN(min_cluster_size=grid['min_cluster_size'], min_samples=grid['min_samples'], metric='euclidean', cluster_selection_method='eom')
     vectorizer = TfidfVectorizer(stop_words='english', lowercase=True)
-    embedding_model = SentenceTransformer('bert-base-nli-mean-tokens')
+    embedding_model = load_model(model_name) if embeded_sentences is None else None
 
     topic_model = BERTopic(
         language='english',
@@ -34,3 +44,150 @@ def apply_bert_topic(grid, recipe_sentences, embeded_sentences):
     print('Done with grid search', grid)
 
     return grid, topic_model.get_topic_freq()
+
+
+# Sweep driver: UMAP only depends on n_neighbors, n_components and min_dist, so the grid is grouped by these three
+# parameters and each reduction is fitted once (and cached on disk), then every HDBSCAN setting of the group is fitted on it
+# by the pool, while the main process fits the next reduction. Every result is appended to the output file as soon as it
+# is done, and the settings already in the file are skipped, so an interrupted sweep is resumed by running it again.
+UMAP_PARAMS = ('n_neighbors', 'n_components', 'min_dist')
+
+# The documents of the sweep, sent once to every worker by _init_sweep_worker
+_sweep_documents = []
+
+
+def prune_grid(grid):
+    """
+        Returns the combinations of the grid (a dictionary of lists, as for sklearn's ParameterGrid) with min_samples <= min_cluster_size,
+        HDBSCAN can't have more core samples than the size of a cluster.
+    """
+    return [params for params in ParameterGrid(grid) if params['min_samples'] <= params['min_cluster_size']]
+
+
+def load_sweep_results(output_path):
+    """
+        Reads the (params, topic frequencies) results written by grid_search. A result cut by an interruption is ignored.
+    """
+    results = []
+    if not os.path.exists(output_path):
+        return results
+    with open(output_path, 'rb') as f:
+        while True:
+            try:
+                results.append(pickle.load(f))
+            except (EOFError, pickle.UnpicklingError):
+                return results
+
+
+def embeddings_fingerprint(embeddings):
+    """
+        Returns a hash of the embeddings (shape, dtype and values), the key of their reductions in the cache of reduce_embeddings.
+    """
+    embeddings = np.ascontiguousarray(embeddings)
+    digest = hashlib.sha256(f'{embeddings.shape}{embeddings.dtype.str}'.encode())
+    digest.update(memoryview(embeddings).cast('B'))
+    return digest.hexdigest()[:16]
+
+
+def reduce_embeddings(embeddings, n_neighbors, n_components, min_dist, cache_dir, fingerprint=None):
+    """
+        Fits UMAP on the embeddings and returns the path of the reduction (a .npy file), reused if it is already in cache_dir.
+        The file is named after the number of embeddings and their fingerprint (see embeddings_fingerprint), so the reductions of
+        other embeddings in the same cache_dir are never picked up. Pass the fingerprint to hash the embeddings only once per sweep.
+    """
+    fingerprint = fingerprint or embeddings_fingerprint(embeddings)
+    path = os.path.join(cache_dir, f'umap_{len(embeddings)}x{fingerprint}_nn{n_neighbors}_nc{n_components}_md{min_dist}.npy')
+    if os.path.exists(path) and np.load(path, mmap_mode='r').shape != (len(embeddings), n_components):
+        print(f'{path} does not match the embeddings, fitting it again')
+        os.remove(path)
+    if not os.path.exists(path):
+        start = time.perf_counter()
+        umap = UMAP(n_neighbors=n_neighbors, n_components=n_components, min_dist=min_dist, metric='cosine')
+        reduced = umap.fit_transform(embeddings).astype(np.float32)
+        # Written under another name first, a cut file is never picked up
+        np.save(path + '.tmp.npy', reduced)
+        os.replace(path + '.tmp.npy', path)
+        print(f'UMAP n_neighbors={n_neighbors}, n_components={n_components}, min_dist={min_dist} ({time.perf_counter() - start:.1f}s)')
+    return path
+
+
+def grid_search(grid, recipe_sentences, embeded_sentences, output_path='grid_search_results.pkl', cache_dir='umap_cache', processes=None):
+    """
+        Runs apply_bert_topic on every combination of the grid, fitting each UMAP reduction once.
+
+        Inputs:
+            - grid: A dictionary of lists with the keys n_neighbors, n_components, min_dist, min_cluster_size and min_samples.
+              The combinations with min_samples > min_cluster_size are dropped (see prune_grid).
+            - recipe_sentences: The documents.
+            - embeded_sentences: Their embeddings (e.g. EmbeddingStore.get).
+            - output_path: The file the results are appended to, read it with load_sweep_results. The combinations already in it are skipped.
+            - cache_dir: The directory of the UMAP reductions, can be shared by sweeps over different embeddings.
+            - processes: The number of HDBSCAN workers. Default is os.cpu_count().
+
+        Output:
+            - The list of (params, topic frequencies) of the whole grid, as returned by apply_bert_topic.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    done = {_params_key(params) for params, _ in load_sweep_results(output_path)}
+    remaining = [params for params in prune_grid(grid) if _params_key(params) not in done]
+    groups = {}
+    for params in remaining:
+        groups.setdefault(tuple(params[name] for name in UMAP_PARAMS), []).append(params)
+    print(f'{len(done)} combinations already done, {len(remaining)} to go in {len(groups)} UMAP groups')
+
+    embeded_sentences = np.asarray(embeded_sentences)
+    fingerprint = embeddings_fingerprint(embeded_sentences)
+    progress = {'done': 0, 'failed': 0}
+    start = time.perf_counter()
+
+    def write(result):
+        # Called in the result thread of the pool, one result at a time
+        with open(output_path, 'ab') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        progress['done'] += 1
+        elapsed = time.perf_counter() - start
+        print(f"{progress['done']}/{len(remaining)} done ({elapsed:.0f}s, {progress['done'] / elapsed * 3600:.0f}/h)")
+
+    def failed(params, error):
+        progress['failed'] += 1
+        print(f'{params} failed due to {error!r}, it will be run again by the next sweep')
+
+    with Pool(processes, initializer=_init_sweep_worker, initargs=(recipe_sentences,)) as pool:
+        for umap_values, group in groups.items():
+            # The pool fits the previous groups meanwhile
+            reduction = reduce_embeddings(embeded_sentences, *umap_values, cache_dir, fingerprint)
+            for params in group:
+                pool.apply_async(_fit_topics, (params, reduction), callback=write, error_callback=partial(failed, params))
+        pool.close()
+        pool.join()
+    if progress['failed']:
+        print(f"{progress['failed']} combinations failed")
+    return load_sweep_results(output_path)
+
+
+def _params_key(params):
+    return tuple(sorted(params.items()))
+
+
+def _init_sweep_worker(documents):
+    global _sweep_documents
+    _sweep_documents = documents
+
+
+def _fit_topics(params, reduction):
+    reduced = np.load(reduction, mmap_mode='r')
+    hdbscan = HDBSCAN(min_cluster_size=params['min_cluster_size'], min_samples=params['min_samples'], metric='euclidean', cluster_selection_method='eom')
+    vectorizer = TfidfVectorizer(stop_words='english', lowercase=True)
+    topic_model = BERTopic(
+        language='english',
+        top_n_words=10,
+        # The embeddings given to fit_transform are already reduced
+        umap_model=BaseDimensionalityReduction(),
+        hdbscan_model=hdbscan,
+        vectorizer_model=vectorizer,
+        verbose=False,
+        )
+    topic_model.fit_transform(documents=_sweep_documents, embeddings=np.asarray(reduced))
+    return params, topic_model.get_topic_freq()
@@ -0,0 +1,175 @@
+# Sentence embeddings of the recipes, computed once and kept on disk.
+# bert_topic.ipynb encoded the recipes one at a time (Pool.imap(embedding_model.encode, ...)) and pickled the whole list;
+# here the recipes are encoded in batches, appended to a flat array as they are done, and memory-mapped when read back.
+# The store is keyed by recipe id, so adding recipes to the corpus only encodes the new ones.
+#
+# Usage:
+#   store = EmbeddingStore('dataset/embeddings', 'bert-base-nli-mean-tokens')
+#   store.fill(recipes['id'].tolist(), recipe_sentences, batch_size=64)
+#   embeded_sentences = store.get(recipes['id'].tolist())
+
+import json
+import os
+import re
+import time
+from functools import lru_cache
+from typing import List, Callable, Any
+import numpy as np
+
+DEFAULT_MODEL = 'bert-base-nli-mean-tokens'
+
+
+@lru_cache(maxsize=None)
+def load_model(model_name: str = DEFAULT_MODEL, device: str = 'cpu'):
+    """
+        Returns the SentenceTransformer, loaded once per process (i.e. once per worker of a Pool).
+    """
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name, device=device)
+
+
+class EmbeddingStore:
+    """
+        The embeddings of one model, in <path>/<model name>/:
+            - meta.json: The model, the dimension, the dtype and the number of embeddings.
+            - ids.jsonl: The recipe id of each row, one json value per line.
+            - embeddings.bin: The rows, written one after the other.
+        Both files are only appended to, and only the part counted in meta.json (which is replaced last) is valid: the rest may be
+        left by a fill that was interrupted, and is overwritten by the next one.
+
+        Inputs:
+            - path: The directory of the stores.
+            - model_name: The SentenceTransformer model. Default is 'bert-base-nli-mean-tokens', as in bert_topic.ipynb
+            - dtype: The dtype the embeddings are stored with, np.float32 or np.float16 (half the size). Default is np.float32
+    """
+    def __init__(self, path: str, model_name: str = DEFAULT_MODEL, dtype: Any = np.float32):
+        self.model_name = model_name
+        self.path = os.path.join(path, re.sub(r'[^\w.-]', '_', model_name))
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self.ids = []
+        self._ids_size = 0
+        if os.path.exists(os.path.join(self.path, 'meta.json')):
+            with open(os.path.join(self.path, 'meta.json')) as f:
+                meta = json.load(f)
+            if np.dtype(meta['dtype']) != self.dtype:
+                raise ValueError(f"{self.path} stores {meta['dtype']} embeddings, not {self.dtype}")
+            self.dim = meta['dim']
+            self._ids_size = meta['ids_size']
+            with open(os.path.join(self.path, 'ids.jsonl'), 'rb') as f:
+                self.ids = [json.loads(line) for line in f.read(self._ids_size).splitlines()]
+        self.rows = {recipe_id: row for row, recipe_id in enumerate(self.ids)}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, recipe_id) -> bool:
+        return recipe_id in self.rows
+
+    def missing(self, ids: List) -> List:
+        """
+            Returns the ids without an embedding, in order and without duplicates.
+        """
+        return list(dict.fromkeys(recipe_id for recipe_id in ids if recipe_id not in self.rows))
+
+    def array(self) -> np.ndarray:
+        """
+            Returns all the embeddings as a memory-mapped (read-only) array, in the order they were added.
+        """
+        if not self.ids:
+            return np.empty((0, self.dim or 0), dtype=self.dtype)
+        return np.memmap(os.path.join(self.path, 'embeddings.bin'), dtype=self.dtype, mode='r', shape=(len(self.ids), self.dim))
+
+    def get(self, ids: List) -> np.ndarray:
+        """
+            Returns the embeddings of the ids, in the same order, as a float32 array.
+            Raises a KeyError if one of them is missing (see fill).
+        """
+        rows = np.array([self.rows[recipe_id] for recipe_id in ids], dtype=np.int64)
+        return np.asarray(self.array()[rows], dtype=np.float32)
+
+    def add(self, ids: List, embeddings: np.ndarray) -> None:
+        """
+            Appends the embeddings of new ids to the store.
+        """
+        embeddings = np.asarray(embeddings, dtype=self.dtype)
+        if len(ids) != len(embeddings):
+            raise ValueError(f'Got {len(ids)} ids but {len(embeddings)} embeddings')
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f'Expected embeddings of dimension {self.dim}, but got {embeddings.shape[1]}')
+        already = [recipe_id for recipe_id in ids if recipe_id in self.rows]
+        if already:
+            raise ValueError(f'{len(already)} ids are already in the store, e.g. {already[0]!r}')
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'embeddings.bin'), 'ab') as f:
+            # Drop what an interrupted fill may have left after the valid rows
+            f.truncate(len(self.ids) * self.dim * self.dtype.itemsize)
+            f.write(np.ascontiguousarray(embeddings).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(os.path.join(self.path, 'ids.jsonl'), 'ab') as f:
+            f.truncate(self._ids_size)
+            f.write(''.join(json.dumps(recipe_id) + '\n' for recipe_id in ids).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            ids_size = f.tell()
+        # meta.json is replaced last, it makes the new rows valid
+        _write_json(os.path.join(self.path, 'meta.json'), {
+            'model': self.model_name, 'dim': self.dim, 'dtype': self.dtype.name, 'count': len(self.ids) + len(ids), 'ids_size': ids_size,
+        })
+        self._ids_size = ids_size
+        for recipe_id in ids:
+            self.rows[recipe_id] = len(self.ids)
+            self.ids.append(recipe_id)
+
+    def fill(
+        self,
+        ids: List,
+        texts: List[str],
+        batch_size: int = 64,
+        device: str = 'cpu',
+        encoder: Callable[[List[str]], np.ndarray] | None = None,
+        save_every: int = 50,
+    ) -> int:
+        """
+            Encodes the texts whose id is not in the store yet, in batches, and adds them to the store.
+
+            Inputs:
+                - ids: The recipe ids.
+                - texts: The text of each recipe (e.g. the joined directions).
+                - batch_size: The number of texts encoded at once.
+                - device: The device of the model. Default is 'cpu'.
+                - encoder: The function encoding a list of texts. Default is the encode method of the model of the store (see load_model).
+                - save_every: The number of batches encoded between two writes to disk. An interrupted fill only loses the batches since the last write.
+
+            Output:
+                - The number of texts encoded.
+        """
+        text_of = dict(zip(ids, texts))
+        missing = self.missing(ids)
+        if not missing:
+            return 0
+        if encoder is None:
+            model = load_model(self.model_name, device)
+            encoder = lambda batch: model.encode(batch, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+        start = time.perf_counter()
+        chunk = batch_size * save_every
+        for offset in range(0, len(missing), chunk):
+            chunk_ids = missing[offset:offset + chunk]
+            embeddings = np.concatenate([
+                np.asarray(encoder([text_of[recipe_id] for recipe_id in chunk_ids[i:i + batch_size]]))
+                for i in range(0, len(chunk_ids), batch_size)
+            ])
+            self.add(chunk_ids, embeddings)
+            done = offset + len(chunk_ids)
+            elapsed = time.perf_counter() - start
+            print(f"Encoded {done}/{len(missing)} recipes ({done / elapsed:.1f} recipes/s)")
+        return len(missing)
+
+
+def _write_json(path: str, data) -> None:
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
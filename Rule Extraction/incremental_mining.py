@@ -0,0 +1,273 @@
+# Incremental updates of the rule table as new recipes come in, without mining the whole corpus again.
+# The state of the miner is the count of every frequent itemset and of its negative border (the itemsets that are not
+# frequent but whose subsets all are, see Thomas et al., "An efficient algorithm for the incremental updation of
+# association rules in large databases"). Adding a batch of recipes only counts these itemsets in the batch:
+#   - If no border itemset became frequent, the new frequent itemsets and their exact counts are known, the old
+#     recipes are not read again.
+#   - Otherwise, only the new candidates (the itemsets whose subsets all became frequent) are counted over the
+#     old partitions, level by level, which is rare once the corpus is large.
+# The rules are then regenerated from the counts and published as a new version of the rule table
+# (see rule_store.publish_rule_table), which the backend picks up without a restart (see helpers_for_backend.RuleTable).
+#
+# Usage:
+#   miner = IncrementalMiner.create('../dataset/full_dataset.csv', '../dataset/miner_state', min_support=0.01)
+#   miner.publish('../dataset/rules')
+#   ...
+#   miner = IncrementalMiner.load('../dataset/miner_state')
+#   miner.add_recipes([tokenize_directions(directions) for directions in new_recipes['directions']])
+#   miner.publish('../dataset/rules')
+
+import json
+import os
+import sys
+import time
+from itertools import combinations
+from typing import List, Dict, FrozenSet, Set
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rule_store import publish_rule_table
+from preprocessed_corpus import preprocess_corpus, load_preprocessed
+from rule_mining import (
+    corpus_transactions, save_partition, mine_frequent_itemsets, count_itemsets,
+    itemset_matrix, count_in_matrix, generate_rules, load_partition,
+)
+
+
+class IncrementalMiner:
+    """
+        The counts of the frequent itemsets of a corpus and of their negative border, kept up to date as recipes are added.
+
+        The state is a directory: the partitions of token-id transactions (see rule_mining.write_transactions), the vocabulary,
+        the tracked itemsets with their counts, and state.json, which is written last so that an interrupted update leaves
+        the previous state readable.
+
+        Inputs:
+            - state_dir: The directory of the state.
+            - tokens: The vocabulary, token id -> token.
+            - partitions: The partitions of the corpus, relative to state_dir.
+            - itemsets: The tracked itemsets with the number of recipes containing them.
+            - n_recipes: The number of recipes in the corpus.
+            - min_support: The minimum support, as a fraction of the recipes.
+            - max_len: The maximum size of the itemsets.
+    """
+    def __init__(
+        self,
+        state_dir: str,
+        tokens: List[str],
+        partitions: List[str],
+        itemsets: Dict[FrozenSet[int], int],
+        n_recipes: int,
+        min_support: float,
+        max_len: int | None,
+    ):
+        self.state_dir = state_dir
+        self.tokens = tokens
+        self.token_ids = {token: i for i, token in enumerate(tokens)}
+        self.partitions = partitions
+        self.itemsets = itemsets
+        self.n_recipes = n_recipes
+        self.min_support = min_support
+        self.max_len = max_len
+        # The number of the saved itemset files, see save
+        self.generation = 0
+
+    @classmethod
+    def create(
+        cls,
+        csv_path: str,
+        state_dir: str,
+        min_support: float = 0.01,
+        max_len: int | None = 5,
+        chunksize: int = 50_000,
+        processes: int | None = None,
+        column: str = 'directions',
+    ) -> 'IncrementalMiner':
+        """
+            Mines the corpus once (see rule_mining.mine_frequent_itemsets), counts the negative border and saves the state.
+            The tokens are read from the preprocessed corpus of the csv (see preprocessed_corpus.py).
+
+            Inputs:
+                - csv_path: The corpus, e.g. full_dataset.csv.
+                - state_dir: The directory to write the state to.
+                - min_support, max_len: See rule_mining.mine_frequent_itemsets.
+                - chunksize, processes, column: See preprocessed_corpus.preprocess_corpus.
+        """
+        corpus = load_preprocessed(preprocess_corpus(csv_path, column, chunksize=chunksize, processes=processes))
+        partitions, tokens = corpus_transactions(corpus, os.path.join(state_dir, 'partitions'), chunksize)
+        frequent, n_recipes = mine_frequent_itemsets(partitions, len(tokens), min_support, max_len, processes)
+        miner = cls(
+            state_dir, tokens, [os.path.relpath(partition, state_dir) for partition in partitions],
+            frequent, n_recipes, min_support, max_len,
+        )
+        # Every token is tracked, a token that is not frequent is in the negative border
+        singletons = [frozenset([token]) for token in range(len(tokens)) if frozenset([token]) not in frequent]
+        miner._count_over_partitions(singletons, miner.partitions, processes)
+        miner._extend_border(processes)
+        miner.save()
+        return miner
+
+    @classmethod
+    def load(cls, state_dir: str) -> 'IncrementalMiner':
+        """
+            Loads the state saved by save.
+        """
+        with open(os.path.join(state_dir, 'state.json')) as f:
+            state = json.load(f)
+        with open(os.path.join(state_dir, 'vocab.json')) as f:
+            tokens = json.load(f)
+        offsets = np.load(os.path.join(state_dir, f'itemsets_{state["generation"]}_offsets.npy'))
+        ids = np.load(os.path.join(state_dir, f'itemsets_{state["generation"]}_ids.npy'))
+        counts = np.load(os.path.join(state_dir, f'itemsets_{state["generation"]}_counts.npy'))
+        itemsets = {
+            frozenset(ids[start:end].tolist()): int(count)
+            for start, end, count in zip(offsets[:-1], offsets[1:], counts)
+        }
+        miner = cls(state_dir, tokens, state['partitions'], itemsets, state['n_recipes'], state['min_support'], state['max_len'])
+        miner.generation = state['generation']
+        return miner
+
+    def save(self) -> None:
+        """
+            Writes the state. The itemsets are written under a new generation number and state.json is replaced last,
+            so a crash in the middle leaves the previous state intact.
+        """
+        generation = self.generation + 1
+        itemsets = list(self.itemsets)
+        offsets = np.zeros(len(itemsets) + 1, dtype=np.int64)
+        np.cumsum([len(itemset) for itemset in itemsets], out=offsets[1:])
+        np.save(os.path.join(self.state_dir, f'itemsets_{generation}_offsets.npy'), offsets)
+        np.save(os.path.join(self.state_dir, f'itemsets_{generation}_ids.npy'), np.fromiter(
+            (token for itemset in itemsets for token in sorted(itemset)), dtype=np.int32, count=offsets[-1]
+        ))
+        np.save(os.path.join(self.state_dir, f'itemsets_{generation}_counts.npy'), np.array([self.itemsets[i] for i in itemsets], dtype=np.int64))
+        _write_json(os.path.join(self.state_dir, 'vocab.json'), self.tokens)
+        _write_json(os.path.join(self.state_dir, 'state.json'), {
+            'generation': generation,
+            'partitions': self.partitions,
+            'n_recipes': self.n_recipes,
+            'min_support': self.min_support,
+            'max_len': self.max_len,
+        })
+        # The previous generation is not needed anymore
+        for name in ('offsets', 'ids', 'counts'):
+            path = os.path.join(self.state_dir, f'itemsets_{generation - 1}_{name}.npy')
+            if os.path.exists(path):
+                os.remove(path)
+        self.generation = generation
+
+    def add_recipes(self, recipes: List[List[str]], processes: int | None = None) -> Dict[str, int]:
+        """
+            Adds a batch of recipes to the corpus and updates the counts.
+
+            Inputs:
+                - recipes: A list of recipes, each a list of tokens (e.g. rule_mining.tokenize_directions of their directions).
+                - processes: The number of workers used if the old partitions have to be read. Default is os.cpu_count().
+
+            Output:
+                - A dictionary with the number of recipes added, of new frequent itemsets and of itemsets counted over the old partitions.
+        """
+        start = time.perf_counter()
+        rows = [sorted({self.token_ids.setdefault(token, len(self.token_ids)) for token in recipe}) for recipe in recipes]
+        new_tokens = list(self.token_ids)[len(self.tokens):]
+        self.tokens.extend(new_tokens)
+        partition = os.path.join('partitions', f'batch_{len(self.partitions)}')
+        save_partition(os.path.join(self.state_dir, partition), rows)
+        old_partitions = list(self.partitions)
+        self.partitions.append(partition)
+
+        # The new tokens never appeared in the old recipes, their count there is 0
+        for token in range(len(self.tokens) - len(new_tokens), len(self.tokens)):
+            self.itemsets[frozenset([token])] = 0
+        frequent_before = set(self.frequent_itemsets())
+        tracked = list(self.itemsets)
+        batch_counts = count_in_matrix(load_partition(os.path.join(self.state_dir, partition), len(self.tokens)), *itemset_matrix(tracked, len(self.tokens)))
+        for itemset, count in zip(tracked, batch_counts):
+            self.itemsets[itemset] += int(count)
+        self.n_recipes += len(rows)
+
+        recounted = self._extend_border(processes, old_partitions)
+        self.save()
+        new_frequent = len(set(self.frequent_itemsets()) - frequent_before)
+        print(f"Added {len(rows)} recipes: {new_frequent} new frequent itemsets, {recounted} itemsets counted over the old recipes ({time.perf_counter() - start:.1f}s)")
+        return {'recipes': len(rows), 'new_frequent': new_frequent, 'recounted': recounted}
+
+    def frequent_itemsets(self) -> Dict[FrozenSet[int], int]:
+        """
+            Returns the frequent itemsets with their counts, as returned by rule_mining.mine_frequent_itemsets.
+        """
+        return {itemset: count for itemset, count in self.itemsets.items() if count / self.n_recipes >= self.min_support}
+
+    def rules(self, metric: str = 'lift', min_threshold: float = 2.0) -> pd.DataFrame:
+        """
+            Generates the rules of the current corpus, see rule_mining.generate_rules.
+        """
+        return generate_rules(self.frequent_itemsets(), self.n_recipes, self.tokens, metric, min_threshold)
+
+    def publish(self, rules_dir: str, metric: str = 'lift', min_threshold: float = 2.0, keep: int = 5) -> str:
+        """
+            Generates the rules and publishes them as a new version of rules_dir (see rule_store.publish_rule_table).
+
+            Output:
+                - The name of the new version.
+        """
+        rules = self.rules(metric, min_threshold)
+        version = publish_rule_table(rules, rules_dir, keep)
+        print(f"{len(rules)} rules published as {version} in {rules_dir}")
+        return version
+
+    def _extend_border(self, processes: int | None = None, partitions: List[str] | None = None) -> int:
+        # Counts the candidates generated from the frequent itemsets that are not tracked yet, level by level, until the
+        # negative border is complete. Only the partitions given are read: the counts in the others (i.e. the batch just added)
+        # must already be included, which they are since every itemset containing a new token has a count of 0 in the old recipes.
+        partitions = self.partitions if partitions is None else partitions
+        recounted = 0
+        while True:
+            candidates = _candidates(set(self.frequent_itemsets()), self.max_len) - self.itemsets.keys()
+            if not candidates:
+                return recounted
+            candidates = sorted(candidates, key=lambda itemset: (len(itemset), sorted(itemset)))
+            batch = self.partitions[len(partitions):]
+            self._count_over_partitions(candidates, batch, processes=1, add=False)
+            self._count_over_partitions(candidates, partitions, processes, add=True)
+            recounted += len(candidates)
+
+    def _count_over_partitions(self, itemsets: List[FrozenSet[int]], partitions: List[str], processes: int | None = None, add: bool = False) -> None:
+        if not itemsets:
+            return
+        if not add:
+            for itemset in itemsets:
+                self.itemsets[itemset] = 0
+        if not partitions:
+            return
+        paths = [os.path.join(self.state_dir, partition) for partition in partitions]
+        if len(paths) == 1 or processes == 1:
+            counts = sum(count_in_matrix(load_partition(path, len(self.tokens)), *itemset_matrix(itemsets, len(self.tokens))) for path in paths)
+        else:
+            counts, _ = count_itemsets(paths, len(self.tokens), itemsets, processes)
+        for itemset, count in zip(itemsets, counts):
+            self.itemsets[itemset] += int(count)
+
+
+def _candidates(frequent: Set[FrozenSet[int]], max_len: int | None) -> Set[FrozenSet[int]]:
+    # Apriori candidate generation: the (k+1)-itemsets whose k-subsets are all frequent, for every k
+    candidates = set()
+    by_prefix = {}
+    for itemset in frequent:
+        if max_len is not None and len(itemset) >= max_len:
+            continue
+        items = tuple(sorted(itemset))
+        by_prefix.setdefault(items[:-1], []).append(items[-1])
+    for prefix, lasts in by_prefix.items():
+        lasts.sort()
+        for a, b in combinations(lasts, 2):
+            candidate = frozenset(prefix + (a, b))
+            if all(candidate - {item} in frequent for item in prefix):
+                candidates.add(candidate)
+    return candidates
+
+
+def _write_json(path: str, data) -> None:
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
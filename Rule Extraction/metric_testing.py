@@ -1,14 +1,26 @@
-from typing import List
+from typing import List, Tuple, Set, FrozenSet, Dict, Iterator
+import sys
+import time
+import pickle
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
 import pandas as pd
 # multiprocessing
 from multiprocessing import Pool
-from functools import partial
 # CPU count
 import os
 import numpy as np
 from concurrent.futures import ProcessPoolExecutor, as_completed
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rule_index import RuleIndex, extract_rules_batch, compile_rules
+from rule_arrays import SharedRuleView, write_rule_arrays, write_corpus, load_rule_arrays, load_corpus, corpus_tokens, extract_rules_shared
 
 def process_task(metric, recipes_chunk, sorted_rules_df, rule_count, rule_extractor):
+    # The batched extractor scores the whole chunk at once
+    if rule_extractor is extract_rules_batch:
+        extracted = extract_rules_batch(recipes_chunk['preprocessed'].tolist(), sorted_rules_df, rule_count, metric)
+        return [(recipe_id, metric, result) for recipe_id, result in zip(recipes_chunk['id'], extracted)]
     results = []
     for index, recipe in recipes_chunk.iterrows():
         # print(f"Processing recipe: {recipe['id']}, {recipe.preprocessed}")
@@ -17,51 +29,239 @@ def process_task(metric, recipes_chunk, sorted_rules_df, rule_count, rule_extrac
         results.append((recipe['id'], metric, (rule_set, rule_dict)))
     return results
 
-def create_tasks(df, metrics, num_cpus, rules_df, rule_count, rule_extractor):
-    chunk_size = len(df) // (num_cpus // len(metrics))  # Number of CPUs divided by the number of metrics
-    chunks = [df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size)]
+def sort_rules(rules: pd.DataFrame | RuleIndex, metric: str) -> pd.DataFrame | RuleIndex:
+    # A RuleIndex carries a permutation per metric, so there is nothing to sort or copy
+    if isinstance(rules, RuleIndex):
+        return rules
+    return rules.sort_values(metric, ascending=False)
 
-    tasks = []
-    for metric in metrics:
-        sorted_rules_df = rules_df.sort_values(metric, ascending=False)
-        for chunk in chunks:
-            tasks.append((metric, chunk, sorted_rules_df, rule_count, rule_extractor))
+def estimate_costs(recipes: List[List[str]], rules: pd.DataFrame | RuleIndex) -> np.ndarray:
+    """
+        Estimates the cost of extracting the rules of each recipe as its number of tokens times its number of candidate rules,
+        i.e. the rules with at least one antecedent token in the recipe (for a RuleIndex, the rules in the posting lists the recipe visits).
 
-    return tasks
+        Inputs:
+            - recipes: A list of recipes, each a list of tokens.
+            - rules: The rules DataFrame (load_rule_data) or a RuleIndex.
+
+        Output:
+            - The estimated cost of each recipe, type: np.ndarray
+    """
+    if isinstance(rules, RuleIndex):
+        # Number of rules registered under each token
+        rules_per_token = dict(enumerate(np.bincount(rules.anchors, minlength=len(rules.tokens)).tolist()))
+        token_ids = rules.token_ids
+        candidates = [sum(rules_per_token[token_ids[token]] for token in set(recipe) if token in token_ids) for recipe in recipes]
+    else:
+        # Number of rules each token is an antecedent of
+        rules_per_token = Counter(token for antecedents in rules['antecedents'] for token in set(antecedents))
+        candidates = [sum(rules_per_token.get(token, 0) for token in set(recipe)) for recipe in recipes]
+    # +1 so that recipes without candidates still count for something
+    return np.array([len(recipe) for recipe in recipes], dtype=np.float64) * (np.array(candidates, dtype=np.float64) + 1)
+
+def cost_chunks(costs: np.ndarray, n_chunks: int) -> List[Tuple[int, int]]:
+    """
+        Splits the recipes into at most n_chunks contiguous (start, end) ranges of about the same total cost.
+    """
+    n_chunks = max(1, min(n_chunks, len(costs)))
+    cumulative = np.cumsum(costs)
+    if len(costs) == 0:
+        return []
+    # Cut where the cumulative cost crosses a multiple of total / n_chunks
+    targets = cumulative[-1] * np.arange(1, n_chunks) / n_chunks
+    cuts = np.unique(np.searchsorted(cumulative, targets, side='right'))
+    bounds = [0] + [int(cut) for cut in cuts if 0 < cut < len(costs)] + [len(costs)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+class MetricTasks(list):
+    """
+        The tasks of create_tasks, one (metric, start, end, cost) tuple per chunk of recipes and metric: the rows start:end of
+        the recipes, with their estimated cost (see estimate_costs). The recipes, the rules and the extractor are held once by
+        the list instead of being copied into every task, parallel_process sends them to each worker once.
+    """
+    def __init__(self, tasks, recipes, rules, rule_count, rule_extractor):
+        super().__init__(tasks)
+        self.recipes = recipes
+        self.rules = rules
+        self.rule_count = rule_count
+        self.rule_extractor = rule_extractor
+
+    @property
+    def metrics(self) -> List[str]:
+        return list(dict.fromkeys(metric for metric, _, _, _ in self))
+
+def create_tasks(df, metrics, num_cpus, rules_df, rule_count, rule_extractor, chunks_per_cpu=4):
+    # More chunks than CPUs, of about the same estimated cost, so that the pool can balance the load while it runs.
+    # (The chunks used to be len(df) // (num_cpus // len(metrics)) rows, which divided by zero with fewer CPUs than metrics.)
+    n_chunks = max(1, -(-num_cpus * chunks_per_cpu // len(metrics)))
+    if rule_extractor is extract_rules_batch:
+        # Compiled once here, the index serves every metric
+        rules_df = compile_rules(rules_df, metrics[0])
+    # The rule-token frequencies are counted once, for all the chunks and metrics
+    costs = estimate_costs(df['preprocessed'].tolist(), rules_df)
+    chunks = cost_chunks(costs, n_chunks)
+    tasks = [(metric, start, end, float(costs[start:end].sum())) for metric in metrics for start, end in chunks]
+    return MetricTasks(tasks, df[['id', 'preprocessed']], rules_df, rule_count, rule_extractor)
 
 def parallel_process(tasks, cpu_count=10):
-    with Pool(cpu_count) as pool:
-        results = pool.starmap(process_task, tasks)
+    """
+        Runs the tasks of create_tasks and returns their results in the order of the tasks: for each task, the list of
+        (recipe id, metric, (rule_set, rule_dict)) of its recipes.
+        The rules and the recipes are written once to memory-mapped arrays that every worker maps (see metric_test), and
+        the tasks only carry positions. The tasks are handed out
+        one at a time, the most expensive first, so no worker is left with a long task at the end.
+        The utilization of every worker is printed at the end.
+    """
+    ids = tasks.recipes['id'].tolist()
+    order = sorted(range(len(tasks)), key=lambda i: -tasks[i][3])
+    results = [None] * len(tasks)
+    utilization = WorkerUtilization()
+    worker_state = _worker_state(tasks.rules, tasks.recipes['preprocessed'].tolist(), tasks.metrics, tasks.rule_count, tasks.rule_extractor)
+    with worker_state as initargs, Pool(cpu_count, initializer=_init_worker, initargs=initargs) as pool:
+        for i, (start, metric, extracted, worker, busy) in pool.imap_unordered(_process_task, ((i, tasks[i]) for i in order)):
+            results[i] = [(ids[start + j], metric, result) for j, result in enumerate(extracted)]
+            utilization.add(worker, busy)
+    utilization.report()
     return results
 
+class WorkerUtilization:
+    """
+        Keeps track of the time each worker spent on tasks, to report how well the load was balanced.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.busy = Counter()
+        self.tasks = Counter()
+
+    def add(self, worker: int, busy: float) -> None:
+        self.busy[worker] += busy
+        self.tasks[worker] += 1
+
+    def report(self) -> None:
+        wall = time.perf_counter() - self.start
+        print(f"Wall time: {wall:.1f}s, {sum(self.tasks.values())} tasks on {len(self.busy)} workers")
+        for worker in sorted(self.busy):
+            print(f"\t -> Worker {worker}: {self.tasks[worker]} tasks, busy {self.busy[worker]:.1f}s ({self.busy[worker] / wall:.0%})")
+        if self.busy:
+            print(f"\t -> Mean utilization: {sum(self.busy.values()) / (len(self.busy) * wall):.0%}")
+
 def metric_test(metric_list: List[str], 
-                rules: pd.DataFrame, 
+                rules: pd.DataFrame | RuleIndex, 
                 recipes:pd.DataFrame, 
-                rule_extractor):
-    # Now divide the CPU count by the length of the metric list
-    # This way each metric will be tested on the same number of CPUs
-    cpu_per_metric = os.cpu_count() // len(metric_list)
-    metric_results = {}
-    for metric in metric_list:
-        print(f"Testing metric: {metric}")
-        # Divide the recipes into chunks where len chunk = cpu_per_metric
-        recipe_chunks = np.array_split(recipes, cpu_per_metric)
-        print(f"Number of chunks: {len(recipe_chunks)}")
-        # Map Async each chunk to a CPU, we want it to be non-blocking so we can continue to the next metric
-        # and gather the results later
-        with Pool(cpu_per_metric) as p:
-            fn = partial(extract_rule_from_chunk, metric, rules.sort_values(metric, ascending=False).copy(), rule_extractor)
-            results = p.map_async(fn, recipe_chunks)
-            metric_results[metric] = results
-    return metric_results
-
-
-def extract_rule_from_chunk(metric: str, rules: pd.DataFrame, recipe_chunk: pd.DataFrame, rule_extractor):
-    # Apply the rule extractor to each recipe in the chunk
-    to_return = []
-    for index, recipe in recipe_chunk.iterrows():
-        result = rule_extractor(recipe=recipe['preprocessed'], rules=rules, metric=metric, rule_count=10)
-        to_return.append(
-            (recipe['id'], metric, result)
-        )
-    return to_return
\ No newline at end of file
+                rule_extractor,
+                rule_count: int = 10,
+                output_path: str = 'metric_test_results.pkl',
+                processes: int | None = None,
+                chunks_per_process: int = 8,
+                report_every: float = 10.0) -> str:
+    """
+        Extracts the rules of every recipe for every metric, with all the metrics sharing one pool of workers.
+
+        The tasks only carry a metric and a range of recipe positions, whatever finishes first is written to output_path right away,
+        while the progress and throughput are printed. The rules (with their order for every metric) and the tokenized recipes
+        are written once to memory-mapped arrays (see rule_arrays.py), which every worker maps: the memory used doesn't grow
+        with the number of workers or of metrics. How the workers extract the rules depends on the extractor:
+            - extract_rules_batch: The rules of a whole chunk are extracted at once on the arrays (extract_rules_shared).
+            - Any other extractor (e.g. helper.extract_rules): It is called on every recipe with a SharedRuleView of the rules
+              sorted by the metric, which builds the rows from the arrays while they are iterated. The extractor must only use
+              rules.iterrows() and the 'antecedents', 'consequents' and metric columns of the rows, as the extract_rules functions
+              do. The recipes are the tokens that are in a rule (see write_corpus).
+
+        Inputs:
+            - metric_list: The metrics to sort the rules by.
+            - rules: The rules DataFrame (load_rule_data) or a RuleIndex.
+            - recipes: A DataFrame with the columns ['id', 'preprocessed'] (see preprocessed_corpus.preprocessed_column for the 'preprocessed' column).
+            - rule_extractor: The function extracting the rules of one recipe (e.g. helper.extract_rules), or extract_rules_batch.
+            - rule_count: The number of rules to suggest. Default is 10.
+            - output_path: The file the results are written to, read it back with load_metric_results.
+            - processes: The number of workers. Default is os.cpu_count().
+            - chunks_per_process: The recipes are split into about processes * chunks_per_process chunks of the same estimated cost
+              (see estimate_costs), handed out most expensive first.
+            - report_every: The number of seconds between two progress reports.
+
+        Output:
+            - output_path
+    """
+    processes = processes or os.cpu_count()
+    ids = recipes['id'].tolist()
+    tokens = recipes['preprocessed'].tolist()
+    costs = estimate_costs(tokens, rules)
+    cumulative = np.concatenate([[0], np.cumsum(costs)])
+    chunks = cost_chunks(costs, processes * chunks_per_process)
+    chunks.sort(key=lambda chunk: cumulative[chunk[0]] - cumulative[chunk[1]])
+    tasks = ((metric, start, end) for start, end in chunks for metric in metric_list)
+    utilization = WorkerUtilization()
+    total = len(ids) * len(metric_list)
+    done = 0
+    with _worker_state(rules, tokens, metric_list, rule_count, rule_extractor) as initargs:
+        start_time = last_report = time.perf_counter()
+        with open(output_path, 'wb') as sink, Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+            for start, metric, extracted, worker, busy in pool.imap_unordered(_process_chunk, tasks):
+                utilization.add(worker, busy)
+                results = [(ids[start + i], metric, rule_set, rule_dict) for i, (rule_set, rule_dict) in enumerate(extracted)]
+                # Every chunk is appended to the file as its own pickle, nothing is kept in memory
+                pickle.dump(results, sink, protocol=pickle.HIGHEST_PROTOCOL)
+                done += len(results)
+                now = time.perf_counter()
+                if now - last_report >= report_every or done == total:
+                    last_report = now
+                    throughput = done / (now - start_time)
+                    eta = (total - done) / throughput if throughput else float('inf')
+                    print(f"{done}/{total} ({done / total:.0%}) - {throughput:.1f} recipes/s - ETA {eta:.0f}s")
+    utilization.report()
+    return output_path
+
+
+def load_metric_results(path: str) -> Iterator[Tuple[int, str, Set[FrozenSet[str]], Dict[FrozenSet[str], Tuple[str, float]]]]:
+    """
+        Reads the results written by metric_test, one (recipe_id, metric, rule_set, rule_dict) tuple at a time.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                results = pickle.load(f)
+            except EOFError:
+                return
+            yield from results
+
+
+@contextmanager
+def _worker_state(rules: pd.DataFrame | RuleIndex, tokens: List[List[str]], metric_list: List[str], rule_count: int, rule_extractor):
+    # The initargs of _init_worker: whatever the extractor, the workers map the same arrays (see metric_test)
+    with tempfile.TemporaryDirectory(prefix='metric_test_') as shared_dir:
+        # The order of every metric comes from the index (rule_store.sort_order), not from the order of the DataFrame
+        index = compile_rules(rules, metric_list[0])
+        write_rule_arrays(index, metric_list, shared_dir)
+        write_corpus(tokens, index, shared_dir)
+        yield (shared_dir, metric_list, rule_count, rule_extractor)
+
+
+# State of the metric_test and parallel_process workers, set once per worker by _init_worker
+_worker = {}
+
+def _init_worker(shared_dir: str, metric_list: List[str], rule_count: int, rule_extractor) -> None:
+    # Only maps the files, the pages are shared with the other workers
+    _worker['arrays'] = load_rule_arrays(shared_dir)
+    _worker['corpus'] = load_corpus(shared_dir)
+    _worker['views'] = {metric: SharedRuleView(_worker['arrays'], metric) for metric in metric_list}
+    _worker['rule_count'] = rule_count
+    _worker['rule_extractor'] = rule_extractor
+
+
+def _process_chunk(task: Tuple[str, int, int]) -> Tuple[int, str, List[Tuple[Set[FrozenSet[str]], Dict[FrozenSet[str], Tuple[str, float]]]], int, float]:
+    metric, start, end = task
+    start_time = time.perf_counter()
+    rule_count = _worker['rule_count']
+    rule_extractor = _worker['rule_extractor']
+    if rule_extractor is extract_rules_batch:
+        extracted = extract_rules_shared(_worker['arrays'], _worker['corpus'][start:end], rule_count, metric)
+    else:
+        rules = _worker['views'][metric]
+        recipes = corpus_tokens(_worker['arrays'], _worker['corpus'][start:end])
+        extracted = [rule_extractor(recipe=recipe, rules=rules, rule_count=rule_count, metric=metric) for recipe in recipes]
+    return start, metric, extracted, os.getpid(), time.perf_counter() - start_time
+
+
+def _process_task(indexed_task: Tuple[int, Tuple[str, int, int, float]]):
+    i, (metric, start, end, _) = indexed_task
+    return i, _process_chunk((metric, start, end))
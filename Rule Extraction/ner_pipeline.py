@@ -0,0 +1,305 @@
+# Sharded NLTK pipeline over the corpus: word_tokenize, then pos_tag, then ne_chunk, as in ner.ipynb.
+# The notebook kept the results of each stage as one pickled list of the whole corpus, which must be fully loaded
+# before it can be used. Here the corpus is split in shards of consecutive recipes, processed in parallel, and every stage
+# writes compact arrays per shard:
+#   - tokens: tokens_offsets.npy, tokens_ids.npy (the ids of the tokens in tokens_vocab.json) and recipe_ids.npy
+#   - pos: pos_ids.npy, the tag of each token (ids in pos_tags.json)
+#   - ner: entities.npy, one (recipe, start token, end token, label) row per named entity (labels in ner_labels.json)
+# A stage of a shard is done once its <stage>.json is written, so an interrupted run only redoes the unfinished ones,
+# and running a stage again (force) invalidates the later stages of the same shards only.
+#
+# Usage:
+#   python ner_pipeline.py ../dataset/full_dataset.csv ../dataset/ner --shard-size 20000
+#   for recipe in NerShards('../dataset/ner').recipes(): ...
+
+import argparse
+import ast
+import json
+import os
+import time
+from dataclasses import dataclass
+from multiprocessing import Pool
+from typing import List, Tuple, Dict, Iterator, Iterable
+import numpy as np
+import pandas as pd
+from nltk import download as nltk_download
+from nltk.tokenize import word_tokenize
+from nltk.tag import pos_tag
+from nltk.chunk import ne_chunk
+from nltk.tree import Tree
+
+STAGES = ['tokens', 'pos', 'ner']
+# Bump the version of a stage if its output changes, the shards done with another version are done again
+STAGE_VERSIONS = {'tokens': 1, 'pos': 1, 'ner': 1}
+# The NLTK resources of each stage (the older and the newer names)
+STAGE_RESOURCES = {
+    'tokens': ['punkt', 'punkt_tab'],
+    'pos': ['averaged_perceptron_tagger', 'averaged_perceptron_tagger_eng'],
+    'ner': ['maxent_ne_chunker', 'maxent_ne_chunker_tab', 'words'],
+}
+ENTITY_DTYPE = np.dtype([('recipe', np.int32), ('start', np.int32), ('end', np.int32), ('label', np.int16)])
+
+
+@dataclass
+class NerShard:
+    """
+        The output of one shard, memory-mapped. The arrays of a stage that was not run are None.
+    """
+    path: str
+    recipe_ids: np.ndarray
+    vocab: List[str]
+    offsets: np.ndarray
+    token_ids: np.ndarray
+    tags: List[str] | None = None
+    pos_ids: np.ndarray | None = None
+    labels: List[str] | None = None
+    entities: np.ndarray | None = None
+
+    def __len__(self) -> int:
+        return len(self.recipe_ids)
+
+    def tokens(self, row: int) -> List[str]:
+        """
+            Returns the tokens of the recipe at the given row of the shard, as word_tokenize returned them.
+        """
+        return [self.vocab[i] for i in self.token_ids[self.offsets[row]:self.offsets[row + 1]].tolist()]
+
+    def pos(self, row: int) -> List[Tuple[str, str]]:
+        """
+            Returns the (token, tag) pairs of the recipe, as pos_tag returned them.
+        """
+        tags = self.pos_ids[self.offsets[row]:self.offsets[row + 1]].tolist()
+        return list(zip(self.tokens(row), (self.tags[tag] for tag in tags)))
+
+    def recipe_entities(self, row: int) -> List[Tuple[str, str]]:
+        """
+            Returns the (entity, label) pairs of the recipe, e.g. ('Dutch oven', 'GPE'), in order of appearance.
+        """
+        start, end = np.searchsorted(self.entities['recipe'], [row, row + 1])
+        tokens = self.tokens(row)
+        return [
+            (' '.join(tokens[entity['start']:entity['end']]), self.labels[entity['label']])
+            for entity in self.entities[start:end]
+        ]
+
+
+class NerShards:
+    """
+        The shards written by run_ner_pipeline, loaded one at a time when iterated.
+
+        Inputs:
+            - output_dir: The directory of the shards.
+    """
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.shard_dirs = sorted(
+            os.path.join(output_dir, name) for name in os.listdir(output_dir) if name.startswith('shard_')
+        )
+
+    def __len__(self) -> int:
+        return len(self.shard_dirs)
+
+    def __iter__(self) -> Iterator[NerShard]:
+        for shard_dir in self.shard_dirs:
+            yield load_shard(shard_dir)
+
+    def recipes(self) -> Iterator[Dict[str, object]]:
+        """
+            Yields the recipes one at a time: {'id', 'tokens', 'pos', 'entities'}, 'pos' and 'entities' only if their stage was run.
+        """
+        for shard in self:
+            for row in range(len(shard)):
+                recipe = {'id': shard.recipe_ids[row].item(), 'tokens': shard.tokens(row)}
+                if shard.pos_ids is not None:
+                    recipe['pos'] = shard.pos(row)
+                if shard.entities is not None:
+                    recipe['entities'] = shard.recipe_entities(row)
+                yield recipe
+
+
+def load_shard(shard_dir: str) -> NerShard:
+    """
+        Memory-maps the output of the done stages of a shard.
+    """
+    if not _stage_done(shard_dir, 'tokens'):
+        raise FileNotFoundError(f'The tokens of {shard_dir} are missing, run run_ner_pipeline first')
+
+    def load(name: str) -> np.ndarray:
+        return np.load(os.path.join(shard_dir, name), mmap_mode='r')
+
+    shard = NerShard(shard_dir, load('recipe_ids.npy'), _read_json(shard_dir, 'tokens_vocab.json'), load('tokens_offsets.npy'), load('tokens_ids.npy'))
+    if _stage_done(shard_dir, 'pos'):
+        shard.tags, shard.pos_ids = _read_json(shard_dir, 'pos_tags.json'), load('pos_ids.npy')
+    if _stage_done(shard_dir, 'ner'):
+        shard.labels, shard.entities = _read_json(shard_dir, 'ner_labels.json'), load('entities.npy')
+    return shard
+
+
+def run_ner_pipeline(
+    csv_path: str,
+    output_dir: str,
+    stages: Iterable[str] = STAGES,
+    shard_size: int = 20_000,
+    column: str = 'directions',
+    processes: int | None = None,
+    force: Iterable[str] = (),
+    shards: Iterable[int] | None = None,
+) -> str:
+    """
+        Runs the stages over the shards of the corpus in parallel. The stages already done are skipped.
+
+        Inputs:
+            - csv_path: The corpus, e.g. full_dataset.csv.
+            - output_dir: The directory of the shards.
+            - stages: The stages to run, among 'tokens', 'pos' and 'ner'. The earlier stages they need are run too if they are not done.
+            - shard_size: The number of recipes per shard. It must stay the same for a given output_dir.
+            - column: The column with the directions, as the string representation of a list of steps.
+            - processes: The number of workers. Default is os.cpu_count().
+            - force: The stages to run again even where they are done (e.g. after changing a tagger).
+            - shards: Only run the shards with these numbers. Default is None, i.e. all of them.
+
+        Output:
+            - output_dir, to be read with NerShards.
+    """
+    stages = set(stages)
+    force = set(force)
+    shards = set(shards) if shards is not None else None
+    os.makedirs(output_dir, exist_ok=True)
+    meta_path = os.path.join(output_dir, 'pipeline.json')
+    if os.path.exists(meta_path) and _read_json(output_dir, 'pipeline.json')['shard_size'] != shard_size:
+        raise ValueError(f'{output_dir} was written with another shard_size, use another directory')
+    with open(meta_path, 'w') as f:
+        json.dump({'csv_path': os.path.abspath(csv_path), 'column': column, 'shard_size': shard_size}, f)
+    # Every stage needs the ones before it
+    last = max(STAGES.index(stage) for stage in stages)
+    for stage in STAGES[:last + 1]:
+        for resource in STAGE_RESOURCES[stage]:
+            nltk_download(resource, quiet=True)
+
+    def tasks():
+        for i, chunk in enumerate(pd.read_csv(csv_path, usecols=[column], chunksize=shard_size)):
+            if shards is not None and i not in shards:
+                continue
+            shard_dir = os.path.join(output_dir, f'shard_{i:05d}')
+            todo = _stages_to_run(shard_dir, last, force)
+            if not todo:
+                continue
+            # The directions are only sent to the workers that tokenize
+            directions = chunk[column].tolist() if 'tokens' in todo else None
+            yield shard_dir, chunk.index.to_numpy(), directions, todo
+
+    start = time.perf_counter()
+    done = 0
+    with Pool(processes) as pool:
+        for shard_dir, todo, elapsed in pool.imap_unordered(_process_shard, tasks()):
+            done += 1
+            print(f"{os.path.basename(shard_dir)}: {', '.join(todo)} done in {elapsed:.1f}s ({done} shards, {time.perf_counter() - start:.0f}s)")
+    return output_dir
+
+
+def _stages_to_run(shard_dir: str, last: int, force: set) -> List[str]:
+    # Once a stage runs, all the later ones have to run again
+    for i, stage in enumerate(STAGES[:last + 1]):
+        if stage in force or not _stage_done(shard_dir, stage):
+            return STAGES[i:last + 1]
+    return []
+
+
+def _process_shard(task: Tuple[str, np.ndarray, List[str] | None, List[str]]) -> Tuple[str, List[str], float]:
+    shard_dir, recipe_ids, directions, todo = task
+    start = time.perf_counter()
+    os.makedirs(shard_dir, exist_ok=True)
+    # The later stages are not valid anymore, even if this run is interrupted or does not run them again
+    for stage in STAGES[STAGES.index(todo[0]):]:
+        if os.path.exists(os.path.join(shard_dir, stage + '.json')):
+            os.remove(os.path.join(shard_dir, stage + '.json'))
+    tokens = None
+    pos = None
+    if 'tokens' in todo:
+        tokens = [word_tokenize(' '.join(ast.literal_eval(recipe))) for recipe in directions]
+        vocab = {}
+        np.save(os.path.join(shard_dir, 'recipe_ids.npy'), recipe_ids.astype(np.int64))
+        np.save(os.path.join(shard_dir, 'tokens_offsets.npy'), _offsets(tokens))
+        np.save(os.path.join(shard_dir, 'tokens_ids.npy'), _encode(tokens, vocab, np.int32))
+        _write_json(shard_dir, 'tokens_vocab.json', list(vocab))
+        _mark_done(shard_dir, 'tokens')
+    if 'pos' in todo:
+        if tokens is None:
+            shard = load_shard(shard_dir)
+            tokens = [shard.tokens(row) for row in range(len(shard))]
+        pos = [pos_tag(recipe) for recipe in tokens]
+        tags = {}
+        np.save(os.path.join(shard_dir, 'pos_ids.npy'), _encode([[tag for _, tag in recipe] for recipe in pos], tags, np.uint8))
+        _write_json(shard_dir, 'pos_tags.json', list(tags))
+        _mark_done(shard_dir, 'pos')
+    if 'ner' in todo:
+        if pos is None:
+            shard = load_shard(shard_dir)
+            pos = [shard.pos(row) for row in range(len(shard))]
+        labels = {}
+        entities = []
+        for row, recipe in enumerate(pos):
+            entities.extend((row, start, end, labels.setdefault(label, len(labels))) for start, end, label in _entity_spans(ne_chunk(recipe)))
+        np.save(os.path.join(shard_dir, 'entities.npy'), np.array(entities, dtype=ENTITY_DTYPE))
+        _write_json(shard_dir, 'ner_labels.json', list(labels))
+        _mark_done(shard_dir, 'ner')
+    return shard_dir, todo, time.perf_counter() - start
+
+
+def _entity_spans(tree: Tree) -> List[Tuple[int, int, str]]:
+    # The (start token, end token, label) of the named entities, the subtrees of the chunked sentence
+    spans = []
+    position = 0
+    for node in tree:
+        if isinstance(node, Tree):
+            length = len(node.leaves())
+            spans.append((position, position + length, node.label()))
+            position += length
+        else:
+            position += 1
+    return spans
+
+
+def _offsets(rows: List[List]) -> np.ndarray:
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=offsets[1:])
+    return offsets
+
+
+def _encode(rows: List[List[str]], ids: Dict[str, int], dtype: type) -> np.ndarray:
+    return np.fromiter((ids.setdefault(value, len(ids)) for row in rows for value in row), dtype=dtype, count=sum(len(row) for row in rows))
+
+
+def _stage_done(shard_dir: str, stage: str) -> bool:
+    path = os.path.join(shard_dir, stage + '.json')
+    return os.path.exists(path) and _read_json(shard_dir, stage + '.json')['version'] == STAGE_VERSIONS[stage]
+
+
+def _mark_done(shard_dir: str, stage: str) -> None:
+    _write_json(shard_dir, stage + '.json', {'version': STAGE_VERSIONS[stage]})
+
+
+def _read_json(directory: str, name: str):
+    with open(os.path.join(directory, name)) as f:
+        return json.load(f)
+
+
+def _write_json(directory: str, name: str, data) -> None:
+    path = os.path.join(directory, name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tokenize, POS tag and NER chunk the directions of a recipe corpus, in shards.')
+    parser.add_argument('csv_path', help='The corpus, e.g. ../dataset/full_dataset.csv')
+    parser.add_argument('output_dir', help='The directory of the shards, e.g. ../dataset/ner')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--shard-size', type=int, default=20_000)
+    parser.add_argument('--column', default='directions')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--force', nargs='*', default=[], choices=STAGES, help='Run these stages again where they are done')
+    parser.add_argument('--shards', nargs='*', type=int, default=None, help='Only run these shards')
+    args = parser.parse_args()
+    run_ner_pipeline(args.csv_path, args.output_dir, args.stages, args.shard_size, args.column, args.processes, args.force, args.shards)
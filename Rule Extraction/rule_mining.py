@@ -0,0 +1,373 @@
+# Out-of-core association rule mining over the full RecipeNLG corpus.
+# The notebooks (data_explore.ipynb, arm_ingredients.ipynb) one-hot encode the whole corpus in memory before fpgrowth,
+# which crashes the kernel on the full dataset. Here the corpus is streamed in chunks and mined with the partitioned
+# two-pass algorithm of Savasere, Omiecinski and Navathe (SON):
+#   1. Every partition is mined on its own with fpgrowth, with the same relative min_support. An itemset frequent in the
+#      whole corpus is frequent in at least one partition, so the union of the local results contains all of them.
+#   2. The exact support of every candidate is counted over all the partitions, and the infrequent ones are dropped.
+# Both passes run in parallel over the partitions, and only one partition per worker is in memory at a time.
+#
+# Usage:
+#   python rule_mining.py ../dataset/full_dataset.csv ../dataset/rules_recipe_scale.csv --min-support 0.01 --max-len 5 --min-threshold 2
+
+import argparse
+import ast
+import json
+import os
+import sys
+import time
+import tempfile
+from multiprocessing import Pool
+from typing import List, Tuple, Dict, FrozenSet, Callable
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from gensim.parsing.preprocessing import preprocess_string
+from mlxtend.frequent_patterns import fpgrowth
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rule_store import convert_rule_data
+from preprocessed_corpus import PreprocessedCorpus, preprocess_corpus, load_preprocessed
+
+# Columns of the rules csv, in the order mlxtend's association_rules writes them (and load_rule_data reads them)
+RULE_COLUMNS = [
+    'antecedents', 'consequents', 'antecedent support', 'consequent support',
+    'support', 'confidence', 'lift', 'leverage', 'conviction', 'zhangs_metric',
+]
+
+
+def tokenize_directions(directions: str) -> List[str]:
+    """
+        Tokenizes the directions of a recipe of full_dataset.csv (a string representation of the list of steps)
+        the same way the backend does: the steps are joined in a single string and preprocessed with gensim preprocess_string.
+    """
+    steps = ast.literal_eval(directions)
+    return preprocess_string(' '.join(steps))
+
+
+def write_transactions(
+    csv_path: str,
+    work_dir: str,
+    column: str = 'directions',
+    chunksize: int = 50_000,
+    processes: int | None = None,
+    tokenizer: Callable[[str], List[str]] = tokenize_directions,
+) -> Tuple[List[str], List[str]]:
+    """
+        Streams the csv in chunks, tokenizes the recipes in parallel, and writes every chunk as a partition of token-id transactions
+        (the CSR arrays of a recipe x token matrix, partition_<i>_offsets.npy and partition_<i>_ids.npy).
+
+        Inputs:
+            - csv_path: The corpus, e.g. full_dataset.csv.
+            - work_dir: The directory to write the partitions to.
+            - column: The column to tokenize. Default is 'directions'.
+            - chunksize: The number of recipes per partition.
+            - processes: The number of tokenizing workers. Default is os.cpu_count().
+            - tokenizer: The function turning a cell of the column into a list of tokens.
+
+        Output:
+            - The paths of the partitions (without the _offsets.npy/_ids.npy suffixes), and the vocabulary (token id -> token).
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    tokens = []
+    token_ids = {}
+    partitions = []
+    processes = processes or os.cpu_count()
+    with Pool(processes) as pool:
+        for i, chunk in enumerate(pd.read_csv(csv_path, usecols=[column], chunksize=chunksize)):
+            start = time.perf_counter()
+            recipes = pool.map(tokenizer, chunk[column].tolist(), chunksize=max(1, len(chunk) // (4 * processes)))
+            rows = []
+            for recipe in recipes:
+                rows.append(sorted({token_ids.setdefault(token, len(token_ids)) for token in recipe}))
+            tokens.extend(list(token_ids)[len(tokens):])
+            partition = os.path.join(work_dir, f'partition_{i}')
+            save_partition(partition, rows)
+            partitions.append(partition)
+            print(f"Partition {i}: {len(rows)} recipes, {len(tokens)} tokens so far ({time.perf_counter() - start:.1f}s)")
+    with open(os.path.join(work_dir, 'vocab.json'), 'w') as f:
+        json.dump(tokens, f)
+    return partitions, tokens
+
+
+def corpus_transactions(corpus: PreprocessedCorpus, work_dir: str, chunksize: int = 50_000) -> Tuple[List[str], List[str]]:
+    """
+        The same as write_transactions, from a corpus already preprocessed (see preprocessed_corpus.py): nothing is tokenized again,
+        the partitions are slices of the corpus and the vocabulary is the corpus one.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    partitions = []
+    for i, start in enumerate(range(0, len(corpus), chunksize)):
+        matrix = corpus.binary_matrix(start, min(start + chunksize, len(corpus)))
+        partition = os.path.join(work_dir, f'partition_{i}')
+        np.save(partition + '_offsets.npy', matrix.indptr.astype(np.int64))
+        np.save(partition + '_ids.npy', matrix.indices.astype(np.int32))
+        partitions.append(partition)
+    with open(os.path.join(work_dir, 'vocab.json'), 'w') as f:
+        json.dump(corpus.tokens, f)
+    return partitions, list(corpus.tokens)
+
+
+def save_partition(partition: str, rows: List[List[int]]) -> None:
+    """
+        Writes the token ids of the recipes (one sorted list per recipe) as the CSR arrays of a partition.
+    """
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=offsets[1:])
+    np.save(partition + '_offsets.npy', offsets)
+    np.save(partition + '_ids.npy', np.fromiter((t for row in rows for t in row), dtype=np.int32, count=offsets[-1]))
+
+
+def load_partition(partition: str, vocab_size: int) -> sp.csr_matrix:
+    """
+        Loads a partition written by write_transactions as a binary recipe x token matrix.
+    """
+    offsets = np.load(partition + '_offsets.npy')
+    ids = np.load(partition + '_ids.npy')
+    return sp.csr_matrix((np.ones(len(ids), dtype=np.int32), ids, offsets), shape=(len(offsets) - 1, vocab_size))
+
+
+def mine_frequent_itemsets(
+    partitions: List[str],
+    vocab_size: int,
+    min_support: float = 0.01,
+    max_len: int | None = 5,
+    processes: int | None = None,
+) -> Tuple[Dict[FrozenSet[int], int], int]:
+    """
+        Finds the itemsets of token ids whose support in the whole corpus is at least min_support (SON algorithm, see the top of the file).
+
+        Inputs:
+            - partitions: The partitions written by write_transactions.
+            - vocab_size: The size of the vocabulary.
+            - min_support: The minimum support, as a fraction of the recipes.
+            - max_len: The maximum size of the itemsets. Default is 5, as in data_explore.ipynb.
+            - processes: The number of workers. Default is os.cpu_count().
+
+        Output:
+            - The frequent itemsets with the number of recipes containing them, and the number of recipes in the corpus.
+    """
+    with Pool(processes) as pool:
+        # Pass 1: the union of the locally frequent itemsets
+        start = time.perf_counter()
+        candidates = set()
+        tasks = [(partition, vocab_size, min_support, max_len) for partition in partitions]
+        for local in pool.imap_unordered(_mine_partition, tasks):
+            candidates.update(local)
+        candidates = sorted(candidates, key=lambda itemset: (len(itemset), sorted(itemset)))
+        print(f"Pass 1: {len(candidates)} candidate itemsets ({time.perf_counter() - start:.1f}s)")
+
+    # Pass 2: the exact support of every candidate
+    start = time.perf_counter()
+    counts, n_recipes = count_itemsets(partitions, vocab_size, candidates, processes)
+    print(f"Pass 2: counted {n_recipes} recipes ({time.perf_counter() - start:.1f}s)")
+
+    # Same test as fpgrowth, on the support rather than on the count
+    frequent = {itemset: int(count) for itemset, count in zip(candidates, counts) if count / n_recipes >= min_support}
+    print(f"{len(frequent)} frequent itemsets")
+    return frequent, n_recipes
+
+
+def count_itemsets(
+    partitions: List[str],
+    vocab_size: int,
+    itemsets: List[FrozenSet[int]],
+    processes: int | None = None,
+) -> Tuple[np.ndarray, int]:
+    """
+        Counts the recipes containing each itemset, over all the partitions in parallel.
+        The itemsets are sent once to every worker, not with every partition.
+
+        Output:
+            - The count of each itemset, and the number of recipes in the partitions.
+    """
+    counts = np.zeros(len(itemsets), dtype=np.int64)
+    n_recipes = 0
+    with Pool(processes, initializer=_init_counter, initargs=(itemsets, vocab_size)) as pool:
+        for partition_counts, partition_recipes in pool.imap_unordered(_count_partition, partitions):
+            counts += partition_counts
+            n_recipes += partition_recipes
+    return counts, n_recipes
+
+
+def _mine_partition(task: Tuple[str, int, float, int | None]) -> List[FrozenSet[int]]:
+    partition, vocab_size, min_support, max_len = task
+    matrix = load_partition(partition, vocab_size)
+    # Only the tokens frequent in this partition can be in a locally frequent itemset
+    frequent_tokens = np.flatnonzero(np.asarray(matrix.sum(axis=0)).ravel() >= min_support * matrix.shape[0])
+    if len(frequent_tokens) == 0:
+        return []
+    # String column names: fpgrowth rejects sparse frames whose integer column names do not start at 0
+    encoded = pd.DataFrame.sparse.from_spmatrix(matrix[:, frequent_tokens].astype(bool), columns=[str(token) for token in frequent_tokens])
+    itemsets = fpgrowth(encoded, min_support=min_support, use_colnames=True, max_len=max_len)
+    return [frozenset(int(token) for token in itemset) for itemset in itemsets['itemsets']]
+
+
+def itemset_matrix(itemsets: List[FrozenSet[int]], vocab_size: int) -> Tuple[sp.csc_matrix, np.ndarray]:
+    """
+        Returns the token x itemset binary matrix of the itemsets and their lengths: recipes @ matrix counts the tokens
+        of every itemset found in every recipe.
+    """
+    indptr = np.zeros(len(itemsets) + 1, dtype=np.int64)
+    np.cumsum([len(itemset) for itemset in itemsets], out=indptr[1:])
+    indices = np.fromiter((token for itemset in itemsets for token in sorted(itemset)), dtype=np.int32, count=indptr[-1])
+    matrix = sp.csc_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr), shape=(vocab_size, len(itemsets)))
+    return matrix, np.diff(indptr)
+
+
+def count_in_matrix(recipes: sp.csr_matrix, itemsets: sp.csc_matrix, lengths: np.ndarray, batch_size: int = 20_000) -> np.ndarray:
+    """
+        Counts the recipes (rows of a recipe x token matrix) containing each itemset (see itemset_matrix).
+    """
+    counts = np.zeros(itemsets.shape[1], dtype=np.int64)
+    for start in range(0, recipes.shape[0], batch_size):
+        found = (recipes[start:start + batch_size] @ itemsets).tocsr()
+        # The recipe contains the itemset iff all of its tokens were found
+        counts += np.bincount(found.indices[found.data == lengths[found.indices]], minlength=itemsets.shape[1])
+    return counts
+
+
+# State of the counting workers, set once per worker by _init_counter
+_counter = {}
+
+def _init_counter(itemsets: List[FrozenSet[int]], vocab_size: int) -> None:
+    _counter['itemsets'], _counter['lengths'] = itemset_matrix(itemsets, vocab_size)
+
+
+def _count_partition(partition: str) -> Tuple[np.ndarray, int]:
+    itemsets, lengths = _counter['itemsets'], _counter['lengths']
+    matrix = load_partition(partition, itemsets.shape[0])
+    return count_in_matrix(matrix, itemsets, lengths), matrix.shape[0]
+
+
+def generate_rules(
+    itemsets: Dict[FrozenSet[int], int],
+    n_recipes: int,
+    tokens: List[str],
+    metric: str = 'lift',
+    min_threshold: float = 1.0,
+) -> pd.DataFrame:
+    """
+        Generates the association rules of the frequent itemsets, with the same columns and formulas as mlxtend's association_rules
+        (see RULE_COLUMNS), so that the result can be written to a csv read by load_rule_data.
+
+        Inputs:
+            - itemsets: The frequent itemsets with their counts, as returned by mine_frequent_itemsets.
+            - n_recipes: The number of recipes in the corpus.
+            - tokens: The vocabulary, token id -> token.
+            - metric: The metric to filter the rules by. Default is 'lift'.
+            - min_threshold: The minimum value of the metric.
+
+        Output:
+            - The rules, type: pd.DataFrame
+    """
+    support = {itemset: count / n_recipes for itemset, count in itemsets.items()}
+    antecedents, consequents, rule_supports = [], [], []
+    for itemset, itemset_support in support.items():
+        if len(itemset) < 2:
+            continue
+        items = sorted(itemset)
+        # Every non-empty proper subset is the antecedents of a rule
+        for mask in range(1, 2 ** len(items) - 1):
+            antecedent = frozenset(item for i, item in enumerate(items) if mask >> i & 1)
+            antecedents.append(antecedent)
+            consequents.append(itemset - antecedent)
+            rule_supports.append(itemset_support)
+    # All the subsets of a frequent itemset are frequent, so their supports are known
+    rules = pd.DataFrame({
+        'antecedent support': [support[antecedent] for antecedent in antecedents],
+        'consequent support': [support[consequent] for consequent in consequents],
+        'support': rule_supports,
+    })
+    rules = add_rule_metrics(rules)
+    rules.insert(0, 'antecedents', [frozenset(tokens[t] for t in antecedent) for antecedent in antecedents])
+    rules.insert(1, 'consequents', [frozenset(tokens[t] for t in consequent) for consequent in consequents])
+    return rules[rules[metric] >= min_threshold].reset_index(drop=True)[RULE_COLUMNS]
+
+
+def add_rule_metrics(rules: pd.DataFrame) -> pd.DataFrame:
+    """
+        Computes confidence, lift, leverage, conviction and zhangs_metric from the 'antecedent support', 'consequent support'
+        and 'support' columns, with mlxtend's formulas.
+    """
+    antecedent_support = rules['antecedent support'].to_numpy()
+    consequent_support = rules['consequent support'].to_numpy()
+    support = rules['support'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        confidence = support / antecedent_support
+        rules['confidence'] = confidence
+        rules['lift'] = confidence / consequent_support
+        rules['leverage'] = support - antecedent_support * consequent_support
+        rules['conviction'] = np.where(confidence == 1, np.inf, (1 - consequent_support) / (1 - confidence))
+        # 0 when the denominator is 0 (e.g. an antecedent in every recipe), as mlxtend does
+        denominator = np.maximum(support * (1 - antecedent_support), antecedent_support * (consequent_support - support))
+        rules['zhangs_metric'] = np.where(denominator == 0, 0, rules['leverage'].to_numpy() / denominator)
+    return rules
+
+
+def mine_rules(
+    csv_path: str = '../dataset/full_dataset.csv',
+    output_path: str = '../dataset/rules_recipe_scale.csv',
+    min_support: float = 0.01,
+    max_len: int | None = 5,
+    metric: str = 'lift',
+    min_threshold: float = 2.0,
+    chunksize: int = 50_000,
+    processes: int | None = None,
+    work_dir: str | None = None,
+    column: str = 'directions',
+    store: bool = True,
+    preprocessed: bool = True,
+) -> pd.DataFrame:
+    """
+        The whole mining pipeline: tokenize the corpus into partitions, mine the frequent itemsets, generate the rules and write them
+        to output_path (the csv format load_rule_data reads) and, if store is True, to the rule store next to it (see rule_store.py).
+
+        Inputs:
+            - csv_path: The corpus. Default is '../dataset/full_dataset.csv'.
+            - output_path: The rules csv. Default is '../dataset/rules_recipe_scale.csv'.
+            - min_support, max_len: See mine_frequent_itemsets.
+            - metric, min_threshold: See generate_rules. The defaults are the ones used in data_explore.ipynb.
+            - chunksize, processes, column: See write_transactions.
+            - work_dir: The directory for the partitions. Default is a temporary directory, deleted at the end.
+            - store: Whether to also write the rule store.
+            - preprocessed: Whether to read the tokens from the preprocessed corpus of the csv (see preprocessed_corpus.py),
+                            preprocessing it first if needed. Otherwise the corpus is tokenized again by write_transactions.
+
+        Output:
+            - The rules, type: pd.DataFrame
+    """
+    with tempfile.TemporaryDirectory(prefix='rule_mining_') as tmp_dir:
+        work_dir = work_dir or tmp_dir
+        if preprocessed:
+            corpus = load_preprocessed(preprocess_corpus(csv_path, column, chunksize=chunksize, processes=processes))
+            partitions, tokens = corpus_transactions(corpus, work_dir, chunksize)
+        else:
+            partitions, tokens = write_transactions(csv_path, work_dir, column, chunksize, processes)
+        itemsets, n_recipes = mine_frequent_itemsets(partitions, len(tokens), min_support, max_len, processes)
+    rules = generate_rules(itemsets, n_recipes, tokens, metric, min_threshold)
+    rules.to_csv(output_path, index=False)
+    print(f"{len(rules)} rules written to {output_path}")
+    if store:
+        print(f"Rule store written to {convert_rule_data(output_path)}")
+    return rules
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mine association rules from the directions of a recipe corpus.')
+    parser.add_argument('csv_path', help='The corpus, e.g. ../dataset/full_dataset.csv')
+    parser.add_argument('output_path', help='The rules csv to write, e.g. ../dataset/rules_recipe_scale.csv')
+    parser.add_argument('--min-support', type=float, default=0.01)
+    parser.add_argument('--max-len', type=int, default=5)
+    parser.add_argument('--metric', default='lift')
+    parser.add_argument('--min-threshold', type=float, default=2.0)
+    parser.add_argument('--chunksize', type=int, default=50_000)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--work-dir', default=None, help='Keep the tokenized partitions in this directory')
+    parser.add_argument('--column', default='directions')
+    parser.add_argument('--no-store', action='store_true', help='Do not write the rule store next to the csv')
+    parser.add_argument('--no-preprocessed', action='store_true', help='Tokenize the corpus again instead of using its preprocessed corpus')
+    args = parser.parse_args()
+    mine_rules(
+        args.csv_path, args.output_path, args.min_support, args.max_len, args.metric, args.min_threshold,
+        args.chunksize, args.processes, args.work_dir, args.column, not args.no_store, not args.no_preprocessed,
+    )
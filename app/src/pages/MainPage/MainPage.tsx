@@ -70,6 +70,18 @@ export const MainPage: React.FC<MainPageProps> = ({api, setActivePage, currentMo
     useEffect(() => {
         // Define the function that the parent will call
         const handleData = (data: BackendResponse) => {
+            if (data.error !== undefined) {
+                api.error({
+                    message: 'Error',
+                    description: data.error,
+                    placement: 'top',
+                });
+                setimprovedRecipeLoading(false);
+                setOriginalRecipe('');
+                setImprovedRecipe(undefined);
+                setStep(0);
+                return;
+            }
             setImprovementLevel(improvementLevel);
             setImprovedRecipe({
                 recipeText: data.example_recipe,
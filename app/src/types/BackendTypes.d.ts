@@ -6,10 +6,12 @@ export type BackendInput = {
 
 
 // Annotations is a python dictionary of the form: {'non_stemmed_word': [('stemmed_word', word_index), ('stemmed_word', word_index)], 'non_stemmed_word': [('stemmed_word', word_index), ('stemmed_word', word_index)]}
+// When the example could not be generated, the server only sends the error: {'error': 'message for the learner'}
 export type BackendResponse = {
     annotations: { [key: string]: Array<[string, number]> },
     ing_seperated: string,
     example_recipe: string,
+    error?: string,
 }
 
 export type BackendUserResultDetails = {
@@ -0,0 +1,209 @@
+# Scores many generated recipes at once, instead of calling get_fullfilled_percentage and calculate_similarity row by row.
+# The answers are tokenized in parallel (with the memoized tokenizer in each worker), every token is given an id, and the
+# original recipes, the generated recipes and the consequents of the suggestions become sparse binary matrices: the
+# fulfilled suggestions and the overlaps of the recipes are then row-wise products of these matrices.
+#
+# Usage:
+#   scores = evaluate_pipeline_results(results)                                # results of pipeline_chunk / complete_pipeline
+#   scores = evaluate_comparison_results(load_results('run.jsonl'), relex_examples, extracted_rules)   # prompt_comparison_mp
+
+import os
+from multiprocessing import Pool
+from typing import List, Dict, Tuple, FrozenSet, Any
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import helpers_for_backend as hfb
+from recipe_annotations import consequent_tokens
+from recipe_tokenizer import default_tokenizer
+from rule_index import extract_rules_batch
+
+# The columns of the scores, see evaluate_generations
+SCORE_COLUMNS = [
+    'n_suggestions',
+    'n_fulfilled',
+    'n_not_fulfilled',
+    'fulfilled_percentage',
+    'original_tokens',
+    'new_tokens',
+    'shared_tokens',
+    'original_in_new',
+    'new_in_original',
+]
+
+
+def _tokenize_texts(texts: List[str]) -> List[List[str]]:
+    tokenizer = default_tokenizer()
+    return [tokenizer(text) for text in texts]
+
+
+def tokenize_texts(texts: List[str], processes: int | None = None, chunk_size: int = 500) -> List[List[str]]:
+    """
+        Tokenizes the texts like preprocess_string, in parallel if there are more than chunk_size of them.
+
+        Inputs:
+            - texts: The texts.
+            - processes: The number of workers. Default is os.cpu_count().
+            - chunk_size: The number of texts sent to a worker at a time.
+    """
+    if len(texts) <= chunk_size or processes == 1:
+        return _tokenize_texts(texts)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    with Pool(processes or os.cpu_count()) as pool:
+        return [tokens for chunk in pool.map(_tokenize_texts, chunks) for tokens in chunk]
+
+
+def _binary_matrix(rows: List[List[int]], n_columns: int) -> sp.csr_matrix:
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=offsets[1:])
+    ids = np.fromiter((i for row in rows for i in row), dtype=np.int64, count=offsets[-1])
+    matrix = sp.csr_matrix((np.ones(len(ids), dtype=np.int32), ids, offsets), shape=(len(rows), n_columns))
+    # A token appearing twice counts once
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+
+def evaluate_generations(
+    original_tokens: List[List[str]],
+    answers: List[str | None],
+    suggestions: List[Dict[FrozenSet[str], Tuple[str, float]] | None],
+    processes: int | None = None,
+) -> pd.DataFrame:
+    """
+        Scores generated recipes: the suggestions they fulfill (as get_fullfilled_percentage) and their overlap with the
+        original recipes (as calculate_similarity).
+
+        Inputs:
+            - original_tokens: The tokens of each original recipe (its 'preprocessed' column).
+            - answers: The answer of GPT for each recipe, the recipe is read between the <RECIPE> tags (see hfb.recipe_text).
+                       None for the rows that failed, their scores are NaN.
+            - suggestions: The suggestions of each prompt, as returned by extract_rules. None if there were none.
+            - processes: The number of workers tokenizing the answers. Default is os.cpu_count().
+
+        Output:
+            - One row per recipe, in the same order, with the columns:
+                - n_suggestions, n_fulfilled, n_not_fulfilled: The number of suggestions, of fulfilled and of not fulfilled suggestions.
+                - fulfilled_percentage: n_fulfilled / n_suggestions, 0 if there were no suggestions.
+                - original_tokens, new_tokens, shared_tokens: The number of distinct tokens of the original recipe, of the new recipe and of both.
+                - original_in_new: The share of the tokens of the original recipe that are in the new recipe.
+                - new_in_original: The share of the tokens of the new recipe that are in the original recipe.
+              type: pd.DataFrame
+    """
+    if not len(original_tokens) == len(answers) == len(suggestions):
+        raise ValueError(f'Got {len(original_tokens)} recipes, {len(answers)} answers and {len(suggestions)} suggestions')
+    answered = np.array([answer is not None for answer in answers], dtype=bool)
+    new_tokens = tokenize_texts([hfb.recipe_text(answer) if answer is not None else '' for answer in answers], processes)
+
+    token_ids: Dict[str, int] = {}
+    encode = lambda tokens: [token_ids.setdefault(token, len(token_ids)) for token in tokens]
+    original_rows = [encode(tokens) for tokens in original_tokens]
+    new_rows = [encode(tokens) for tokens in new_tokens]
+    consequent_rows, suggestion_recipes = [], []
+    for recipe, recipe_suggestions in enumerate(suggestions):
+        for consequents, _ in (recipe_suggestions or {}).values():
+            consequent_rows.append(encode(consequent_tokens(consequents)))
+            suggestion_recipes.append(recipe)
+    suggestion_recipes = np.array(suggestion_recipes, dtype=np.int64)
+
+    originals = _binary_matrix(original_rows, len(token_ids))
+    news = _binary_matrix(new_rows, len(token_ids))
+    consequents = _binary_matrix(consequent_rows, len(token_ids))
+
+    # A suggestion is fulfilled if all the tokens of its consequents are in the new recipe
+    present = np.asarray(consequents.multiply(news[suggestion_recipes]).sum(axis=1)).ravel()
+    fulfilled = present == consequents.getnnz(axis=1)
+    n_suggestions = np.bincount(suggestion_recipes, minlength=len(answers))
+    n_fulfilled = np.bincount(suggestion_recipes, weights=fulfilled, minlength=len(answers)).astype(np.int64)
+
+    original_counts = originals.getnnz(axis=1)
+    new_counts = news.getnnz(axis=1)
+    shared = np.asarray(originals.multiply(news).sum(axis=1)).ravel()
+    # The scores of the rows without an answer are unknown, not zero
+    unknown = lambda values: np.where(answered, values, np.nan)
+    return pd.DataFrame({
+        'n_suggestions': n_suggestions,
+        'n_fulfilled': unknown(n_fulfilled),
+        'n_not_fulfilled': unknown(n_suggestions - n_fulfilled),
+        'fulfilled_percentage': unknown(np.where(n_suggestions > 0, n_fulfilled / np.maximum(n_suggestions, 1), 0.0)),
+        'original_tokens': original_counts,
+        'new_tokens': unknown(new_counts),
+        'shared_tokens': unknown(shared),
+        'original_in_new': unknown(np.where(original_counts > 0, shared / np.maximum(original_counts, 1), np.nan)),
+        'new_in_original': unknown(np.where(new_counts > 0, shared / np.maximum(new_counts, 1), np.nan)),
+    })
+
+
+def evaluate_pipeline_results(results: List[Dict[str, Any]], processes: int | None = None) -> pd.DataFrame:
+    """
+        Scores the results of pipeline_chunk (or complete_pipeline) of Example Gens/helper.py.
+        The original recipes are tokenized from their 'original_recipe' text (the directions, which gives the same tokens
+        as the 'preprocessed' column: the brackets and quotes of a list of steps are removed with the punctuation).
+
+        Inputs:
+            - results: The dictionaries returned by pipeline_chunk, with the keys index, original_recipe, new_recipe and rules.
+            - processes: See evaluate_generations.
+
+        Output:
+            - The index of each recipe, followed by the columns of evaluate_generations, type: pd.DataFrame
+    """
+    originals = tokenize_texts([str(result['original_recipe']) for result in results], processes)
+    scores = evaluate_generations(
+        originals,
+        [result['new_recipe'] for result in results],
+        [result['rules'] for result in results],
+        processes,
+    )
+    scores.insert(0, 'index', [result['index'] for result in results])
+    return scores
+
+
+def evaluate_comparison_results(
+    results: Dict[str, Dict[int, List[Tuple[int, str | None, Any]]]] | List[Dict[str, Dict[int, List[Tuple[int, str | None, Any]]]]],
+    recipes: pd.DataFrame,
+    rules: pd.DataFrame | Any,
+    metric: str = 'lift',
+    processes: int | None = None,
+) -> pd.DataFrame:
+    """
+        Scores the results of a prompt comparison run (prompt_comparison_mp.parallel_process or load_results).
+        The suggestions are not in the results: they are extracted again, once for all the rows and the largest rule count
+        (the smaller rule counts are prefixes of it, see hfb.top_rules).
+
+        Inputs:
+            - results: {prompt function name: {rule count: [(row, new recipe, fulfilled percentage)]}}, or the list of these
+                       dictionaries returned by parallel_process.
+            - recipes: The recipes of the run (e.g. relex_examples), with a 'preprocessed' column. The rows are positions in it.
+            - rules: The rules of the run, a DataFrame sorted by the metric or a RuleIndex.
+            - metric: The metric the rules are sorted by. Default is 'lift'.
+            - processes: See evaluate_generations.
+
+        Output:
+            - One row per (prompt function, rule count, row) with the columns prompt_function, rule_count, row, followed by
+              the columns of evaluate_generations, type: pd.DataFrame
+    """
+    if isinstance(results, list):
+        merged = {}
+        for task_results in results:
+            merged.update(task_results)
+        results = merged
+    keys, answers = [], []
+    for name, by_rule_count in results.items():
+        for rule_count, rows in by_rule_count.items():
+            for row, new_recipe, _ in rows:
+                keys.append((name, int(rule_count), int(row)))
+                answers.append(new_recipe)
+    if not keys:
+        return pd.DataFrame(columns=['prompt_function', 'rule_count', 'row'] + SCORE_COLUMNS)
+    preprocessed = recipes['preprocessed'].tolist()
+    largest = max(rule_count for _, rule_count, _ in keys)
+    needed = sorted({row for _, _, row in keys})
+    extractions = dict(zip(needed, extract_rules_batch([preprocessed[row] for row in needed], rules, largest, metric)))
+    scores = evaluate_generations(
+        [preprocessed[row] for _, _, row in keys],
+        answers,
+        [hfb.top_rules(extractions[row][1], rule_count)[1] for _, rule_count, row in keys],
+        processes,
+    )
+    keys = pd.DataFrame(keys, columns=['prompt_function', 'rule_count', 'row'])
+    return pd.concat([keys, scores], axis=1)
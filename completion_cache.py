@@ -0,0 +1,319 @@
+# Persistent cache for chat completions.
+# All the prompt functions use temperature=0, so the same request always gets (nearly) the same answer:
+# reruns of the experiments and users resubmitting the same recipe are answered from the cache instead of the API.
+# The default cache is one file per user, whatever the directory the process runs from (the server, the notebooks, ...):
+# $XDG_CACHE_HOME/gelex/completion_cache.sqlite, i.e. ~/.cache/gelex/completion_cache.sqlite by default.
+# Set GELEX_COMPLETION_CACHE to another file to move it, or to an empty string to disable it.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Any, Generator, AsyncGenerator
+import openai
+from openai.openai_object import OpenAIObject
+from openai.util import convert_to_openai_object
+
+
+def user_cache_path() -> str:
+    """
+        Returns the path of the cache of the user: $XDG_CACHE_HOME/gelex/completion_cache.sqlite, or ~/.cache/gelex/completion_cache.sqlite.
+    """
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'gelex', 'completion_cache.sqlite')
+
+
+DEFAULT_CACHE_PATH = os.environ.get('GELEX_COMPLETION_CACHE', user_cache_path())
+
+
+class CompletionCache:
+    """
+        A content-addressed cache of chat completions, stored in a sqlite file.
+
+        The key of a request is the sha256 of the model, the messages and the sampling parameters, so any change
+        to the prompt (or to a system prompt) is a different entry. The file can be shared by several processes
+        (e.g. the workers of a multiprocessing Pool).
+
+        Inputs:
+            - path: The sqlite file. Default is DEFAULT_CACHE_PATH.
+            - max_entries: The maximum number of entries. When it is reached, the least recently used entries are evicted down to
+                           90% of it, so that the entries are not counted again at the next put.
+            - ttl: The time to live of an entry in seconds. Default is None, i.e. entries never expire.
+    """
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = 100_000, ttl: float | None = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Tokens that were not paid for thanks to the hits
+        self.saved_tokens = 0
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+        self._pid: int | None = None
+        # The number of entries when they were last counted (on connection and on eviction), plus the puts of this process since
+        self._entries = 0
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # Connections can't be shared with forked processes, each process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self._connection.execute('CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)')
+            self._entries = self._connection.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+        return self._connection
+
+    @staticmethod
+    def key(model: str, messages: List[Dict[str, str]], **params: Any) -> str:
+        """
+            Returns the key of a request: the sha256 of its canonical json encoding.
+        """
+        request = {'model': model, 'messages': messages, **params}
+        encoded = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> OpenAIObject | None:
+        """
+            Returns the cached response of the key, or None if it isn't cached (or has expired).
+        """
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute('SELECT response, created FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self.connection.execute('DELETE FROM completions WHERE key = ?', (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute('UPDATE completions SET last_used = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        response = convert_to_openai_object(json.loads(row[0]))
+        self.saved_tokens += response.get('usage', {}).get('total_tokens', 0)
+        return response
+
+    def put(self, key: str, response: OpenAIObject) -> None:
+        """
+            Stores the response under the key, evicting the least recently used entries if the cache is full.
+        """
+        now = time.time()
+        encoded = json.dumps(response.to_dict_recursive())
+        with self._lock:
+            connection = self.connection
+            connection.execute('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)', (key, encoded, now, now))
+            # A replaced entry is counted as well, and the other processes' puts are not: the entries are only counted
+            # when this count says that the cache is full
+            self._entries += 1
+            if self._entries <= self.max_entries:
+                return
+            count = connection.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+            if count > self.max_entries:
+                keep = self.max_entries - max(1, self.max_entries // 10)
+                connection.execute(
+                    'DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY last_used LIMIT ?)',
+                    (count - keep,),
+                )
+                count = keep
+            self._entries = count
+
+    def evict_expired(self) -> int:
+        """
+            Deletes the expired entries and returns how many were deleted. Expired entries are also dropped lazily by get.
+        """
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            cursor = self.connection.execute('DELETE FROM completions WHERE created < ?', (time.time() - self.ttl,))
+        return cursor.rowcount
+
+    def clear(self) -> None:
+        with self._lock:
+            self.connection.execute('DELETE FROM completions')
+
+    def __bool__(self) -> bool:
+        # An empty cache is still a cache: without this, `if cache` would be False for it (and run a COUNT(*) through __len__)
+        return True
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.connection.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+
+    def stats(self) -> Dict[str, float]:
+        """
+            Returns the hit/miss counters of this process, the hit rate, the saved tokens and the number of entries.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'saved_tokens': self.saved_tokens,
+            'entries': len(self),
+        }
+
+
+_default_cache: CompletionCache | None = None
+
+def default_cache() -> CompletionCache | None:
+    """
+        Returns the cache shared by the whole process, or None if GELEX_COMPLETION_CACHE is set to an empty string.
+    """
+    global _default_cache
+    if not DEFAULT_CACHE_PATH:
+        return None
+    if _default_cache is None:
+        _default_cache = CompletionCache()
+    return _default_cache
+
+
+def _cacheable(params: Dict[str, Any]) -> bool:
+    # Only deterministic requests are cached, sampling with a temperature should give a new answer every time
+    return params.get('temperature', 1) == 0 and not params.get('stream', False)
+
+
+def cached_completion(
+    model: str,
+    messages: List[Dict[str, str]],
+    cache: CompletionCache | None = None,
+    **params: Any,
+) -> OpenAIObject:
+    """
+        Drop-in replacement for openai.ChatCompletion.create that answers from the cache when possible.
+
+        Inputs:
+            - model: The model to use.
+            - messages: The messages, as for openai.ChatCompletion.create.
+            - cache: The cache to use. Default is default_cache().
+            - params: Any other parameter of openai.ChatCompletion.create (e.g. temperature). Only requests with temperature=0 are cached.
+
+        Output:
+            - The response, type: openai.openai_object.OpenAIObject
+    """
+    if cache is None:
+        cache = default_cache()
+    if cache is None or not _cacheable(params):
+        return openai.ChatCompletion.create(model=model, messages=messages, **params)
+    key = CompletionCache.key(model, messages, **params)
+    response = cache.get(key)
+    if response is None:
+        response = openai.ChatCompletion.create(model=model, messages=messages, **params)
+        cache.put(key, response)
+    return response
+
+
+async def cached_completion_async(
+    client,
+    model: str,
+    messages: List[Dict[str, str]],
+    cache: CompletionCache | None = None,
+    **params: Any,
+) -> OpenAIObject:
+    """
+        The same as cached_completion, but the request is sent with client.chat_completion (an AsyncGptClient).
+        The sqlite lookups are fast enough to be done on the event loop.
+    """
+    if cache is None:
+        cache = default_cache()
+    if cache is None or not _cacheable(params):
+        return await client.chat_completion(model=model, messages=messages, **params)
+    # The timeout doesn't change the answer, it is not part of the key
+    key = CompletionCache.key(model, messages, **{k: v for k, v in params.items() if k != 'timeout'})
+    response = cache.get(key)
+    if response is None:
+        response = await client.chat_completion(model=model, messages=messages, **params)
+        cache.put(key, response)
+    return response
+
+
+def _streamed_response(model: str, content: str, finish_reason: str) -> OpenAIObject:
+    # The response of the non-streaming request, rebuilt from the streamed text, so that it can be cached
+    return convert_to_openai_object({
+        'object': 'chat.completion',
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': finish_reason}],
+    })
+
+
+def cached_completion_stream(
+    model: str,
+    messages: List[Dict[str, str]],
+    cache: CompletionCache | None = None,
+    **params: Any,
+) -> Generator[str, None, None]:
+    """
+        Streams the text of the answer as the model produces it (openai.ChatCompletion.create with stream=True).
+        The request shares its cache entry with the same non-streaming request: a cached answer is yielded at once,
+        and a streamed answer is cached once complete, i.e. only if the model stopped by itself (finish_reason 'stop'):
+        an answer cut by max_tokens, a content filter or a dropped connection is not replayed.
+
+        Inputs: See cached_completion.
+
+        Output:
+            - A generator of the pieces of the answer's text.
+    """
+    if cache is None:
+        cache = default_cache()
+    key = CompletionCache.key(model, messages, **params) if cache is not None and _cacheable(params) else None
+    if key is not None:
+        response = cache.get(key)
+        if response is not None:
+            yield response.choices[0].message.content
+            return
+    pieces = []
+    finish_reason = None
+    for chunk in openai.ChatCompletion.create(model=model, messages=messages, stream=True, **params):
+        if not chunk.choices:
+            continue
+        piece = chunk.choices[0].delta.get('content')
+        finish_reason = chunk.choices[0].get('finish_reason') or finish_reason
+        if piece:
+            pieces.append(piece)
+            yield piece
+    if key is not None and finish_reason == 'stop':
+        cache.put(key, _streamed_response(model, ''.join(pieces), finish_reason))
+
+
+async def cached_completion_stream_async(
+    client,
+    model: str,
+    messages: List[Dict[str, str]],
+    cache: CompletionCache | None = None,
+    **params: Any,
+) -> AsyncGenerator[str, None]:
+    """
+        The same as cached_completion_stream, but the request is sent with client.chat_completion_stream (an AsyncGptClient).
+    """
+    if cache is None:
+        cache = default_cache()
+    cacheable = cache is not None and _cacheable(params)
+    key = CompletionCache.key(model, messages, **{k: v for k, v in params.items() if k != 'timeout'}) if cacheable else None
+    if key is not None:
+        response = cache.get(key)
+        if response is not None:
+            yield response.choices[0].message.content
+            return
+    pieces = []
+    finish_reason = None
+    async for chunk in client.chat_completion_stream(model=model, messages=messages, **params):
+        if not chunk.choices:
+            continue
+        piece = chunk.choices[0].delta.get('content')
+        finish_reason = chunk.choices[0].get('finish_reason') or finish_reason
+        if piece:
+            pieces.append(piece)
+            yield piece
+    if key is not None and finish_reason == 'stop':
+        cache.put(key, _streamed_response(model, ''.join(pieces), finish_reason))
@@ -0,0 +1,196 @@
+# Asynchronous client for the chat completions endpoint.
+# The responses and errors are the same objects the synchronous openai.ChatCompletion.create returns/raises,
+# so the rest of the code (e.g. _print_response, get_fullfilled_percentage) works with both.
+
+import asyncio
+import json
+import os
+from typing import List, Dict, Any, AsyncGenerator
+import aiohttp
+import openai
+from openai.openai_object import OpenAIObject
+from openai.util import convert_to_openai_object
+
+
+class AsyncGptClient:
+    """
+        A chat completions client sharing one pooled HTTP session between all the requests.
+
+        Each process should create one client (or use default_client()) and reuse it, so that the connections
+        to the API are kept alive. Requests are plain coroutines: they can be awaited concurrently with asyncio.gather,
+        and cancelling the task awaiting a request cancels the HTTP request.
+
+        Inputs:
+            - api_key: The API key. Default is openai.api_key, i.e. the OPENAI_APIKEY environment variable.
+            - api_base: The base url of the API. Default is openai.api_base. Point it to a local stub server to test without the API.
+            - max_connections: The maximum number of simultaneous connections, i.e. in-flight requests.
+            - timeout: The default timeout of a request, in seconds.
+    """
+    def __init__(
+        self,
+        api_key: str | None = None,
+        api_base: str | None = None,
+        max_connections: int = 64,
+        timeout: float = 120.0,
+    ):
+        self.api_key = api_key or openai.api_key or os.environ.get('OPENAI_APIKEY')
+        self.api_base = (api_base or openai.api_base).rstrip('/')
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._session: aiohttp.ClientSession | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # The session is bound to the event loop it is created in, so it is created on first use
+        # (and again if the client is used from another loop, e.g. successive asyncio.run calls in a notebook)
+        loop = asyncio.get_running_loop()
+        if self._session is not None and not self._session.closed and self._loop is not loop:
+            self._discard_session()
+        if self._session is None or self._session.closed:
+            self._loop = loop
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                headers={'Authorization': f'Bearer {self.api_key}'},
+            )
+        return self._session
+
+    def _discard_session(self) -> None:
+        # The session belongs to another event loop. If that loop still runs (in another thread) the session is closed there.
+        # Otherwise (e.g. the loop of a previous asyncio.run) its connections can't be reused from this loop: the session is
+        # detached and its connector closed, instead of leaking until the garbage collector warns.
+        session, loop = self._session, self._loop
+        self._session = None
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+            return
+        connector = session.connector
+        session.detach()
+        if connector is None:
+            return
+        try:
+            # Closes the transports right away, what it returns only waits for them to be closed
+            closing = connector.close()
+        except RuntimeError:
+            # Waiting needs the loop of the connector, which is closed: the transports are closed all the same
+            return
+        # Awaited on this loop, aiohttp warns about a close() that is never awaited
+        future = asyncio.ensure_future(closing)
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def __aenter__(self) -> 'AsyncGptClient':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def chat_completion(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = "gpt-3.5-turbo",
+        temperature: float = 0,
+        timeout: float | None = None,
+        **params: Any,
+    ) -> OpenAIObject:
+        """
+            Sends a chat completion request.
+
+            Inputs:
+                - messages: The messages, as for openai.ChatCompletion.create.
+                - model: The model to use. Default is "gpt-3.5-turbo".
+                - temperature: The sampling temperature. Default is 0.
+                - timeout: The timeout of this request in seconds. Default is the timeout of the client.
+                - params: Any other parameter of the endpoint (e.g. max_tokens).
+
+            Output:
+                - The response, type: openai.openai_object.OpenAIObject
+        """
+        payload = {'model': model, 'messages': messages, 'temperature': temperature, **params}
+        try:
+            async with self.session.post(
+                f'{self.api_base}/chat/completions',
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=timeout or self.timeout),
+            ) as response:
+                body = await response.text()
+                if response.status != 200:
+                    raise _api_error(response.status, body, response.headers)
+                return convert_to_openai_object(json.loads(body))
+        except asyncio.TimeoutError as e:
+            raise openai.error.Timeout(f'Request timed out after {timeout or self.timeout} seconds') from e
+        except aiohttp.ClientConnectionError as e:
+            raise openai.error.APIConnectionError(f'Error communicating with the API: {e}') from e
+
+    async def chat_completion_stream(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = "gpt-3.5-turbo",
+        temperature: float = 0,
+        timeout: float | None = None,
+        **params: Any,
+    ) -> AsyncGenerator[OpenAIObject, None]:
+        """
+            Sends a chat completion request with stream=True and yields the chunks as the model produces them,
+            i.e. the same objects as openai.ChatCompletion.create(stream=True). The text is in chunk.choices[0].delta.get('content').
+            The timeout applies to the time between two chunks, not to the whole answer.
+
+            Inputs: See chat_completion.
+        """
+        payload = {'model': model, 'messages': messages, 'temperature': temperature, 'stream': True, **params}
+        try:
+            async with self.session.post(
+                f'{self.api_base}/chat/completions',
+                json=payload,
+                timeout=aiohttp.ClientTimeout(sock_read=timeout or self.timeout),
+            ) as response:
+                if response.status != 200:
+                    raise _api_error(response.status, await response.text(), response.headers)
+                # Server-sent events, one "data: {...}" line per chunk, ended by "data: [DONE]"
+                async for line in response.content:
+                    line = line.decode('utf-8').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    data = line[len('data:'):].strip()
+                    if data == '[DONE]':
+                        return
+                    yield convert_to_openai_object(json.loads(data))
+        except asyncio.TimeoutError as e:
+            raise openai.error.Timeout(f'No data received for {timeout or self.timeout} seconds') from e
+        except aiohttp.ClientConnectionError as e:
+            raise openai.error.APIConnectionError(f'Error communicating with the API: {e}') from e
+
+
+def _api_error(status: int, body: str, headers) -> openai.error.OpenAIError:
+    # Same error classes as the openai package, so callers can handle both clients the same way
+    try:
+        json_body = json.loads(body)
+        message = json_body['error']['message']
+    except (ValueError, KeyError, TypeError):
+        json_body, message = None, body
+    error_class = {
+        400: openai.error.InvalidRequestError,
+        401: openai.error.AuthenticationError,
+        403: openai.error.PermissionError,
+        404: openai.error.InvalidRequestError,
+        429: openai.error.RateLimitError,
+        503: openai.error.ServiceUnavailableError,
+    }.get(status, openai.error.APIError)
+    if error_class is openai.error.InvalidRequestError:
+        return error_class(message, None, http_body=body, http_status=status, json_body=json_body, headers=dict(headers))
+    return error_class(message, http_body=body, http_status=status, json_body=json_body, headers=dict(headers))
+
+
+_default_client: AsyncGptClient | None = None
+
+def default_client() -> AsyncGptClient:
+    """
+        Returns the client shared by the whole process, creating it on first use.
+    """
+    global _default_client
+    if _default_client is None:
+        _default_client = AsyncGptClient()
+    return _default_client
@@ -1,12 +1,20 @@
 # Make sure to install openai package before running this file
 # https://platform.openai.com/docs/api-reference?lang=python
 
+import itertools
 import openai
 import os
+import threading
+import time
 import pandas as pd
+from gpt_client import AsyncGptClient, default_client
+from completion_cache import CompletionCache, cached_completion, cached_completion_async, cached_completion_stream, cached_completion_stream_async
 from dataclasses import dataclass
-from typing import List, Tuple, Set, FrozenSet, Generator, Any, Dict, Literal
+from typing import List, Tuple, Set, FrozenSet, Generator, AsyncGenerator, Any, Dict, Literal
 from gensim.parsing.preprocessing import preprocess_string
+from rule_index import RuleIndex, extract_rules_from_index
+from rule_store import load_rule_store, current_rule_version
+from recipe_tokenizer import RecipeTokenizer, TokenizedText, default_tokenizer
 
 @dataclass
 class PipelineOutput:
@@ -15,6 +23,40 @@ class PipelineOutput:
     fulfilled_rules: Set[FrozenSet[str]]
     rules: Dict[FrozenSet[str], Tuple[str, float]]
 
+# The system prompt used by prompt_gpt and prompt_gpt_async
+SYSTEM_PROMPT = """
+            You are a recipe improvement assistant. The improvement will be done ONLY in the scope of rules.
+            You will be given a recipe and a set of rules that it has already fulfilled. Note that this will just be a subset of all the rules that the recipe fulfills.
+            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe. Note that, these words aren't dependent on each other. Thus they don't have to appear in the same sentence, or in the same order that they are given. It just means they have to appear at least once somewhere in the recipe.
+            The user will also give you some new set of rules that it has not fulfilled yet.
+            
+            You are responsible for rewriting the recipe. You have to make sure that the new recipe you write fulfills all the new rules, while keeping all the details from the original recipe intact.
+            Thus, you are to only add upon the original recipe, and avoid removing anything from it. You are to only add something if it directly helps you fulfill the new rules.
+            
+            You'll write two parts, the first part is the Ingredients and Instructions. The second part is the explanation.
+            The first part will be wrapped between <RECIPE> and </RECIPE> tags. In this part include the ingredient portions in the list labelled Ingredients: and then the Instructions section as a numbered list
+            
+            The second part will be wrapped between <EXPLANATION> and </EXPLANATION> tags. In this part, explain why you made the changes you made.
+            
+            So the output format is:
+            <RECIPE>
+            Ingredients:
+            - Ingredient 1
+            - Ingredient 2
+            ...
+            Instructions:
+            1. Step 1
+            2. Step 2
+            ...
+            </RECIPE>
+            <EXPLANATION>
+            Your explanation here
+            </EXPLANATION>
+            """
+
+# The number of rules of each improvement level of the frontend (rule_counts in app/src/pages/MainPage/MainPage.tsx)
+RULE_COUNTS = [1, 3, 5, 10, 30]
+
 # Set the API key, make sure to set the OPENAI_APIKEY environment variable before running this file
 openai.api_key = os.environ['OPENAI_APIKEY']
 
@@ -26,17 +68,25 @@ def load_rule_data(filename = 'rules_recipe_scale.csv', metric='lift'):
 
         Parameters:
             filename (str): The name(and directory) of the file containing the rules. Default is 'rules_recipe_scale.csv'
+                            Can also be a rule store directory written by rule_store.convert_rule_data, which loads without eval.
             metric (str): The metric to sort the rules by. Default is 'lift'
 
         Returns:
             extracted_rules (pd.DataFrame): The mined rules sorted by the metric specified
+
+        For repeated extraction (e.g. in the backend), compile the result once with RuleIndex.from_dataframe(extracted_rules, metric)
+        and pass the RuleIndex to extract_rules instead of the DataFrame.
     """
 
     # load rules csv
     print('Starting to load rule data')
-    rules = pd.read_csv(filename)
-    # From the antecedents column, convert from frozenset to list of strings
-    rules['antecedents'] = rules['antecedents'].apply(lambda x: list(eval(x)))
+    if os.path.isdir(filename):
+        # Binary rule store, the antecedents are already token lists
+        rules = load_rule_store(filename).to_dataframe()
+    else:
+        rules = pd.read_csv(filename)
+        # From the antecedents column, convert from frozenset to list of strings
+        rules['antecedents'] = rules['antecedents'].apply(lambda x: list(eval(x)))
     print('Rule data loaded...')
     print()
     print('Starting rule extraction...')
@@ -47,9 +97,84 @@ def load_rule_data(filename = 'rules_recipe_scale.csv', metric='lift'):
     print('_'*30)
     return extracted_rules
 
+def load_rule_index(store_path = 'rules_recipe_scale.rules', metric='lift') -> RuleIndex:
+
+    """
+        This function loads a rule store (see rule_store.convert_rule_data) and compiles it into a RuleIndex.
+        This is the fastest way to get rules ready for extract_rules, since neither the csv nor a DataFrame is involved.
+        The same RuleIndex can serve any metric: extract_rules picks the precomputed permutation of the metric it is given.
+
+        Parameters:
+            store_path (str): The directory of the rule store. Default is 'rules_recipe_scale.rules'
+            metric (str): The default metric to sort the rules by. Default is 'lift'
+
+        Returns:
+            index (RuleIndex): The compiled rules
+    """
+    return RuleIndex.from_store(load_rule_store(store_path), metric)
+
+class RuleTable:
+    """
+        The rules of a directory of published versions (see rule_store.publish_rule_table), swapped for the new version
+        as soon as one is published, without restarting the backend.
+
+        Pass it to extract_rules (or complete_pipeline) instead of a RuleIndex: every call uses the current version.
+        At most every check_every seconds, the CURRENT file is read and if it changed the new version is loaded.
+        The requests that come in meanwhile keep using the previous version until the new one is ready.
+
+        Inputs:
+            - rules_dir: The directory of the published versions.
+            - metric: The default metric to sort the rules by. Default is 'lift'
+            - check_every: The number of seconds between two checks for a new version. Default is 5.
+    """
+    def __init__(self, rules_dir: str, metric: str = 'lift', check_every: float = 5.0):
+        self.rules_dir = rules_dir
+        self.metric = metric
+        self.check_every = check_every
+        self.version = None
+        self._index = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """
+            Loads the current version if it changed, returns whether a new version was loaded.
+        """
+        # Only one thread loads, the others go on with the previous version
+        if not self._lock.acquire(blocking=self._index is None):
+            return False
+        try:
+            self._last_check = time.monotonic()
+            version = current_rule_version(self.rules_dir)
+            if version is None:
+                raise FileNotFoundError(f'No rules were published in {self.rules_dir}')
+            if version == self.version:
+                return False
+            index = load_rule_index(os.path.join(self.rules_dir, version + '.rules'), self.metric)
+            # A single assignment, readers see either the old or the new index
+            self._index, self.version = index, version
+            print(f'Rules {version} loaded from {self.rules_dir}')
+            return True
+        finally:
+            self._lock.release()
+
+    def get(self) -> RuleIndex:
+        """
+            Returns the RuleIndex of the current version.
+        """
+        if time.monotonic() - self._last_check >= self.check_every:
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the version we have
+                print(f'Could not load the new rules of {self.rules_dir}: {e}')
+        return self._index
+
+
 def extract_rules(
     recipe: List[str],
-    rules: pd.DataFrame,
+    rules: pd.DataFrame | RuleIndex | RuleTable,
     rule_count = 3,
     metric='lift'
 ) -> Set[FrozenSet[str]]:
@@ -61,13 +186,20 @@ def extract_rules(
         Input: 
             - recipe: A list of tokens (i.e. a recipe preprocessed using gensim preprocess_string, make sure that the whole recipe is a single string before using preprocess_string)
             - rules: A pd.DataFrame with columns: ['antecedents', 'consequents', 'confidence', 'lift'], should be sorted by the metric.
+                     Can also be a RuleIndex compiled from such a DataFrame, in which case only the rules whose antecedents are in the recipe are visited,
+                     or a RuleTable, in which case the RuleIndex of its current version is used.
             - rule_count: The number of rules to be extracted
+            - metric: The metric the rules are sorted by. A RuleIndex is sorted by this metric on the fly, a DataFrame should already be sorted by it.
 
         Output:
             - Two elements:
                 - A set of frozensets, each frozenset is a rule.
                 - A dictionary with the rules as keys and the tuple (consequents, lift) as values.
     """
+    if isinstance(rules, RuleTable):
+        rules = rules.get()
+    if isinstance(rules, RuleIndex):
+        return extract_rules_from_index(recipe, rules, rule_count, metric)
 
     # Initialize the list to be returned
     rules_to_return = set()
@@ -96,61 +228,116 @@ def extract_rules(
     return rules_to_return, suggestions_to_return
 
 
+def top_rules(
+    suggestions: Dict[FrozenSet[str], Tuple[str, float]],
+    rule_count: int,
+) -> Tuple[Set[FrozenSet[str]], Dict[FrozenSet[str], Tuple[str, float]]]:
+    """
+        Returns the first rule_count rules of an extraction, in the format of extract_rules.
+
+        extract_rules picks the rules greedily in metric order, and whether a rule is picked only depends on the rules picked
+        before it: the rules of extract_rules(recipe, rules, 3) are the first 3 rules of extract_rules(recipe, rules, 30).
+        The suggestions are in the order they were picked, so the smaller extractions are prefixes of the larger one.
+
+        Input:
+            - suggestions: The suggestions returned by extract_rules with at least rule_count rules.
+            - rule_count: The number of rules to keep.
+    """
+    top = dict(itertools.islice(suggestions.items(), rule_count))
+    return set(top), top
+
+
+def extract_rules_levels(
+    recipe: List[str],
+    rules: pd.DataFrame | RuleIndex | RuleTable,
+    levels: List[int] = RULE_COUNTS,
+    metric='lift'
+) -> Dict[int, Tuple[Set[FrozenSet[str]], Dict[FrozenSet[str], Tuple[str, float]]]]:
+    """
+        Extracts the rules of every improvement level at once: the rules are extracted once for the largest level,
+        and the other levels are derived from it (see top_rules).
+
+        Input:
+            - recipe: A list of tokens, as for extract_rules.
+            - rules: The rules, as for extract_rules.
+            - levels: The numbers of rules. Default is RULE_COUNTS, the levels of the frontend.
+            - metric: The metric the rules are sorted by.
+
+        Output:
+            - A dictionary {number of rules: (fulfilled rules, suggestions)}, the same as extract_rules(recipe, rules, number of rules, metric).
+    """
+    _, suggestions = extract_rules(recipe, rules, max(levels), metric)
+    return {level: top_rules(suggestions, level) for level in levels}
+
+
+def _prompt_messages(prompt: str) -> List[Dict[str, str]]:
+    # The messages sent by prompt_gpt and its async/streaming versions
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
 def prompt_gpt(
         prompt: str,
         print_response: bool = True,
         model="gpt-3.5-turbo",
+        cache: CompletionCache | None = None,
 ) -> openai.openai_object.OpenAIObject:
     """
         This function takes as input a prompt and returns the response from GPT-3.5.
+        Responses are cached, so sending the same prompt again doesn't cost any tokens.
 
         Inputs:
             - prompt: The prompt to be sent to GPT.
             - print_response: Whether to print the response or not.
             - model: The model to use for the response. Default is "gpt-3.5-turbo".
+            - cache: The completion cache to use. Default is the cache shared by the process (completion_cache.default_cache()).
 
         Output:
             - The response from GPT type: GptResponse.
     """
-    response = openai.ChatCompletion.create(
+    response = cached_completion(
+        cache=cache,
         model=model,
-        messages = [
-            {
-            "role": "system", "content": """
-            You are a recipe improvement assistant. The improvement will be done ONLY in the scope of rules.
-            You will be given a recipe and a set of rules that it has already fulfilled. Note that this will just be a subset of all the rules that the recipe fulfills.
-            The rules will be of following shape: frozenset({{'word1', 'word2', ...}}) -> This means that the words word1, word2, ... should be present somewhere in the recipe. Note that, these words aren't dependent on each other. Thus they don't have to appear in the same sentence, or in the same order that they are given. It just means they have to appear at least once somewhere in the recipe.
-            The user will also give you some new set of rules that it has not fulfilled yet.
-            
-            You are responsible for rewriting the recipe. You have to make sure that the new recipe you write fulfills all the new rules, while keeping all the details from the original recipe intact.
-            Thus, you are to only add upon the original recipe, and avoid removing anything from it. You are to only add something if it directly helps you fulfill the new rules.
-            
-            You'll write two parts, the first part is the Ingredients and Instructions. The second part is the explanation.
-            The first part will be wrapped between <RECIPE> and </RECIPE> tags. In this part include the ingredient portions in the list labelled Ingredients: and then the Instructions section as a numbered list
-            
-            The second part will be wrapped between <EXPLANATION> and </EXPLANATION> tags. In this part, explain why you made the changes you made.
-            
-            So the output format is:
-            <RECIPE>
-            Ingredients:
-            - Ingredient 1
-            - Ingredient 2
-            ...
-            Instructions:
-            1. Step 1
-            2. Step 2
-            ...
-            </RECIPE>
-            <EXPLANATION>
-            Your explanation here
-            </EXPLANATION>
-            """
-            },
-            {
-            "role": "user", "content": prompt
-            }
-        ],
+        messages=_prompt_messages(prompt),
+        temperature=0,
+    )
+    if print_response:
+        _print_response(response)
+    return response
+
+
+async def prompt_gpt_async(
+        prompt: str,
+        print_response: bool = False,
+        model="gpt-3.5-turbo",
+        client: AsyncGptClient | None = None,
+        timeout: float | None = None,
+        cache: CompletionCache | None = None,
+) -> openai.openai_object.OpenAIObject:
+    """
+        The asynchronous version of prompt_gpt, sent through a pooled AsyncGptClient. Many of these can be in flight at once.
+
+        Inputs:
+            - prompt: The prompt to be sent to GPT.
+            - print_response: Whether to print the response or not. Default is False.
+            - model: The model to use for the response. Default is "gpt-3.5-turbo".
+            - client: The client to send the request with. Default is the client shared by the process (gpt_client.default_client()).
+            - timeout: The timeout of the request in seconds. Default is the timeout of the client.
+            - cache: The completion cache to use. Default is the cache shared by the process (completion_cache.default_cache()).
+
+        Output:
+            - The response from GPT type: GptResponse.
+    """
+    client = client or default_client()
+    response = await cached_completion_async(
+        client,
+        cache=cache,
+        model=model,
+        messages=_prompt_messages(prompt),
         temperature=0,
+        timeout=timeout,
     )
     if print_response:
         _print_response(response)
@@ -219,7 +406,7 @@ def _print_response(response: openai.openai_object.OpenAIObject|str) -> None:
 def complete_pipeline(
         recipe_tokens: List[str],
         recipe_directions: List[str] | str,
-        extracted_rules: pd.DataFrame,
+        extracted_rules: pd.DataFrame | RuleIndex,
         prompt_function: callable = prompt_gpt,
         rule_count: int = 3,
         metric: str = 'lift',
@@ -232,7 +419,7 @@ def complete_pipeline(
         Inputs:
             - recipe_tokens: A list of tokens (i.e. a recipe preprocessed using gensim preprocess_string, make sure that the whole recipe is a single string before using preprocess_string)
             - recipe_directions: The directions of the recipe, type: str or List[str]. If it is a list, it will be converted to a string as steps separated by enumeration. (i.e. 1. step1\n2. step2\n...)
-            - extracted_rules: A pandas dataframe with columns ['antecedents', 'consequents', 'confidence', 'lift']. IMPORTANT: The DF should be sorted by the metric.
+            - extracted_rules: A pandas dataframe with columns ['antecedents', 'consequents', 'confidence', 'lift']. IMPORTANT: The DF should be sorted by the metric. A RuleIndex can be given instead.
             - prompt_function: The function to be used to send the prompt to GPT. The default is prompt_gpt.
         
         Output:
@@ -257,26 +444,218 @@ def complete_pipeline(
 
 
 
-def get_fullfilled_percentage(response, suggestions: Dict[str, Tuple[frozenset, int]]):
+async def complete_pipeline_async(
+        recipe_tokens: List[str],
+        recipe_directions: List[str] | str,
+        extracted_rules: pd.DataFrame | RuleIndex,
+        prompt_function: callable = prompt_gpt_async,
+        rule_count: int = 3,
+        metric: str = 'lift',
+        model="gpt-3.5-turbo",
+        client: AsyncGptClient | None = None,
+        timeout: float | None = None,
+) -> PipelineOutput:
+    """
+        The asynchronous version of complete_pipeline. The rule extraction is done in place (it is fast with a RuleIndex),
+        and the GPT request is awaited on the client, so the event loop keeps serving other requests meanwhile.
+        See complete_pipeline for the inputs and the output.
+
+        Extra inputs:
+            - client: The AsyncGptClient to send the request with. Default is the client shared by the process.
+            - timeout: The timeout of the GPT request in seconds. Default is the timeout of the client.
+    """
+    fulfilled_rules, suggestions = extract_rules(recipe_tokens, extracted_rules, rule_count, metric)
+    prompt = create_prompt(recipe_directions, fulfilled_rules, suggestions)
+    resp = await prompt_function(prompt=prompt, print_response=False, model=model, client=client, timeout=timeout)
+    return PipelineOutput(
+        original_recipe=recipe_directions,
+        new_recipe=resp.choices[0].message.content,
+        fulfilled_rules=fulfilled_rules,
+        rules=suggestions
+    )
+
+
+class RecipeStreamParser:
+    """
+        Extracts the text between the <RECIPE> and </RECIPE> tags from an answer received in pieces.
+        A tag may be split between two pieces, so the end of a piece that could be the start of a tag is held back until the next piece.
+    """
+    START_TAG = '<RECIPE>'
+    END_TAG = '</RECIPE>'
+
+    def __init__(self):
+        self.buffer = ''
+        self.inside = False
+        self.done = False
+
+    def feed(self, piece: str) -> str:
+        """
+            Adds a piece of the answer and returns the new recipe text it completes (possibly empty).
+        """
+        if self.done:
+            return ''
+        self.buffer += piece
+        if not self.inside:
+            start = self.buffer.find(self.START_TAG)
+            if start == -1:
+                # Only keep what could be the beginning of the start tag
+                self.buffer = self.buffer[-(len(self.START_TAG) - 1):]
+                return ''
+            self.inside = True
+            self.buffer = self.buffer[start + len(self.START_TAG):]
+        end = self.buffer.find(self.END_TAG)
+        if end != -1:
+            self.done = True
+            text, self.buffer = self.buffer[:end], ''
+            return text
+        # Hold back a possible beginning of the end tag
+        keep = _partial_tag_length(self.buffer, self.END_TAG)
+        text, self.buffer = self.buffer[:len(self.buffer) - keep], self.buffer[len(self.buffer) - keep:]
+        return text
+
+    def flush(self) -> str:
+        """
+            Returns the held back text once the answer is complete (if the end tag never came).
+        """
+        text = self.buffer if self.inside and not self.done else ''
+        self.buffer = ''
+        return text
+
+
+def _partial_tag_length(text: str, tag: str) -> int:
+    # Length of the longest suffix of text that is a prefix of tag
+    for length in range(min(len(text), len(tag) - 1), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+
+def complete_pipeline_stream(
+        recipe_tokens: List[str],
+        recipe_directions: List[str] | str,
+        extracted_rules: pd.DataFrame | RuleIndex,
+        rule_count: int = 3,
+        metric: str = 'lift',
+        model="gpt-3.5-turbo",
+        cache: CompletionCache | None = None,
+) -> Generator[str | PipelineOutput, None, None]:
+    """
+        The streaming version of complete_pipeline (with prompt_gpt): the text of the new recipe (between the <RECIPE> tags)
+        is yielded piece by piece as GPT writes it, so it can be forwarded to the frontend right away.
+        The last item yielded is the PipelineOutput, the same as complete_pipeline returns. See complete_pipeline for the inputs.
+
+        Example:
+            for item in complete_pipeline_stream(tokens, directions, rules):
+                if isinstance(item, PipelineOutput):
+                    output = item
+                else:
+                    send_partial_recipe(item)
+    """
+    fulfilled_rules, suggestions = extract_rules(recipe_tokens, extracted_rules, rule_count, metric)
+    prompt = create_prompt(recipe_directions, fulfilled_rules, suggestions)
+    parser = RecipeStreamParser()
+    pieces = []
+    for piece in cached_completion_stream(model=model, messages=_prompt_messages(prompt), cache=cache, temperature=0):
+        pieces.append(piece)
+        text = parser.feed(piece)
+        if text:
+            yield text
+    text = parser.flush()
+    if text:
+        yield text
+    yield PipelineOutput(
+        original_recipe=recipe_directions,
+        new_recipe=''.join(pieces),
+        fulfilled_rules=fulfilled_rules,
+        rules=suggestions
+    )
+
+
+async def complete_pipeline_stream_async(
+        recipe_tokens: List[str],
+        recipe_directions: List[str] | str,
+        extracted_rules: pd.DataFrame | RuleIndex,
+        rule_count: int = 3,
+        metric: str = 'lift',
+        model="gpt-3.5-turbo",
+        client: AsyncGptClient | None = None,
+        timeout: float | None = None,
+        cache: CompletionCache | None = None,
+) -> AsyncGenerator[str | PipelineOutput, None]:
+    """
+        The asynchronous version of complete_pipeline_stream, sent through an AsyncGptClient (default: the client shared by the process).
+        The timeout is the maximum time between two pieces of the answer.
+    """
+    fulfilled_rules, suggestions = extract_rules(recipe_tokens, extracted_rules, rule_count, metric)
+    prompt = create_prompt(recipe_directions, fulfilled_rules, suggestions)
+    client = client or default_client()
+    parser = RecipeStreamParser()
+    pieces = []
+    async for piece in cached_completion_stream_async(client, model=model, messages=_prompt_messages(prompt), cache=cache, temperature=0, timeout=timeout):
+        pieces.append(piece)
+        text = parser.feed(piece)
+        if text:
+            yield text
+    text = parser.flush()
+    if text:
+        yield text
+    yield PipelineOutput(
+        original_recipe=recipe_directions,
+        new_recipe=''.join(pieces),
+        fulfilled_rules=fulfilled_rules,
+        rules=suggestions
+    )
+
+
+def recipe_text(answer: str) -> str:
+    """
+        Returns the generated recipe of an answer of GPT, i.e. the text between the <RECIPE> and </RECIPE> tags.
+        If a tag is missing, the text goes from the start or to the end of the answer.
+    """
+    start = answer.find('<RECIPE>')
+    start = 0 if start < 0 else start + len('<RECIPE>')
+    end = answer.find('</RECIPE>', start)
+    return answer[start:end if end >= 0 else len(answer)].strip()
+
+
+def tokenize_recipe(text: str, tokenizer: RecipeTokenizer | None = None) -> TokenizedText:
+    """
+        Tokenizes a recipe (the user recipe, or the text of a generated one) in a single pass, with the memoized tokenizer.
+        The tokens are the same as preprocess_string(text), and come with the words they were found in, so the same result
+        can be used for extract_rules (.tokens), get_fullfilled_percentage and the annotations of the frontend (.annotations()).
+
+        Input:
+            - text: The recipe, as a single string.
+            - tokenizer: The tokenizer to use. Default is the one shared by the process (recipe_tokenizer.default_tokenizer).
+
+        Output:
+            - The tokens with their words, type: TokenizedText
+    """
+    return (tokenizer or default_tokenizer()).tokenize(text)
+
+def get_fullfilled_percentage(response, suggestions: Dict[str, Tuple[frozenset, int]], tokenized: TokenizedText | None = None):
     """
         This function takes as input the response from GPT and the suggestions, and returns the percentage of suggestions that were fulfilled.
 
         Input:
             - response: The response from GPT, type: GptResponse
             - suggestions: The suggestions to be fulfilled, type: Dict[str, Tuple[frozenset, int]]
+            - tokenized: The generated recipe already tokenized with tokenize_recipe, if the caller has it. Default is None, i.e. it is tokenized here.
         
         Output:
             - A tuple of the form (num_fullfilled, num_not_fullfilled, percentage)
     """
 
-    generated_recipe = response.choices[0].message.content
-    recipe_start = generated_recipe.find('<RECIPE>') + len('<RECIPE>')
-    recipe_end = generated_recipe.find('</RECIPE>')
-    generated_recipe_text = generated_recipe[recipe_start:recipe_end].strip()
     num_fullfilled = 0
     num_not_fullfilled = 0
-    # Preprocessing new recipe
-    generated_preprocessed = preprocess_string(generated_recipe_text)
+    if tokenized is None:
+        generated_recipe = response.choices[0].message.content
+        recipe_start = generated_recipe.find('<RECIPE>') + len('<RECIPE>')
+        recipe_end = generated_recipe.find('</RECIPE>')
+        generated_recipe_text = generated_recipe[recipe_start:recipe_end].strip()
+        # Preprocessing new recipe
+        tokenized = tokenize_recipe(generated_recipe_text)
+    generated_preprocessed = tokenized.token_set
     # Iterate over all the values of suggestions(which is a dictionary)
     # Check if the set is a subset of the generated recipe
     # If yes, increment num_fullfilled
@@ -291,4 +670,4 @@ def get_fullfilled_percentage(response, suggestions: Dict[str, Tuple[frozenset,
         percentage = num_fullfilled / (num_fullfilled + num_not_fullfilled)
     except ZeroDivisionError:
         percentage = 0
-    return (num_fullfilled, num_not_fullfilled, percentage)
\ No newline at end of file
+    return (num_fullfilled, num_not_fullfilled, percentage)
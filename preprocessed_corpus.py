@@ -0,0 +1,215 @@
+# The corpus preprocessed once with gensim preprocess_string, instead of with DataFrame.apply in every notebook run.
+# The tokens are stored as token ids in flat arrays (one vocabulary, so every token string exists once in memory),
+# in a directory named after the column and a hash of the preprocessor: a new gensim version or different filters
+# give a new directory, and an existing one is reused as long as the csv did not change.
+#
+# Usage:
+#   relex_recipes['preprocessed'] = preprocessed_column('relex_examples.csv', column='recipe', parse_list=False)
+#   sample_recipes['preprocessed'] = preprocessed_column('../dataset/full_dataset.csv').loc[sample_recipes.index]
+
+import ast
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass
+from multiprocessing import Pool
+from typing import List, Tuple, Callable
+import gensim
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from gensim.parsing.preprocessing import preprocess_string, DEFAULT_FILTERS
+
+# Bump this if the layout of the files below changes
+CORPUS_FORMAT_VERSION = 1
+
+
+@dataclass
+class PreprocessedCorpus:
+    """
+        A preprocessed column of a csv. The directory contains:
+            - meta.json: The source csv (path, size and modification time), the column and the preprocessor version.
+            - vocab.json: The token vocabulary, token id -> token.
+            - recipe_ids.npy: The id of each recipe (the id column of the csv, or the row number).
+            - offsets.npy, ids.npy: CSR arrays, the tokens of recipe i are ids[offsets[i]:offsets[i+1]], in the order preprocess_string returns them.
+
+        The arrays are opened with np.load(mmap_mode='r'), loading a corpus is almost free.
+    """
+    path: str
+    tokens: List[str]
+    recipe_ids: np.ndarray
+    offsets: np.ndarray
+    ids: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position: int) -> List[str]:
+        """
+            Returns the tokens of the recipe at the given position, as preprocess_string would.
+        """
+        return [self.tokens[i] for i in self.token_ids(position).tolist()]
+
+    def token_ids(self, position: int) -> np.ndarray:
+        return self.ids[self.offsets[position]:self.offsets[position + 1]]
+
+    def to_series(self) -> pd.Series:
+        """
+            Returns the tokens of every recipe as a pd.Series indexed by the recipe ids, i.e. the usual 'preprocessed' column.
+        """
+        return pd.Series([self[i] for i in range(len(self))], index=np.asarray(self.recipe_ids), name='preprocessed')
+
+    def binary_matrix(self, start: int = 0, end: int | None = None) -> sp.csr_matrix:
+        """
+            Returns the recipe x token binary matrix of the recipes [start, end), e.g. the transactions of the rule miners.
+        """
+        end = len(self) if end is None else end
+        offsets = np.asarray(self.offsets[start:end + 1])
+        # Copied, sum_duplicates sorts the ids in place
+        ids = np.array(self.ids[offsets[0]:offsets[-1]])
+        matrix = sp.csr_matrix((np.ones(len(ids), dtype=np.int32), ids, offsets - offsets[0]), shape=(end - start, len(self.tokens)))
+        # A token appearing twice in a recipe counts once
+        matrix.sum_duplicates()
+        matrix.data[:] = 1
+        return matrix
+
+
+def preprocessor_version(filters: List[Callable] = DEFAULT_FILTERS, parse_list: bool = True) -> str:
+    """
+        Returns a hash of everything that changes the tokens: the gensim version, the filters and how the cells are read.
+    """
+    description = {
+        'format': CORPUS_FORMAT_VERSION,
+        'gensim': gensim.__version__,
+        'filters': [f'{f.__module__}.{f.__qualname__}' for f in filters],
+        'parse_list': parse_list,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def preprocess_text(text: str, parse_list: bool = True) -> List[str]:
+    """
+        Preprocesses a cell the way the notebooks and the backend do.
+
+        Inputs:
+            - text: The cell, e.g. the directions of a recipe of full_dataset.csv.
+            - parse_list: Whether the cell is the string representation of a list of steps (as the directions of full_dataset.csv),
+                          in which case the steps are joined in a single string first.
+
+        Output:
+            - The tokens, as returned by gensim preprocess_string.
+    """
+    if parse_list:
+        text = ' '.join(ast.literal_eval(text))
+    return preprocess_string(text)
+
+
+def preprocess_corpus(
+    csv_path: str,
+    column: str = 'directions',
+    id_column: str | None = None,
+    parse_list: bool = True,
+    output_dir: str | None = None,
+    chunksize: int = 50_000,
+    processes: int | None = None,
+    force: bool = False,
+) -> str:
+    """
+        Preprocesses a column of a csv in parallel and writes the tokens to a corpus directory (see PreprocessedCorpus).
+        If the directory already holds the same column of the same csv preprocessed with the same version, nothing is done.
+
+        Inputs:
+            - csv_path: The csv, e.g. full_dataset.csv.
+            - column: The column to preprocess. Default is 'directions'.
+            - id_column: The column with the recipe ids. Default is None, i.e. the row number.
+            - parse_list: See preprocess_text.
+            - output_dir: The directory of the corpora. Default is <csv_path>.preprocessed
+            - chunksize: The number of rows read from the csv at a time.
+            - processes: The number of workers. Default is os.cpu_count().
+            - force: Whether to preprocess again even if the corpus is up to date.
+
+        Output:
+            - The path of the corpus directory, to be loaded with load_preprocessed.
+    """
+    version = preprocessor_version(parse_list=parse_list)
+    path = os.path.join(output_dir or csv_path + '.preprocessed', f'{column}_{version}')
+    source = _source_info(csv_path, column, id_column)
+    meta_path = os.path.join(path, 'meta.json')
+    if not force and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f)['source'] == source:
+                return path
+    os.makedirs(path, exist_ok=True)
+    # meta.json is written last, a corpus without it is incomplete
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    start = time.perf_counter()
+    token_ids = {}
+    offsets = [0]
+    recipe_ids = []
+    processes = processes or os.cpu_count()
+    usecols = [column] if id_column is None else [column, id_column]
+    with Pool(processes) as pool, open(os.path.join(path, 'ids.bin'), 'wb') as ids_file:
+        for chunk in pd.read_csv(csv_path, usecols=usecols, chunksize=chunksize):
+            texts = chunk[column].fillna('[]' if parse_list else '').tolist()
+            tasks = [(texts[i:i + 1000], parse_list) for i in range(0, len(texts), 1000)]
+            for recipes in pool.imap(_preprocess_batch, tasks):
+                for recipe in recipes:
+                    ids = [token_ids.setdefault(token, len(token_ids)) for token in recipe]
+                    ids_file.write(np.array(ids, dtype=np.int32).tobytes())
+                    offsets.append(offsets[-1] + len(ids))
+            recipe_ids.extend(chunk[id_column].tolist() if id_column is not None else chunk.index.tolist())
+            print(f"{len(recipe_ids)} recipes preprocessed, {len(token_ids)} tokens ({time.perf_counter() - start:.1f}s)")
+
+    # The ids were streamed to a raw file, they are converted to .npy once their number is known
+    ids = np.lib.format.open_memmap(os.path.join(path, 'ids.npy'), mode='w+', dtype=np.int32, shape=(offsets[-1],))
+    ids[:] = np.fromfile(os.path.join(path, 'ids.bin'), dtype=np.int32)
+    ids.flush()
+    del ids
+    os.remove(os.path.join(path, 'ids.bin'))
+    np.save(os.path.join(path, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(path, 'recipe_ids.npy'), np.array(recipe_ids))
+    with open(os.path.join(path, 'vocab.json'), 'w') as f:
+        json.dump(list(token_ids), f)
+    with open(meta_path, 'w') as f:
+        json.dump({'source': source, 'version': version, 'n_recipes': len(recipe_ids), 'n_tokens': len(token_ids)}, f)
+    return path
+
+
+def load_preprocessed(path: str) -> PreprocessedCorpus:
+    """
+        Memory-maps a corpus written by preprocess_corpus.
+    """
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        raise FileNotFoundError(f'{path} is not a complete preprocessed corpus, run preprocess_corpus again')
+    with open(os.path.join(path, 'vocab.json')) as f:
+        tokens = json.load(f)
+    # The recipe ids may be strings, which can't be memory-mapped
+    recipe_ids = np.load(os.path.join(path, 'recipe_ids.npy'), allow_pickle=False)
+    return PreprocessedCorpus(
+        path=path,
+        tokens=tokens,
+        recipe_ids=recipe_ids,
+        offsets=np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r'),
+        ids=np.load(os.path.join(path, 'ids.npy'), mmap_mode='r'),
+    )
+
+
+def preprocessed_column(csv_path: str, column: str = 'directions', id_column: str | None = None, parse_list: bool = True, **kwargs) -> pd.Series:
+    """
+        The 'preprocessed' column of the notebooks, from the corpus of the csv (preprocessed first if needed).
+        Any other keyword argument is passed to preprocess_corpus.
+    """
+    return load_preprocessed(preprocess_corpus(csv_path, column, id_column, parse_list, **kwargs)).to_series()
+
+
+def _preprocess_batch(task: Tuple[List[str], bool]) -> List[List[str]]:
+    texts, parse_list = task
+    return [preprocess_text(text, parse_list) for text in texts]
+
+
+def _source_info(csv_path: str, column: str, id_column: str | None) -> dict:
+    stat = os.stat(csv_path)
+    return {'path': os.path.abspath(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'column': column, 'id_column': id_column}
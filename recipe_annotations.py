@@ -0,0 +1,213 @@
+# The annotations of a generated recipe, i.e. the words the frontend highlights as new (BackendResponse.annotations).
+# The tokens of the user recipe and of the generated recipe are interned as integer ids and diffed: common prefix and suffix
+# are skipped, the stems that appear exactly once on both sides anchor the two recipes together (patience diff, as in git),
+# and the short gaps between the anchors are diffed with Myers' O(ND) algorithm. A token of the generated recipe that is not
+# matched with a token of the user recipe was added by GPT: its word is annotated. Unlike comparing the sets of stems, a
+# stem the user recipe already had is annotated where GPT added it again.
+#
+# Usage:
+#   annotation = annotate(hfb.tokenize_recipe(user_recipe), hfb.tokenize_recipe(new_recipe), suggestions)
+#   response = annotation.backend_response()
+
+from bisect import bisect_left
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Tuple, Dict, FrozenSet, Set
+from recipe_tokenizer import TokenizedText
+from rule_store import parse_frozenset
+
+
+@dataclass
+class RecipeAnnotation:
+    """
+        The changes of a generated recipe.
+
+        Attributes:
+            - text: The generated recipe.
+            - annotations: The words with an added token, {non-stemmed word: [(stemmed word, word index), ...]}
+            - ing_seperated: The ingredients part of the generated recipe.
+            - added: The positions (in the tokens of the generated recipe) of the added tokens.
+            - suggested: The word indexes of the added tokens that are in the consequents of a suggested rule.
+    """
+    text: str
+    annotations: Dict[str, List[Tuple[str, int]]]
+    ing_seperated: str
+    added: List[int]
+    suggested: List[int]
+
+    def backend_response(self) -> Dict:
+        """
+            Returns the BackendResponse of the frontend (see app/src/types/BackendTypes.d.ts).
+        """
+        return {'annotations': self.annotations, 'ing_seperated': self.ing_seperated, 'example_recipe': self.text}
+
+
+def ingredients_part(text: str) -> str:
+    """
+        Returns the ingredients of a generated recipe: the text before 'Instructions:', without the 'Ingredients:' title.
+    """
+    return text.split('Instructions:')[0].replace('Ingredients:', '', 1).strip()
+
+
+@lru_cache(maxsize=100_000)
+def consequent_tokens(consequents: str) -> FrozenSet[str]:
+    """
+        Returns the tokens of the consequents of a suggestion ("frozenset({'word1', ...})"), parsed without eval.
+    """
+    return parse_frozenset(consequents)
+
+
+def suggested_tokens(suggestions: Dict[FrozenSet[str], Tuple[str, float]]) -> Set[str]:
+    """
+        Returns the tokens of the consequents of the suggestions returned by extract_rules.
+    """
+    return set().union(*(consequent_tokens(consequents) for consequents, _ in suggestions.values()))
+
+
+def annotate(original: TokenizedText, generated: TokenizedText, suggestions: Dict[FrozenSet[str], Tuple[str, float]] | None = None) -> RecipeAnnotation:
+    """
+        Annotates the tokens GPT added to the user recipe.
+
+        Inputs:
+            - original: The user recipe, tokenized with hfb.tokenize_recipe.
+            - generated: The generated recipe (the text between the <RECIPE> tags), tokenized with hfb.tokenize_recipe.
+            - suggestions: The suggestions of the prompt, as returned by extract_rules. Default is None, i.e. no suggested words.
+
+        Output:
+            - The annotations, the ingredients and the added tokens, type: RecipeAnnotation
+    """
+    # The ids only have to agree between the two recipes, so the stems are interned per call and nothing grows across requests
+    ids: Dict[str, int] = {}
+    original_ids = [ids.setdefault(token, len(ids)) for token in original.tokens]
+    generated_ids = [ids.setdefault(token, len(ids)) for token in generated.tokens]
+    matched = match_tokens(original_ids, generated_ids)
+    suggested_stems = suggested_tokens(suggestions) if suggestions else set()
+    annotations, added, suggested = {}, [], []
+    for position, token in enumerate(generated.tokens):
+        if matched[position]:
+            continue
+        word_index = generated.word_indexes[position]
+        annotations.setdefault(generated.words[word_index], []).append((token, word_index))
+        added.append(position)
+        if token in suggested_stems:
+            suggested.append(word_index)
+    return RecipeAnnotation(generated.text, annotations, ingredients_part(generated.text), added, suggested)
+
+
+def match_tokens(a: List[int], b: List[int]) -> List[bool]:
+    """
+        Diffs two sequences of ids and returns, for each element of b, whether it is matched with an element of a
+        (i.e. False for the elements added to a to get b).
+    """
+    matched = [False] * len(b)
+    # The ranges [a_start, a_end) x [b_start, b_end) left to diff
+    ranges = [(0, len(a), 0, len(b))]
+    while ranges:
+        a_start, a_end, b_start, b_end = ranges.pop()
+        # Common prefix and suffix
+        while a_start < a_end and b_start < b_end and a[a_start] == b[b_start]:
+            matched[b_start] = True
+            a_start += 1
+            b_start += 1
+        while a_start < a_end and b_start < b_end and a[a_end - 1] == b[b_end - 1]:
+            a_end -= 1
+            b_end -= 1
+            matched[b_end] = True
+        if a_start == a_end or b_start == b_end:
+            continue
+        anchors = _unique_anchors(a, b, a_start, a_end, b_start, b_end)
+        if not anchors:
+            _myers(a, b, a_start, a_end, b_start, b_end, matched)
+            continue
+        previous_a, previous_b = a_start, b_start
+        for i, j in anchors:
+            matched[j] = True
+            ranges.append((previous_a, i, previous_b, j))
+            previous_a, previous_b = i + 1, j + 1
+        ranges.append((previous_a, a_end, previous_b, b_end))
+    return matched
+
+
+def _unique_anchors(a: List[int], b: List[int], a_start: int, a_end: int, b_start: int, b_end: int) -> List[Tuple[int, int]]:
+    # The ids appearing exactly once in both ranges, paired in the longest order-preserving chain
+    positions_a = {}
+    for i in range(a_start, a_end):
+        positions_a[a[i]] = -1 if a[i] in positions_a else i
+    counts_b = {}
+    for j in range(b_start, b_end):
+        counts_b[b[j]] = counts_b.get(b[j], 0) + 1
+    pairs = [
+        (positions_a[b[j]], j) for j in range(b_start, b_end)
+        if counts_b[b[j]] == 1 and positions_a.get(b[j], -1) >= 0
+    ]
+    if not pairs:
+        return []
+    # Longest increasing subsequence of the positions in a (the pairs are in b order)
+    tails, tail_pairs, previous = [], [], [None] * len(pairs)
+    for index, (i, _) in enumerate(pairs):
+        length = bisect_left(tails, i)
+        previous[index] = tail_pairs[length - 1] if length else None
+        if length == len(tails):
+            tails.append(i)
+            tail_pairs.append(index)
+        else:
+            tails[length] = i
+            tail_pairs[length] = index
+    chain = []
+    index = tail_pairs[-1]
+    while index is not None:
+        chain.append(pairs[index])
+        index = previous[index]
+    return chain[::-1]
+
+
+def _myers(a: List[int], b: List[int], a_start: int, a_end: int, b_start: int, b_end: int, matched: List[bool]) -> None:
+    # Myers' greedy algorithm: the furthest x reached on each diagonal k = x - y with d edits, kept for every d to backtrack
+    n, m = a_end - a_start, b_end - b_start
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+    for d in range(n + m + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_start + x] == b[b_start + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                trace.append(v[offset - d:offset + d + 1:2])
+                _backtrack(trace, n, m, b_start, matched)
+                return
+        # The x of the diagonals -d, -d + 2, ..., d
+        trace.append(v[offset - d:offset + d + 1:2])
+
+
+def _backtrack(trace: List[List[int]], x: int, y: int, b_start: int, matched: List[bool]) -> None:
+    for d in range(len(trace) - 1, 0, -1):
+        k = x - y
+        previous = trace[d - 1]
+        if k == -d or (k != d and previous[(k - 1 + d - 1) // 2] < previous[(k + 1 + d - 1) // 2]):
+            # Down from diagonal k + 1: b[y - 1] was added
+            previous_k = k + 1
+            previous_x = previous[(previous_k + d - 1) // 2]
+            start_x = previous_x
+        else:
+            # Right from diagonal k - 1: a[x - 1] was removed
+            previous_k = k - 1
+            previous_x = previous[(previous_k + d - 1) // 2]
+            start_x = previous_x + 1
+        # The snake after the edit is made of matches
+        while x > start_x:
+            x -= 1
+            y -= 1
+            matched[b_start + y] = True
+        x, y = previous_x, previous_x - previous_k
+    # The snake of d = 0
+    while x > 0:
+        x -= 1
+        y -= 1
+        matched[b_start + y] = True
@@ -0,0 +1,149 @@
+# Memoized tokenizer for the request path of the backend.
+# gensim preprocess_string works on whitespace-separated words: every filter after strip_tags (lowercasing, punctuation,
+# numbers, stopwords, short tokens, stemming) only looks inside a word, so the tokens of a text are the tokens of its words,
+# in order. Recipes reuse a small vocabulary, so the tokens of each word are computed once and memoized, and a single pass
+# over the words gives the tokens for rule extraction, the fulfilled rules of a generated recipe and the word annotations
+# of the frontend.
+
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Tuple, Dict, Set, Iterable
+from gensim.parsing.preprocessing import preprocess_string, RE_TAGS
+
+_WORD_RE = re.compile(r'\S+')
+_SPACE_RE = re.compile(r'\s')
+
+
+@dataclass
+class TokenizedText:
+    """
+        The tokens of a text with the words they come from.
+
+        Attributes:
+            - text: The text.
+            - tokens: The tokens, the same as preprocess_string(text).
+            - words: The whitespace-separated words of the text, as the frontend splits them.
+            - word_indexes: For each token, the index of its word in words.
+            - spans: For each token, the (start, end) character offsets of its word in the text.
+    """
+    text: str
+    tokens: List[str]
+    words: List[str]
+    word_indexes: List[int]
+    spans: List[Tuple[int, int]]
+
+    @property
+    def token_set(self) -> Set[str]:
+        return set(self.tokens)
+
+    def annotations(self, stems: Iterable[str] | None = None) -> Dict[str, List[Tuple[str, int]]]:
+        """
+            Returns the annotations of the frontend (BackendResponse.annotations):
+            {non-stemmed word: [(stemmed word, word index), ...]}
+
+            Inputs:
+                - stems: Only annotate the words with one of these tokens (e.g. the tokens of the suggested rules). Default is None, i.e. every word.
+        """
+        stems = set(stems) if stems is not None else None
+        annotations = {}
+        for token, word_index in zip(self.tokens, self.word_indexes):
+            if stems is None or token in stems:
+                annotations.setdefault(self.words[word_index], []).append((token, word_index))
+        return annotations
+
+
+class RecipeTokenizer:
+    """
+        preprocess_string with a bounded memo of the tokens of each word, shared by every request.
+        Can be called like preprocess_string: tokenizer(text) returns the list of tokens.
+
+        Inputs:
+            - max_words: The maximum number of memoized words, the least recently used ones are evicted first.
+    """
+    def __init__(self, max_words: int = 200_000):
+        self.max_words = max_words
+        self.hits = 0
+        self.misses = 0
+        # Texts with a tag spanning several words, which are tokenized as a whole
+        self.fallbacks = 0
+        self._memo: OrderedDict[str, Tuple[str, ...]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> List[str]:
+        return self.tokenize(text).tokens
+
+    def word_tokens(self, word: str) -> Tuple[str, ...]:
+        """
+            Returns the tokens of a single word, i.e. preprocess_string(word), from the memo if possible.
+        """
+        with self._lock:
+            tokens = self._memo.get(word)
+            if tokens is not None:
+                self._memo.move_to_end(word)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+        tokens = tuple(preprocess_string(word))
+        with self._lock:
+            self._memo[word] = tokens
+            if len(self._memo) > self.max_words:
+                self._memo.popitem(last=False)
+        return tokens
+
+    def tokenize(self, text: str) -> TokenizedText:
+        """
+            Tokenizes a text in a single pass over its words.
+
+            Output:
+                - The tokens with their words, type: TokenizedText
+        """
+        words, word_indexes, spans, tokens = [], [], [], []
+        for word_index, match in enumerate(_WORD_RE.finditer(text)):
+            words.append(match.group())
+            for token in self.word_tokens(match.group()):
+                tokens.append(token)
+                word_indexes.append(word_index)
+                spans.append(match.span())
+        if any(_SPACE_RE.search(tag.group()) for tag in RE_TAGS.finditer(text)):
+            # strip_tags removes '<...>' even across words, which the per-word tokens can't do: the tokens of the whole text
+            # are used, each matched to the next word that has it (or to the previous word if none has)
+            self.fallbacks += 1
+            whole = preprocess_string(text)
+            position = 0
+            aligned_indexes, aligned_spans = [], []
+            for token in whole:
+                match = next((i for i in range(position, len(tokens)) if tokens[i] == token), None)
+                if match is not None:
+                    position = match + 1
+                aligned = match if match is not None else max(position - 1, 0)
+                aligned_indexes.append(word_indexes[aligned] if word_indexes else 0)
+                aligned_spans.append(spans[aligned] if spans else (0, 0))
+            tokens, word_indexes, spans = whole, aligned_indexes, aligned_spans
+        return TokenizedText(text, tokens, words, word_indexes, spans)
+
+    def stats(self) -> Dict[str, float]:
+        """
+            Returns the hit/miss counters of the memo, the hit rate, the number of memoized words and of fallbacks.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'words': len(self._memo),
+            'fallbacks': self.fallbacks,
+        }
+
+
+_default_tokenizer: RecipeTokenizer | None = None
+
+def default_tokenizer() -> RecipeTokenizer:
+    """
+        Returns the tokenizer shared by the whole process.
+    """
+    global _default_tokenizer
+    if _default_tokenizer is None:
+        _default_tokenizer = RecipeTokenizer()
+    return _default_tokenizer
@@ -0,0 +1,239 @@
+# Central scheduler for the requests sent to the OpenAI API.
+# It keeps the requests within the requests-per-minute and tokens-per-minute limits of the account,
+# bounds the number of requests in flight, and retries the transient errors with exponential backoff.
+
+import asyncio
+import inspect
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Callable
+from urllib.error import HTTPError
+import openai
+
+# Rough number of characters per token for English text, used to estimate the cost of a request before sending it
+CHARS_PER_TOKEN = 4
+# Tokens added by the chat format for every message
+TOKENS_PER_MESSAGE = 4
+
+
+def estimate_tokens(prompt: str | List[Dict[str, str]], completion_tokens: int = 500) -> int:
+    """
+        Estimates the number of tokens a request will use, without a tokenizer.
+
+        Inputs:
+            - prompt: The prompt, or the list of messages sent.
+            - completion_tokens: The expected length of the answer. Default is 500 (about the length of a rewritten recipe).
+
+        Output:
+            - The estimated number of tokens, prompt and answer included.
+    """
+    if isinstance(prompt, str):
+        prompt = [{'role': 'user', 'content': prompt}]
+    prompt_tokens = sum(len(message['content']) // CHARS_PER_TOKEN + TOKENS_PER_MESSAGE for message in prompt)
+    return prompt_tokens + completion_tokens
+
+
+class TokenBucket:
+    """
+        A token bucket refilled continuously at per_minute units per minute, holding at most capacity units.
+
+        Reservations are taken immediately and the level may go negative: the caller then waits until the
+        level is back to zero. This serves the callers in the order they reserved, and requests larger than
+        the capacity still go through (after a longer wait).
+    """
+    def __init__(self, per_minute: float, capacity: float | None = None):
+        self.rate = per_minute / 60
+        self.capacity = capacity if capacity is not None else per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+            Takes amount units out of the bucket and returns how many seconds to wait before using them.
+        """
+        self._refill()
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        """
+            Corrects a reservation once the real cost is known (positive amount: more was used than reserved).
+        """
+        self._refill()
+        self.level -= amount
+
+
+class RequestScheduler:
+    """
+        Runs the requests under token-bucket budgets for requests and tokens, with a global concurrency limit.
+
+        A request is any function sending one request to the API: a coroutine function (e.g. prompt_gpt_async)
+        or a regular function (e.g. prompt_gpt), which is run in a thread. Transient errors (rate limits, timeouts,
+        connection errors, 5xx) are retried with exponential backoff and full jitter; when the API answers with a
+        Retry-After header it is honored, and a 429 pauses every request of the scheduler, not only the failed one.
+
+        Inputs:
+            - requests_per_minute: The requests per minute limit of the account.
+            - tokens_per_minute: The tokens per minute limit of the account.
+            - max_concurrency: The maximum number of requests in flight.
+            - max_retries: The number of times a request is retried before the error is raised.
+            - base_delay: The backoff delay of the first retry, in seconds. It doubles with every retry.
+            - max_delay: The maximum backoff delay, in seconds.
+    """
+    def __init__(
+        self,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 40_000,
+        max_concurrency: int = 16,
+        max_retries: int = 8,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._semaphore: asyncio.Semaphore | None = None
+        self._semaphore_loop: asyncio.AbstractEventLoop | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        # Every request waits until this time (time.monotonic()) after a 429
+        self._paused_until = 0.0
+        self.counters = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'failed': 0, 'tokens': 0}
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Created lazily, so that the scheduler can be created outside of the event loop. A semaphore is bound to the loop
+        # it is used in, so a new one is created for every loop (e.g. successive parallel_process calls, each in its own asyncio.run)
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        return self._executor
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def run(self, function: Callable, *args, estimated_tokens: int = 1000, **kwargs) -> Any:
+        """
+            Runs function(*args, **kwargs) once the budgets allow it, retrying the transient errors.
+
+            Inputs:
+                - function: The function sending the request, a coroutine function or a regular function.
+                - estimated_tokens: The estimated tokens of the request (see estimate_tokens). The budget is corrected
+                  with the real usage if the function returns an OpenAI response.
+                - args, kwargs: The arguments of the function.
+
+            Output:
+                - What the function returns.
+        """
+        attempt = 0
+        while True:
+            async with self.semaphore:
+                await self._wait_for_budget(estimated_tokens)
+                try:
+                    self.counters['requests'] += 1
+                    if inspect.iscoroutinefunction(function):
+                        response = await function(*args, **kwargs)
+                    else:
+                        loop = asyncio.get_running_loop()
+                        response = await loop.run_in_executor(self.executor, lambda: function(*args, **kwargs))
+                    self._record_usage(response, estimated_tokens)
+                    return response
+                except Exception as e:
+                    if not _is_transient(e) or attempt >= self.max_retries:
+                        self.counters['failed'] += 1
+                        raise
+                    delay = self._backoff(e, attempt)
+            # The semaphore is released while waiting, so that other requests can go on
+            self.counters['retries'] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _wait_for_budget(self, estimated_tokens: int) -> None:
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        wait = max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _record_usage(self, response: Any, estimated_tokens: int) -> None:
+        usage = getattr(response, 'usage', None) or (response.get('usage') if isinstance(response, dict) else None)
+        if usage is None:
+            return
+        used = usage.get('total_tokens', estimated_tokens)
+        self.counters['tokens'] += used
+        self.tokens.adjust(used - estimated_tokens)
+
+    def _backoff(self, error: Exception, attempt: int) -> float:
+        retry_after = _retry_after(error)
+        if retry_after is None:
+            # Exponential backoff with full jitter
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        else:
+            delay = retry_after
+        if isinstance(error, openai.error.RateLimitError) or _status(error) == 429:
+            self.counters['rate_limited'] += 1
+            # Pause every request, otherwise the requests in the queue would hit the limit too
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters)
+
+
+def _status(error: Exception) -> int | None:
+    if isinstance(error, HTTPError):
+        return error.code
+    return getattr(error, 'http_status', None)
+
+
+def _is_transient(error: Exception) -> bool:
+    if isinstance(error, (
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.APIConnectionError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+        ConnectionError,
+        asyncio.TimeoutError,
+    )):
+        return True
+    status = _status(error)
+    if isinstance(error, (openai.error.APIError, HTTPError)):
+        return status is None or status == 429 or status >= 500
+    return False
+
+
+def _retry_after(error: Exception) -> float | None:
+    # The header may be in a case-sensitive dict (e.g. the headers of AsyncGptClient errors)
+    headers = getattr(error, 'headers', None) or {}
+    for name in ('retry-after-ms', 'Retry-After-Ms'):
+        if headers.get(name) is not None:
+            try:
+                return float(headers[name]) / 1000
+            except ValueError:
+                pass
+    for name in ('retry-after', 'Retry-After'):
+        if headers.get(name) is not None:
+            try:
+                return float(headers[name])
+            except ValueError:
+                pass
+    return None
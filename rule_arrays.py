@@ -0,0 +1,267 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import List, Tuple, Set, FrozenSet, Dict, Iterable, Iterator
+import numpy as np
+import scipy.sparse as sp
+from rule_index import RuleIndex, _subset_matrix
+
+# Rule tables and tokenized corpora as flat arrays in .npy files, so that the worker processes of a pool can
+# np.load(mmap_mode='r') them: every worker then reads the same pages of the page cache, instead of holding its own
+# copy of the rules (and of the recipes) pickled into every task.
+
+
+@dataclass
+class RuleArrays:
+    """
+        The arrays extract_rules_shared needs, all memory-mapped. Rule i is the rule i of the RuleIndex the arrays were written from.
+
+        Attributes:
+            - path: The directory of the arrays.
+            - tokens: The vocabulary, token id -> token.
+            - antecedents: token x rule binary matrix, built on the memory-mapped CSC arrays without copying them.
+            - antecedent_lengths: The number of tokens of each antecedent.
+            - consequents, consequent_lengths: Same as above, for the consequents.
+            - consequent_text_offsets, consequent_text: The utf-8 encoded consequent strings.
+            - suggestion_keys: See RuleIndex.suggestion_keys.
+            - antecedent_keys: An id for the set of antecedents of each rule, rules with the same antecedents have the same id.
+            - metrics: The value of each metric for each rule.
+            - ranks: For each metric, the position of each rule when sorted by the metric in descending order.
+            - orders: For each metric, the rules sorted by the metric in descending order (the inverse of ranks).
+    """
+    path: str
+    tokens: List[str]
+    antecedents: sp.csc_matrix
+    antecedent_lengths: np.ndarray
+    consequents: sp.csc_matrix
+    consequent_lengths: np.ndarray
+    consequent_text_offsets: np.ndarray
+    consequent_text: np.ndarray
+    suggestion_keys: np.ndarray
+    antecedent_keys: np.ndarray
+    metrics: Dict[str, np.ndarray]
+    ranks: Dict[str, np.ndarray]
+    orders: Dict[str, np.ndarray]
+
+    def consequent_string(self, rule_id: int) -> str:
+        start, end = self.consequent_text_offsets[rule_id], self.consequent_text_offsets[rule_id + 1]
+        return self.consequent_text[start:end].tobytes().decode('utf-8')
+
+    def decode(self, ids: Iterable[int]) -> FrozenSet[str]:
+        return frozenset(self.tokens[i] for i in ids)
+
+    def antecedent_tokens(self, rule_id: int) -> List[str]:
+        return [self.tokens[i] for i in self.antecedents.indices[self.antecedents.indptr[rule_id]:self.antecedents.indptr[rule_id + 1]].tolist()]
+
+
+class SharedRuleView:
+    """
+        The rules of memory-mapped RuleArrays sorted by a metric, for the extractors that iterate over a rules DataFrame
+        (e.g. helper.extract_rules): iterrows yields the rows one at a time, built from the arrays, so nothing is copied.
+        A row has the 'antecedents' (a list of tokens), the 'consequents' (the string of the csv) and the metrics of the arrays,
+        as in the DataFrame of load_rule_data. Only iterrows and len are supported.
+    """
+    def __init__(self, arrays: RuleArrays, metric: str):
+        self.arrays = arrays
+        self.metric = metric
+
+    def __len__(self) -> int:
+        return len(self.arrays.antecedent_lengths)
+
+    def iterrows(self) -> Iterator[Tuple[int, Dict[str, object]]]:
+        arrays = self.arrays
+        for rule_id in arrays.orders[self.metric]:
+            rule_id = int(rule_id)
+            row = {'antecedents': arrays.antecedent_tokens(rule_id), 'consequents': arrays.consequent_string(rule_id)}
+            for metric, values in arrays.metrics.items():
+                row[metric] = values[rule_id]
+            yield rule_id, row
+
+
+def write_rule_arrays(index: RuleIndex, metrics: List[str], path: str) -> str:
+    """
+        Writes the arrays of a RuleIndex, with the rankings of the given metrics, to a directory (created if needed).
+
+        Inputs:
+            - index: A RuleIndex (RuleIndex.from_dataframe or RuleIndex.from_store).
+            - metrics: The metrics the rules will be sorted by.
+            - path: The directory to write the arrays to.
+
+        Output:
+            - path
+    """
+    os.makedirs(path, exist_ok=True)
+    _save_itemsets(path, 'antecedent', index.antecedents, len(index.tokens))
+    _save_itemsets(path, 'consequent', index.consequents, len(index.tokens))
+    text = [consequent.encode('utf-8') for consequent in index.consequent_strings]
+    np.save(os.path.join(path, 'consequent_text_offsets.npy'), np.cumsum([0] + [len(x) for x in text], dtype=np.int64))
+    np.save(os.path.join(path, 'consequent_text.npy'), np.frombuffer(b''.join(text), dtype=np.uint8))
+    np.save(os.path.join(path, 'suggestion_keys.npy'), np.asarray(index.suggestion_keys, dtype=np.int64))
+    antecedent_keys = {}
+    np.save(os.path.join(path, 'antecedent_keys.npy'), np.array(
+        [antecedent_keys.setdefault(frozenset(antecedent), len(antecedent_keys)) for antecedent in index.antecedents],
+        dtype=np.int64,
+    ))
+    for metric in metrics:
+        np.save(os.path.join(path, f'metric_{metric}.npy'), np.asarray(index.metric_values[metric], dtype=np.float64))
+        order = np.asarray(index.order(metric), dtype=np.int64)
+        ranks = np.empty(len(index), dtype=np.int64)
+        ranks[order] = np.arange(len(index))
+        np.save(os.path.join(path, f'rank_{metric}.npy'), ranks)
+        np.save(os.path.join(path, f'order_{metric}.npy'), order)
+    with open(os.path.join(path, 'arrays.json'), 'w') as f:
+        json.dump({'tokens': index.tokens, 'metrics': metrics}, f)
+    return path
+
+
+def load_rule_arrays(path: str) -> RuleArrays:
+    """
+        Memory-maps the arrays written by write_rule_arrays. Nothing is copied, loading is almost free.
+    """
+    with open(os.path.join(path, 'arrays.json')) as f:
+        meta = json.load(f)
+
+    def load(name: str) -> np.ndarray:
+        return np.load(os.path.join(path, name), mmap_mode='r', allow_pickle=False)
+
+    return RuleArrays(
+        path=path,
+        tokens=meta['tokens'],
+        antecedents=_load_itemsets(load, 'antecedent', len(meta['tokens'])),
+        antecedent_lengths=load('antecedent_lengths.npy'),
+        consequents=_load_itemsets(load, 'consequent', len(meta['tokens'])),
+        consequent_lengths=load('consequent_lengths.npy'),
+        consequent_text_offsets=load('consequent_text_offsets.npy'),
+        consequent_text=load('consequent_text.npy'),
+        suggestion_keys=load('suggestion_keys.npy'),
+        antecedent_keys=load('antecedent_keys.npy'),
+        metrics={metric: load(f'metric_{metric}.npy') for metric in meta['metrics']},
+        ranks={metric: load(f'rank_{metric}.npy') for metric in meta['metrics']},
+        orders={metric: load(f'order_{metric}.npy') for metric in meta['metrics']},
+    )
+
+
+def write_corpus(recipes: List[List[str]], index: RuleIndex, path: str) -> str:
+    """
+        Writes the tokenized recipes, encoded with the vocabulary of the rules, as the CSR arrays of a recipe x token matrix.
+        Tokens that are in no rule are dropped, they can't change the extracted rules.
+
+        Inputs:
+            - recipes: A list of recipes, each a list of tokens (i.e. preprocessed using gensim preprocess_string)
+            - index: The RuleIndex the rule arrays were written from.
+            - path: The directory to write the arrays to.
+
+        Output:
+            - path
+    """
+    os.makedirs(path, exist_ok=True)
+    encoded = [sorted(index.encode(recipe)) for recipe in recipes]
+    offsets = np.cumsum([0] + [len(recipe) for recipe in encoded], dtype=np.int64)
+    dtype = _index_dtype(max(offsets[-1], len(index.tokens)))
+    np.save(os.path.join(path, 'corpus_offsets.npy'), offsets.astype(dtype))
+    np.save(os.path.join(path, 'corpus_ids.npy'), np.fromiter((i for recipe in encoded for i in recipe), dtype=dtype, count=offsets[-1]))
+    np.save(os.path.join(path, 'corpus_data.npy'), np.ones(offsets[-1], dtype=np.int32))
+    with open(os.path.join(path, 'corpus.json'), 'w') as f:
+        json.dump({'n_recipes': len(recipes), 'n_tokens': len(index.tokens)}, f)
+    return path
+
+
+def load_corpus(path: str) -> sp.csr_matrix:
+    """
+        Returns the recipe x token matrix written by write_corpus, on top of the memory-mapped arrays.
+    """
+    with open(os.path.join(path, 'corpus.json')) as f:
+        meta = json.load(f)
+
+    def load(name: str) -> np.ndarray:
+        return np.load(os.path.join(path, name), mmap_mode='r', allow_pickle=False)
+
+    return _csr_view(load('corpus_data.npy'), load('corpus_ids.npy'), load('corpus_offsets.npy'), (meta['n_recipes'], meta['n_tokens']))
+
+
+def corpus_tokens(arrays: RuleArrays, recipes: sp.csr_matrix) -> List[List[str]]:
+    """
+        Decodes rows of the recipe x token matrix returned by load_corpus back to lists of tokens. Only the tokens that are
+        in a rule were written, the others can't change the extracted rules.
+    """
+    return [[arrays.tokens[i] for i in recipes.indices[recipes.indptr[row]:recipes.indptr[row + 1]].tolist()] for row in range(recipes.shape[0])]
+
+
+def extract_rules_shared(
+    arrays: RuleArrays,
+    recipes: sp.csr_matrix,
+    rule_count: int = 3,
+    metric: str = 'lift',
+) -> List[Tuple[Set[FrozenSet[str]], Dict[FrozenSet[str], Tuple[str, float]]]]:
+    """
+        The same as extract_rules_batch, but on memory-mapped arrays: the rules are kept in the order they were written,
+        and the candidate rules of each recipe are sorted by their rank for the metric instead.
+
+        Input:
+            - arrays: The rule arrays, as returned by load_rule_arrays.
+            - recipes: Rows of the recipe x token matrix returned by load_corpus (e.g. corpus[start:end]).
+            - rule_count: The number of rules to be extracted for each recipe
+            - metric: The metric to sort the rules by.
+
+        Output:
+            - A list with one (fulfilled_rules, suggestions) tuple per recipe, as returned by extract_rules.
+    """
+    fulfilled = _subset_matrix(recipes, arrays.antecedents, arrays.antecedent_lengths)
+    already_in_recipe = _subset_matrix(recipes, arrays.consequents, arrays.consequent_lengths)
+    candidates = (fulfilled - fulfilled.multiply(already_in_recipe)).tocsr()
+    candidates.eliminate_zeros()
+    ranks = arrays.ranks[metric]
+    values = arrays.metrics[metric]
+    results = []
+    for row in range(recipes.shape[0]):
+        rule_ids = candidates.indices[candidates.indptr[row]:candidates.indptr[row + 1]]
+        rule_ids = rule_ids[np.argsort(ranks[rule_ids])]
+        rules_to_return = set()
+        suggestions_to_return = dict()
+        already_suggested = set()
+        used_antecedents = set()
+        for rule_id in rule_ids.tolist():
+            suggestion_key = int(arrays.suggestion_keys[rule_id])
+            antecedent_key = int(arrays.antecedent_keys[rule_id])
+            if suggestion_key in already_suggested or antecedent_key in used_antecedents:
+                continue
+            antecedents = arrays.decode(arrays.antecedents.indices[arrays.antecedents.indptr[rule_id]:arrays.antecedents.indptr[rule_id + 1]])
+            rules_to_return.add(antecedents)
+            suggestions_to_return[antecedents] = (arrays.consequent_string(rule_id), float(values[rule_id]))
+            already_suggested.add(suggestion_key)
+            used_antecedents.add(antecedent_key)
+            if len(rules_to_return) == rule_count:
+                break
+        results.append((rules_to_return, suggestions_to_return))
+    return results
+
+
+def _index_dtype(max_value: int) -> type:
+    # scipy uses the same dtype for indptr and indices, so both are written with it to avoid a conversion (copy) when loading
+    return np.int32 if max_value < np.iinfo(np.int32).max else np.int64
+
+
+def _save_itemsets(path: str, name: str, itemsets: List[Iterable[int]], vocab_size: int) -> None:
+    lengths = np.array([len(itemset) for itemset in itemsets], dtype=np.int32)
+    offsets = np.zeros(len(itemsets) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    dtype = _index_dtype(max(offsets[-1], vocab_size))
+    np.save(os.path.join(path, f'{name}_offsets.npy'), offsets.astype(dtype))
+    np.save(os.path.join(path, f'{name}_ids.npy'), np.fromiter((i for itemset in itemsets for i in sorted(itemset)), dtype=dtype, count=offsets[-1]))
+    np.save(os.path.join(path, f'{name}_data.npy'), np.ones(offsets[-1], dtype=np.int32))
+    np.save(os.path.join(path, f'{name}_lengths.npy'), lengths)
+
+
+def _load_itemsets(load, name: str, vocab_size: int) -> sp.csc_matrix:
+    offsets = load(f'{name}_offsets.npy')
+    matrix = sp.csc_matrix((vocab_size, len(offsets) - 1), dtype=np.int32)
+    # Set the arrays directly, the constructor would check (and possibly copy) them
+    matrix.data, matrix.indices, matrix.indptr = load(f'{name}_data.npy'), load(f'{name}_ids.npy'), offsets
+    return matrix
+
+
+def _csr_view(data: np.ndarray, indices: np.ndarray, indptr: np.ndarray, shape: Tuple[int, int]) -> sp.csr_matrix:
+    matrix = sp.csr_matrix(shape, dtype=data.dtype)
+    matrix.data, matrix.indices, matrix.indptr = data, indices, indptr
+    return matrix
+
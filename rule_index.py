@@ -0,0 +1,408 @@
+import heapq
+import weakref
+from dataclasses import dataclass, field
+from typing import List, Tuple, Set, FrozenSet, Dict, Iterable, Iterator
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from rule_store import RuleStore, METRIC_COLUMNS, sort_order
+
+
+@dataclass
+class RuleIndex:
+    """
+        A compiled version of the rules DataFrame returned by load_rule_data.
+
+        Every token is interned to an integer id, and every rule is stored as a tuple of token ids.
+        Each rule is registered in the inverted index under a single "anchor" token of its antecedents
+        (the least frequent one), so that a recipe only ever visits the rules whose anchor it contains.
+
+        The rules themselves are stored once, independently of any metric. For each metric the index keeps
+        a permutation of the rules (precomputed in the rule store, or sorted once on first use) and posting lists
+        holding the positions of the rules in that permutation, so iterating over the merged posting lists
+        visits the candidate rules in exactly the same order as the DataFrame scan. Switching metric between two
+        calls only switches the permutation that is used.
+
+        Attributes:
+            - metric: The default metric to sort the rules by.
+            - tokens: The vocabulary, token id -> token.
+            - token_ids: The inverse vocabulary, token -> token id.
+            - antecedents: The antecedents of each rule as a tuple of token ids.
+            - consequents: The consequents of each rule as a frozenset of token ids.
+            - consequent_strings: The consequents of each rule as they appear in the csv (i.e. "frozenset({'word1', ...})")
+            - suggestion_keys: For each rule, an id for the key extract_rules uses to skip already suggested consequents.
+            - anchors: For each rule, the antecedent token id it is registered under in the posting lists.
+            - metric_values: The value of each metric column for each rule.
+            - orders: For each metric, the permutation that sorts the rules by the metric in descending order.
+    """
+    metric: str
+    tokens: List[str]
+    token_ids: Dict[str, int]
+    antecedents: List[Tuple[int, ...]]
+    consequents: List[FrozenSet[int]]
+    consequent_strings: List[str]
+    suggestion_keys: List[int]
+    anchors: List[int] = field(repr=False)
+    metric_values: Dict[str, np.ndarray] = field(repr=False)
+    orders: Dict[str, np.ndarray] = field(default_factory=dict, repr=False)
+    # metric -> (order as a list, anchor token id -> ascending list of positions in the order), built on first use
+    _rankings: Dict[str, Tuple[List[int], Dict[int, List[int]]]] = field(default_factory=dict, repr=False)
+    # metric -> sparse token x rule matrices used by extract_rules_batch, built on first use
+    _matrices: Dict[str, '_RuleMatrices'] = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_dataframe(cls, rules: pd.DataFrame, metric: str = 'lift') -> 'RuleIndex':
+        """
+            This function compiles the rules DataFrame into a RuleIndex.
+
+            Inputs:
+                - rules: A pd.DataFrame with columns: ['antecedents', 'consequents', metric], e.g. as returned by load_rule_data.
+                         If it is sorted by the metric, ties keep the order of the DataFrame (as in the extract_rules scan),
+                         otherwise the rules are sorted by the metric like rules.sort_values(metric, ascending=False).
+                - metric: The default metric to sort the rules by. Default is 'lift'
+
+            Output:
+                - A RuleIndex, the rule ids are the positions in the DataFrame.
+        """
+        tokens = []
+        token_ids = {}
+
+        def intern(token: str) -> int:
+            if token not in token_ids:
+                token_ids[token] = len(tokens)
+                tokens.append(token)
+            return token_ids[token]
+
+        antecedents = []
+        consequents = []
+        # Parse each distinct consequent string only once
+        parsed_consequents = {}
+        for antecedent, consequent in zip(rules['antecedents'], rules['consequents']):
+            antecedents.append(tuple(intern(token) for token in antecedent))
+            if consequent not in parsed_consequents:
+                parsed_consequents[consequent] = frozenset(intern(token) for token in eval(consequent))
+            consequents.append(parsed_consequents[consequent])
+
+        columns = [column for column in METRIC_COLUMNS if column in rules.columns]
+        if metric not in columns:
+            columns.append(metric)
+        metric_values = {column: rules[column].to_numpy(dtype=np.float64) for column in columns}
+        return cls(
+            metric=metric,
+            tokens=tokens,
+            token_ids=token_ids,
+            antecedents=antecedents,
+            consequents=consequents,
+            consequent_strings=rules['consequents'].tolist(),
+            suggestion_keys=_suggestion_keys(rules['consequents']),
+            anchors=_anchors(antecedents, len(tokens)),
+            metric_values=metric_values,
+            # A DataFrame that is already sorted by the metric is scanned in its own order, anything else is sorted on first use
+            orders={metric: np.arange(len(rules))} if _is_descending(metric_values[metric]) else {},
+        )
+
+    @classmethod
+    def from_store(cls, store: RuleStore, metric: str = 'lift') -> 'RuleIndex':
+        """
+            This function compiles a RuleStore (see rule_store.py) into a RuleIndex, without going through a DataFrame.
+            The metric values and the precomputed permutations of the store are used as they are, without copies.
+
+            Inputs:
+                - store: A RuleStore, as returned by load_rule_store.
+                - metric: The default metric to sort the rules by. Default is 'lift'
+
+            Output:
+                - A RuleIndex, with the rules in the order of the store.
+        """
+        antecedent_ids = store.antecedent_ids.tolist()
+        antecedent_offsets = store.antecedent_offsets.tolist()
+        consequent_ids = store.consequent_ids.tolist()
+        consequent_offsets = store.consequent_offsets.tolist()
+        consequent_strings = store.consequent_strings()
+
+        antecedents = [tuple(antecedent_ids[antecedent_offsets[i]:antecedent_offsets[i + 1]]) for i in range(len(store))]
+        return cls(
+            metric=metric,
+            tokens=list(store.tokens),
+            token_ids={token: i for i, token in enumerate(store.tokens)},
+            antecedents=antecedents,
+            consequents=[frozenset(consequent_ids[consequent_offsets[i]:consequent_offsets[i + 1]]) for i in range(len(store))],
+            consequent_strings=consequent_strings,
+            suggestion_keys=_suggestion_keys(consequent_strings),
+            anchors=_anchors(antecedents, len(store.tokens)),
+            metric_values=store.metrics,
+            orders=dict(store.orders),
+        )
+
+    def __len__(self) -> int:
+        return len(self.antecedents)
+
+    def order(self, metric: str | None = None) -> np.ndarray:
+        """
+            Returns the permutation that sorts the rules by the metric in descending order.
+        """
+        metric = metric or self.metric
+        if metric not in self.orders:
+            self.orders[metric] = sort_order(self.metric_values[metric])
+        return self.orders[metric]
+
+    def score(self, rule_id: int, metric: str | None = None) -> float:
+        """
+            Returns the value of the metric for a rule.
+        """
+        return float(self.metric_values[metric or self.metric][rule_id])
+
+    def encode(self, recipe: Iterable[str]) -> Set[int]:
+        """
+            Converts a list of tokens to the set of token ids. Tokens that do not appear in any rule are dropped.
+        """
+        return {self.token_ids[token] for token in recipe if token in self.token_ids}
+
+    def decode(self, ids: Iterable[int]) -> FrozenSet[str]:
+        """
+            Converts token ids back to a frozenset of tokens.
+        """
+        return frozenset(self.tokens[i] for i in ids)
+
+    def candidates(self, recipe_ids: Set[int], metric: str | None = None) -> Iterator[int]:
+        """
+            Yields, in metric order, the ids of the rules whose antecedents are a subset of the recipe.
+        """
+        order, postings = self._ranking(metric or self.metric)
+        lists = [postings[token] for token in recipe_ids if token in postings]
+        for position in heapq.merge(*lists):
+            rule_id = order[position]
+            if recipe_ids.issuperset(self.antecedents[rule_id]):
+                yield rule_id
+
+    def encode_batch(self, recipes: Iterable[Iterable[str]]) -> sp.csr_matrix:
+        """
+            Converts a list of recipes to a sparse binary recipe x token matrix.
+        """
+        indptr = [0]
+        indices = []
+        for recipe in recipes:
+            indices.extend(sorted(self.encode(recipe)))
+            indptr.append(len(indices))
+        data = np.ones(len(indices), dtype=np.int32)
+        return sp.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, len(self.tokens)))
+
+    def _rule_matrices(self, metric: str) -> '_RuleMatrices':
+        if metric not in self._matrices:
+            order, _ = self._ranking(metric)
+            antecedent_keys = {}
+            self._matrices[metric] = _RuleMatrices(
+                order=order,
+                antecedents=_token_matrix([self.antecedents[rule_id] for rule_id in order], len(self.tokens)),
+                antecedent_lengths=np.array([len(self.antecedents[rule_id]) for rule_id in order], dtype=np.int32),
+                consequents=_token_matrix([self.consequents[rule_id] for rule_id in order], len(self.tokens)),
+                consequent_lengths=np.array([len(self.consequents[rule_id]) for rule_id in order], dtype=np.int32),
+                antecedent_keys=[
+                    antecedent_keys.setdefault(frozenset(self.antecedents[rule_id]), len(antecedent_keys)) for rule_id in order
+                ],
+            )
+        return self._matrices[metric]
+
+    def _ranking(self, metric: str) -> Tuple[List[int], Dict[int, List[int]]]:
+        if metric not in self._rankings:
+            order = self.order(metric).tolist()
+            postings = {}
+            for position, rule_id in enumerate(order):
+                postings.setdefault(self.anchors[rule_id], []).append(position)
+            self._rankings[metric] = (order, postings)
+        return self._rankings[metric]
+
+
+@dataclass
+class _RuleMatrices:
+    # All the arrays are in metric order, i.e. column j is the rule order[j]
+    order: List[int]
+    antecedents: sp.csc_matrix
+    antecedent_lengths: np.ndarray
+    consequents: sp.csc_matrix
+    consequent_lengths: np.ndarray
+    antecedent_keys: List[int]
+
+
+def _is_descending(values: np.ndarray) -> bool:
+    # Sorted in descending order with the NaNs last, i.e. sort_order would only reorder ties
+    n_values = len(values) - int(np.isnan(values).sum())
+    head = values[:n_values]
+    return not np.isnan(head).any() and bool(np.all(head[:-1] >= head[1:]))
+
+
+def _token_matrix(itemsets: List[Iterable[int]], vocab_size: int) -> sp.csc_matrix:
+    # token x rule binary matrix, so that recipes @ matrix counts the tokens of each rule found in each recipe
+    indptr = [0]
+    indices = []
+    for itemset in itemsets:
+        indices.extend(itemset)
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.int32)
+    return sp.csc_matrix((data, indices, indptr), shape=(vocab_size, len(itemsets)))
+
+
+def _subset_matrix(recipes: sp.csr_matrix, itemsets: sp.csc_matrix, lengths: np.ndarray) -> sp.csr_matrix:
+    # (recipe, rule) is stored iff all the tokens of the rule's itemset are in the recipe
+    counts = (recipes @ itemsets).tocsr()
+    counts.data = (counts.data == lengths[counts.indices]).astype(np.int8)
+    counts.eliminate_zeros()
+    return counts
+
+
+def _suggestion_keys(consequent_strings: Iterable[str]) -> List[int]:
+    # extract_rules keeps track of frozenset(row['consequents']), i.e. the characters of the consequent string,
+    # to skip consequents that were already suggested. We intern the same keys so that the results are identical.
+    key_ids = {}
+    return [key_ids.setdefault(frozenset(consequent), len(key_ids)) for consequent in consequent_strings]
+
+
+def _anchors(antecedents: List[Tuple[int, ...]], vocab_size: int) -> List[int]:
+    # Count how many antecedents each token appears in
+    frequency = [0] * vocab_size
+    for antecedent in antecedents:
+        for token in antecedent:
+            frequency[token] += 1
+    # Register every rule under its rarest antecedent token, this keeps the posting lists short
+    return [min(antecedent, key=frequency.__getitem__) for antecedent in antecedents]
+
+
+# id of a compiled DataFrame -> (weak reference to the DataFrame, its RuleIndex), see compile_rules
+_compiled: Dict[int, Tuple[weakref.ref, RuleIndex]] = {}
+
+
+def compile_rules(rules: pd.DataFrame | RuleIndex, metric: str = 'lift') -> RuleIndex:
+    """
+        Returns the RuleIndex of the rules. A DataFrame is only compiled the first time it is given: until it is garbage
+        collected, the same DataFrame object returns the same RuleIndex in this process, so that functions called once per
+        chunk with the whole rules DataFrame (e.g. pipeline_chunk) do not compile it every time.
+        Do not modify a DataFrame after it was compiled. Across processes, compile the rules once and send the RuleIndex.
+
+        Inputs:
+            - rules: A RuleIndex, returned as is, or a rules DataFrame (see RuleIndex.from_dataframe).
+            - metric: The default metric of the RuleIndex compiled from a DataFrame. Default is 'lift'
+
+        Output:
+            - A RuleIndex
+    """
+    if isinstance(rules, RuleIndex):
+        return rules
+    key = id(rules)
+    cached = _compiled.get(key)
+    if cached is not None and cached[0]() is rules:
+        return cached[1]
+    index = RuleIndex.from_dataframe(rules, metric)
+    _compiled[key] = (weakref.ref(rules, lambda _: _compiled.pop(key, None)), index)
+    return index
+
+
+def extract_rules_from_index(
+    recipe: List[str],
+    index: RuleIndex,
+    rule_count: int = 3,
+    metric: str | None = None,
+) -> Tuple[Set[FrozenSet[str]], Dict[FrozenSet[str], Tuple[str, float]]]:
+    """
+        The RuleIndex version of extract_rules. Only the rules whose antecedents are in the recipe are visited,
+        in metric order, and the function stops as soon as it has found the required number of rules.
+
+        Input:
+            - recipe: A list of tokens (i.e. a recipe preprocessed using gensim preprocess_string)
+            - index: A RuleIndex
+            - rule_count: The number of rules to be extracted
+            - metric: The metric to sort the rules by. Default is the metric the index was built with.
+
+        Output:
+            - Two elements:
+                - A set of frozensets, each frozenset is a rule.
+                - A dictionary with the rules as keys and the tuple (consequents, metric value) as values.
+    """
+    metric = metric or index.metric
+    rules_to_return = set()
+    suggestions_to_return = dict()
+    already_suggested = set()
+    recipe_ids = index.encode(recipe)
+    for rule_id in index.candidates(recipe_ids, metric):
+        # Make sure the consequents are NOT in the recipe, and that they were not suggested already
+        if index.consequents[rule_id].issubset(recipe_ids) or index.suggestion_keys[rule_id] in already_suggested:
+            continue
+        antecedents = index.decode(index.antecedents[rule_id])
+        # We already have a suggestion with a higher metric value
+        if antecedents in suggestions_to_return:
+            continue
+        rules_to_return.add(antecedents)
+        suggestions_to_return[antecedents] = (index.consequent_strings[rule_id], index.score(rule_id, metric))
+        already_suggested.add(index.suggestion_keys[rule_id])
+        # Break if we have found the required number of rules
+        if len(rules_to_return) == rule_count:
+            break
+    return rules_to_return, suggestions_to_return
+
+
+def extract_rules_batch(
+    recipes: List[List[str]],
+    rules: pd.DataFrame | RuleIndex,
+    rule_count: int = 3,
+    metric: str | None = None,
+    batch_size: int = 256,
+) -> List[Tuple[Set[FrozenSet[str]], Dict[FrozenSet[str], Tuple[str, float]]]]:
+    """
+        The batched version of extract_rules, for scoring many recipes at once.
+
+        The recipes are encoded as a sparse recipe x token matrix, and the antecedents and consequents as sparse token x rule matrices.
+        Multiplying them counts, for every recipe/rule pair, how many tokens of the rule are in the recipe, which gives the
+        subset tests for all the pairs at once. Then, for each recipe, the rules are selected greedily in metric order with
+        the same semantics as extract_rules (skip consequents already in the recipe or already suggested, one suggestion per antecedent).
+
+        Input:
+            - recipes: A list of recipes, each a list of tokens (i.e. preprocessed using gensim preprocess_string)
+            - rules: A RuleIndex, or a rules DataFrame as returned by load_rule_data, compiled once per DataFrame (see compile_rules).
+            - rule_count: The number of rules to be extracted for each recipe
+            - metric: The metric to sort the rules by. Default is the metric of the RuleIndex, 'lift' for a DataFrame.
+            - batch_size: The number of recipes multiplied at once, bounds the memory used by the products.
+
+        Output:
+            - A list with one (fulfilled_rules, suggestions) tuple per recipe, as returned by extract_rules.
+    """
+    index = compile_rules(rules, metric or 'lift')
+    metric = metric or index.metric
+    matrices = index._rule_matrices(metric)
+    results = []
+    for start in range(0, len(recipes), batch_size):
+        encoded = index.encode_batch(recipes[start:start + batch_size])
+        fulfilled = _subset_matrix(encoded, matrices.antecedents, matrices.antecedent_lengths)
+        already_in_recipe = _subset_matrix(encoded, matrices.consequents, matrices.consequent_lengths)
+        # Rules that the recipe fulfills, whose consequents are not in the recipe
+        candidates = (fulfilled - fulfilled.multiply(already_in_recipe)).tocsr()
+        candidates.eliminate_zeros()
+        candidates.sort_indices()
+        for row in range(encoded.shape[0]):
+            positions = candidates.indices[candidates.indptr[row]:candidates.indptr[row + 1]]
+            results.append(_select_rules(index, matrices, positions.tolist(), rule_count, metric))
+    return results
+
+
+def _select_rules(
+    index: RuleIndex,
+    matrices: _RuleMatrices,
+    positions: List[int],
+    rule_count: int,
+    metric: str,
+) -> Tuple[Set[FrozenSet[str]], Dict[FrozenSet[str], Tuple[str, float]]]:
+    # Greedy top-k over the candidate rules of one recipe, in metric order
+    rules_to_return = set()
+    suggestions_to_return = dict()
+    already_suggested = set()
+    used_antecedents = set()
+    for position in positions:
+        rule_id = matrices.order[position]
+        if index.suggestion_keys[rule_id] in already_suggested or matrices.antecedent_keys[position] in used_antecedents:
+            continue
+        antecedents = index.decode(index.antecedents[rule_id])
+        rules_to_return.add(antecedents)
+        suggestions_to_return[antecedents] = (index.consequent_strings[rule_id], index.score(rule_id, metric))
+        already_suggested.add(index.suggestion_keys[rule_id])
+        used_antecedents.add(matrices.antecedent_keys[position])
+        if len(rules_to_return) == rule_count:
+            break
+    return rules_to_return, suggestions_to_return
@@ -0,0 +1,308 @@
+import ast
+import json
+import os
+import re
+import shutil
+from dataclasses import dataclass
+from typing import List, Dict, FrozenSet
+import numpy as np
+import pandas as pd
+
+# Bump this if the layout of the files below changes
+STORE_FORMAT = 'gelex-rule-store'
+STORE_VERSION = 1
+
+# Columns written by mlxtend's association_rules, in addition to antecedents and consequents
+METRIC_COLUMNS = [
+    'antecedent support',
+    'consequent support',
+    'support',
+    'confidence',
+    'lift',
+    'leverage',
+    'conviction',
+    'zhangs_metric',
+]
+
+# Metrics the rules can be sorted by, a permutation is precomputed for each of them
+ORDER_METRICS = ['lift', 'confidence', 'zhangs_metric', 'support', 'leverage', 'conviction']
+
+_FROZENSET_RE = re.compile(r'^\s*frozenset\((.*)\)\s*$', re.DOTALL)
+
+
+@dataclass
+class RuleStore:
+    """
+        The mined rules in a columnar, eval-free layout. A store is a directory containing:
+            - meta.json: The format version, the number of rules and the metric columns.
+            - vocab.json: The token vocabulary, token id -> token.
+            - antecedent_offsets.npy, antecedent_ids.npy: CSR arrays, the antecedents of rule i are antecedent_ids[antecedent_offsets[i]:antecedent_offsets[i+1]]
+            - consequent_offsets.npy, consequent_ids.npy: Same as above, for the consequents.
+            - consequent_text_offsets.npy, consequent_text.npy: The utf-8 encoded consequent strings of the csv (i.e. "frozenset({'word1', ...})"), so that the suggestions are the same as the csv ones.
+            - metric_<name>.npy: One float64 array per metric column.
+            - order_<name>.npy: For each metric in ORDER_METRICS, the permutation that sorts the rules by the metric in descending order.
+
+        The rules are kept in the order of the csv they were converted from. All the arrays are opened
+        with np.load(mmap_mode='r'), so processes loading the same store share the same pages.
+    """
+    path: str
+    tokens: List[str]
+    antecedent_offsets: np.ndarray
+    antecedent_ids: np.ndarray
+    consequent_offsets: np.ndarray
+    consequent_ids: np.ndarray
+    consequent_text_offsets: np.ndarray
+    consequent_text: np.ndarray
+    metrics: Dict[str, np.ndarray]
+    orders: Dict[str, np.ndarray]
+
+    def __len__(self) -> int:
+        return len(self.antecedent_offsets) - 1
+
+    def order(self, metric: str) -> np.ndarray:
+        """
+            Returns the permutation that sorts the rules by the metric in descending order. Precomputed permutations are
+            returned as is (no copy), any other metric column is sorted on the fly.
+        """
+        if metric in self.orders:
+            return self.orders[metric]
+        return sort_order(self.metrics[metric])
+
+    def antecedents(self, rule_id: int) -> np.ndarray:
+        return self.antecedent_ids[self.antecedent_offsets[rule_id]:self.antecedent_offsets[rule_id + 1]]
+
+    def consequents(self, rule_id: int) -> np.ndarray:
+        return self.consequent_ids[self.consequent_offsets[rule_id]:self.consequent_offsets[rule_id + 1]]
+
+    def consequent_string(self, rule_id: int) -> str:
+        start, end = self.consequent_text_offsets[rule_id], self.consequent_text_offsets[rule_id + 1]
+        return self.consequent_text[start:end].tobytes().decode('utf-8')
+
+    def consequent_strings(self) -> List[str]:
+        text = self.consequent_text.tobytes()
+        offsets = self.consequent_text_offsets.tolist()
+        return [text[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(self))]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+            Converts the store back to the DataFrame load_rule_data builds from the csv, i.e. with the antecedents
+            as lists of strings and the consequents as strings. The rules are in the order of the store.
+        """
+        tokens = self.tokens
+        ids = self.antecedent_ids.tolist()
+        offsets = self.antecedent_offsets.tolist()
+        df = pd.DataFrame({
+            'antecedents': [[tokens[t] for t in ids[offsets[i]:offsets[i + 1]]] for i in range(len(self))],
+            'consequents': self.consequent_strings(),
+        })
+        for column, values in self.metrics.items():
+            df[column] = np.asarray(values)
+        return df
+
+
+def sort_order(values: np.ndarray) -> np.ndarray:
+    """
+        Returns the permutation that sorts the values in descending order, NaNs last.
+        This is exactly the order of rules.sort_values(metric, ascending=False), ties included.
+    """
+    return pd.Series(values).sort_values(ascending=False).index.to_numpy(dtype=np.int64)
+
+
+def parse_frozenset(text: str) -> FrozenSet[str]:
+    """
+        Parses a string of the form "frozenset({'word1', 'word2'})" as written to the csv by mlxtend, without eval.
+    """
+    match = _FROZENSET_RE.match(text)
+    if match is None:
+        raise ValueError(f'Expected a string of the form "frozenset({{...}})", but got {text!r}')
+    items = ast.literal_eval(match.group(1)) if match.group(1).strip() else ()
+    if not all(isinstance(item, str) for item in items):
+        raise ValueError(f'Expected a frozenset of strings, but got {text!r}')
+    return frozenset(items)
+
+
+def convert_rule_data(filename: str = 'rules_recipe_scale.csv', store_path: str | None = None) -> str:
+    """
+        One-time conversion of a rules .csv (as written by mlxtend's association_rules) to a RuleStore directory.
+
+        Parameters:
+            filename (str): The name(and directory) of the csv file containing the rules. Default is 'rules_recipe_scale.csv'
+            store_path (str): The directory to write the store to. Default is the csv filename with a .rules extension.
+
+        Returns:
+            store_path (str): The directory the store was written to.
+    """
+    if store_path is None:
+        store_path = os.path.splitext(filename)[0] + '.rules'
+    rules = pd.read_csv(filename)
+
+    token_ids = {}
+    def encode(itemset: FrozenSet[str]) -> List[int]:
+        return [token_ids.setdefault(token, len(token_ids)) for token in sorted(itemset)]
+
+    antecedents = [encode(parse_frozenset(x)) for x in rules['antecedents']]
+    consequents = [encode(parse_frozenset(x)) for x in rules['consequents']]
+    consequent_text = [x.encode('utf-8') for x in rules['consequents']]
+    metrics = [column for column in METRIC_COLUMNS if column in rules.columns]
+
+    os.makedirs(store_path, exist_ok=True)
+    _save_csr(store_path, 'antecedent', antecedents)
+    _save_csr(store_path, 'consequent', consequents)
+    np.save(os.path.join(store_path, 'consequent_text_offsets.npy'), _offsets([len(x) for x in consequent_text]))
+    np.save(os.path.join(store_path, 'consequent_text.npy'), np.frombuffer(b''.join(consequent_text), dtype=np.uint8))
+    for column in metrics:
+        np.save(os.path.join(store_path, _metric_filename(column)), rules[column].to_numpy(dtype=np.float64))
+    orders = [column for column in ORDER_METRICS if column in metrics]
+    for column in orders:
+        np.save(os.path.join(store_path, _order_filename(column)), sort_order(rules[column].to_numpy(dtype=np.float64)))
+    with open(os.path.join(store_path, 'vocab.json'), 'w') as f:
+        json.dump(list(token_ids), f)
+    # meta.json is written last, a store without it is incomplete
+    with open(os.path.join(store_path, 'meta.json'), 'w') as f:
+        json.dump({
+            'format': STORE_FORMAT,
+            'version': STORE_VERSION,
+            'n_rules': len(rules),
+            'metrics': metrics,
+            'orders': orders,
+        }, f)
+    return store_path
+
+
+def load_rule_store(store_path: str) -> RuleStore:
+    """
+        Loads a RuleStore written by convert_rule_data. The arrays are memory-mapped, so loading is almost free.
+        Nothing in the store is evaluated, and the arrays are checked to be consistent, so it is safe to load untrusted stores.
+
+        Parameters:
+            store_path (str): The directory of the store.
+
+        Returns:
+            store (RuleStore): The loaded rules.
+    """
+    with open(os.path.join(store_path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != STORE_FORMAT or meta.get('version') != STORE_VERSION:
+        raise ValueError(f'{store_path} is not a version {STORE_VERSION} rule store')
+    with open(os.path.join(store_path, 'vocab.json')) as f:
+        tokens = json.load(f)
+    if not isinstance(tokens, list) or not all(isinstance(token, str) for token in tokens):
+        raise ValueError(f'{store_path}/vocab.json should be a list of strings')
+
+    def load(name: str) -> np.ndarray:
+        return np.load(os.path.join(store_path, name), mmap_mode='r', allow_pickle=False)
+
+    # The names become file names, only the known columns are accepted (no path separators)
+    if not isinstance(meta.get('metrics'), list) or not all(column in METRIC_COLUMNS for column in meta['metrics']):
+        raise ValueError(f'{store_path}/meta.json has unknown metrics, expected some of {METRIC_COLUMNS}')
+    if not isinstance(meta.get('orders', []), list) or not all(column in ORDER_METRICS for column in meta.get('orders', [])):
+        raise ValueError(f'{store_path}/meta.json has unknown orders, expected some of {ORDER_METRICS}')
+    n_rules = meta['n_rules']
+    store = RuleStore(
+        path=store_path,
+        tokens=tokens,
+        antecedent_offsets=load('antecedent_offsets.npy'),
+        antecedent_ids=load('antecedent_ids.npy'),
+        consequent_offsets=load('consequent_offsets.npy'),
+        consequent_ids=load('consequent_ids.npy'),
+        consequent_text_offsets=load('consequent_text_offsets.npy'),
+        consequent_text=load('consequent_text.npy'),
+        metrics={column: load(_metric_filename(column)) for column in meta['metrics']},
+        orders={column: load(_order_filename(column)) for column in meta.get('orders', [])},
+    )
+    _check_csr(store.antecedent_offsets, store.antecedent_ids, n_rules, len(tokens), 'antecedent')
+    _check_csr(store.consequent_offsets, store.consequent_ids, n_rules, len(tokens), 'consequent')
+    _check_csr(store.consequent_text_offsets, store.consequent_text, n_rules, 256, 'consequent_text')
+    for column, values in store.metrics.items():
+        if values.shape != (n_rules,):
+            raise ValueError(f'Metric {column} has shape {values.shape}, expected ({n_rules},)')
+    for column, order in store.orders.items():
+        if order.shape != (n_rules,) or order.dtype.kind not in 'iu' or (n_rules and (order.min() < 0 or order.max() >= n_rules)):
+            raise ValueError(f'order_{column} is not a permutation of the rules')
+        if n_rules and np.bincount(order, minlength=n_rules).max() != 1:
+            raise ValueError(f'order_{column} is not a permutation of the rules')
+    return store
+
+
+def publish_rule_table(rules: pd.DataFrame, rules_dir: str, keep: int = 5) -> str:
+    """
+        Publishes a new version of the rules: the csv (as written by mlxtend, i.e. the format load_rule_data reads) and its store
+        are written to <rules_dir>/v<version>.csv and <rules_dir>/v<version>.rules, then the CURRENT file is switched to the new version.
+        CURRENT is replaced atomically, so readers (see helpers_for_backend.RuleTable) always see a complete version.
+
+        Parameters:
+            rules (pd.DataFrame): The rules, with the columns of mlxtend's association_rules (antecedents and consequents as frozensets).
+            rules_dir (str): The directory of the versions.
+            keep (int): The number of versions to keep (at least 1, the new one), older ones are deleted. Default is 5.
+
+        Returns:
+            version (str): The name of the new version, e.g. 'v000003'.
+    """
+    if keep < 1:
+        raise ValueError(f'keep should be at least 1, got {keep}')
+    os.makedirs(rules_dir, exist_ok=True)
+    versions = list_rule_versions(rules_dir)
+    version = f'v{int(versions[-1][1:]) + 1 if versions else 1:06d}'
+    csv_path = os.path.join(rules_dir, version + '.csv')
+    rules.to_csv(csv_path, index=False)
+    convert_rule_data(csv_path)
+    tmp_path = os.path.join(rules_dir, 'CURRENT.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(rules_dir, 'CURRENT'))
+    # Readers may still be loading the previous version, only the older ones are deleted
+    for old in (versions + [version])[:-keep]:
+        os.remove(os.path.join(rules_dir, old + '.csv'))
+        shutil.rmtree(os.path.join(rules_dir, old + '.rules'), ignore_errors=True)
+    return version
+
+
+def list_rule_versions(rules_dir: str) -> List[str]:
+    """
+        Returns the published versions in rules_dir, oldest first.
+    """
+    if not os.path.isdir(rules_dir):
+        return []
+    return sorted(name[:-len('.csv')] for name in os.listdir(rules_dir) if re.fullmatch(r'v\d{6}\.csv', name))
+
+
+def current_rule_version(rules_dir: str) -> str | None:
+    """
+        Returns the current version of rules_dir (see publish_rule_table), or None if nothing was published yet.
+    """
+    try:
+        with open(os.path.join(rules_dir, 'CURRENT')) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _metric_filename(column: str) -> str:
+    return 'metric_' + column.replace(' ', '_') + '.npy'
+
+
+def _order_filename(column: str) -> str:
+    return 'order_' + column.replace(' ', '_') + '.npy'
+
+
+def _offsets(lengths: List[int]) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _save_csr(store_path: str, name: str, rows: List[List[int]]) -> None:
+    np.save(os.path.join(store_path, f'{name}_offsets.npy'), _offsets([len(row) for row in rows]))
+    np.save(os.path.join(store_path, f'{name}_ids.npy'), np.fromiter((i for row in rows for i in row), dtype=np.int32))
+
+
+def _check_csr(offsets: np.ndarray, values: np.ndarray, n_rows: int, n_values: int, name: str) -> None:
+    # Every slice taken from the store is bounds-checked here once, instead of on every lookup
+    if offsets.ndim != 1 or values.ndim != 1 or len(offsets) != n_rows + 1:
+        raise ValueError(f'{name} arrays have the wrong shape')
+    if offsets.dtype.kind not in 'iu' or values.dtype.kind not in 'iu':
+        raise ValueError(f'{name} arrays should be integer arrays')
+    if offsets[0] != 0 or offsets[-1] != len(values) or np.any(np.diff(offsets) < 0):
+        raise ValueError(f'{name}_offsets is not a valid offset array')
+    if len(values) and (values.min() < 0 or values.max() >= n_values):
+        raise ValueError(f'{name} ids are out of range')
@@ -0,0 +1,525 @@
+# Asyncio backend of the web app (app/).
+# The frontend sends a BackendInput {user_recipe, number_of_rules, user_id} on the /ws/example WebSocket and gets a
+# BackendResponse {annotations, ing_seperated, example_recipe} back (see app/src/types/BackendTypes.d.ts), and posts the
+# results of the learners to /trace, which are buffered and written in batches (see trace_store).
+# The rule extraction runs in a thread pool, the GPT requests go through the RequestScheduler on the async client, so a
+# single process serves many learners at once: while one request waits for GPT, the event loop serves the others.
+# Identical submissions (same recipe, same number of rules) that arrive while the first one is running share its result.
+# The rules of every improvement level are extracted at once and kept per recipe, and the answers are kept as well: a learner
+# resubmitting the same recipe at another level skips the extraction, and with prefetch_levels the GPT requests of the
+# adjacent levels are sent in the background, so moving the improvement slider is answered from memory.
+#
+# Usage:
+#   OPENAI_APIKEY=... python server.py --rules rules_recipe_scale.rules --port 8000
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Callable, Awaitable, Hashable
+from aiohttp import web, WSMsgType
+import helpers_for_backend as hfb
+from gpt_client import AsyncGptClient
+from recipe_annotations import annotate
+from request_scheduler import RequestScheduler, estimate_tokens
+from trace_store import ParquetTraceSink, TraceWriteError
+
+# Bounds of the BackendInput, the frontend offers 1, 3, 5, 10 or 30 rules (hfb.RULE_COUNTS) and asks for at least 25 characters
+MIN_RECIPE_LENGTH = 25
+MAX_RECIPE_LENGTH = 20_000
+MAX_RULES = max(hfb.RULE_COUNTS)
+
+
+class InvalidInput(ValueError):
+    pass
+
+
+# The state of the application, see create_app. Plain string keys: web.AppKey needs aiohttp 3.9, requirements2.txt pins 3.8.5
+SERVICE = 'service'
+TRACES = 'traces'
+CLIENT = 'client'
+PING_INTERVAL = 'ping_interval'
+ALLOWED_ORIGIN = 'allowed_origin'
+
+
+class Coalescer:
+    """
+        Runs one task per key at a time: callers asking for a key whose task is still running wait for that task instead
+        of starting another one. The task is not cancelled when a caller goes away, the other callers still get its result.
+    """
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._tasks
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._tasks.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda task: self._done(key, task))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        self._tasks.pop(key, None)
+        # Retrieve the exception, in case every caller went away before the end
+        if not task.cancelled():
+            task.exception()
+
+
+class TraceBuffer:
+    """
+        Buffers the trace records and writes them in batches: when max_records are buffered, and at least every max_delay seconds.
+        The sink is called in a thread, with the list of records of a batch. If it has roll and close methods (e.g. a
+        trace_store.ParquetTraceSink), roll is called after every periodic flush and close when the buffer is closed.
+        If a write fails, its records (or only the ones it did not write) are kept for the next one, up to max_buffered records:
+        the oldest are dropped beyond. add does not raise when the write it triggers fails.
+    """
+    def __init__(
+        self,
+        sink: Callable[[List[Dict[str, Any]]], None],
+        max_records: int = 500,
+        max_delay: float = 2.0,
+        max_buffered: int = 100_000,
+    ):
+        self.sink = sink
+        self.max_records = max_records
+        self.max_delay = max_delay
+        self.max_buffered = max_buffered
+        self.records: List[Dict[str, Any]] = []
+        self.written = 0
+        self.dropped = 0
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    async def add(self, *records: Dict[str, Any]) -> None:
+        self.records.extend(records)
+        if len(self.records) >= self.max_records:
+            try:
+                await self.flush()
+            except Exception:
+                # The records are still buffered for the next write, the request that added them does not fail
+                traceback.print_exc()
+
+    async def _in_thread(self, function: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def flush(self) -> None:
+        # One write at a time, so that the batches are written in order
+        async with self._lock:
+            records, self.records = self.records, []
+            if not records:
+                return
+            try:
+                await self._in_thread(self.sink, records)
+            except BaseException as e:
+                # A sink that wrote part of the batch tells which records are left
+                left = e.records if isinstance(e, TraceWriteError) else records
+                self.written += len(records) - len(left)
+                self.records = left + self.records
+                if len(self.records) > self.max_buffered:
+                    self.dropped += len(self.records) - self.max_buffered
+                    self.records = self.records[-self.max_buffered:]
+                raise
+            self.written += len(records)
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.max_delay)
+            try:
+                await self.flush()
+                if hasattr(self.sink, 'roll'):
+                    async with self._lock:
+                        await self._in_thread(self.sink.roll)
+            except Exception:
+                traceback.print_exc()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        try:
+            await self.flush()
+        finally:
+            if hasattr(self.sink, 'close'):
+                async with self._lock:
+                    await self._in_thread(self.sink.close)
+
+
+def jsonl_sink(path: str) -> Callable[[List[Dict[str, Any]]], None]:
+    """
+        Returns a TraceBuffer sink appending the records to a json lines file, one write per batch.
+    """
+    def write(records: List[Dict[str, Any]]) -> None:
+        with open(path, 'a') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+    return write
+
+
+class ExampleService:
+    """
+        Generates the examples: tokenize the user recipe, extract the rules, prompt GPT and build the BackendResponse.
+
+        Inputs:
+            - rules: The rules, a RuleIndex or a RuleTable (see helpers_for_backend).
+            - model: The GPT model.
+            - scheduler: The RequestScheduler of the GPT requests.
+            - client: The AsyncGptClient the requests are sent with.
+            - metric: The metric the rules are sorted by. Default is 'lift'.
+            - timeout: The timeout of a GPT request in seconds.
+            - executor_workers: The number of threads for the rule extraction.
+            - levels: The numbers of rules of the improvement levels. Default is hfb.RULE_COUNTS.
+            - prefetch_levels: The number of levels on each side of a requested level whose examples are generated in the background.
+                               Default is 0, i.e. only the requested examples are generated.
+            - max_cached: The number of recipes whose rules are kept, and of examples kept.
+    """
+    def __init__(
+        self,
+        rules: Any,
+        model: str,
+        scheduler: RequestScheduler,
+        client: AsyncGptClient,
+        metric: str = 'lift',
+        timeout: float = 120.0,
+        executor_workers: int = 4,
+        levels: List[int] = hfb.RULE_COUNTS,
+        prefetch_levels: int = 0,
+        max_cached: int = 1024,
+    ):
+        self.rules = rules
+        self.model = model
+        self.scheduler = scheduler
+        self.client = client
+        self.metric = metric
+        self.timeout = timeout
+        self.levels = sorted(set(levels))
+        if self.levels[-1] < MAX_RULES:
+            raise ValueError(f'The largest level should have at least {MAX_RULES} rules, the other numbers of rules are derived from it')
+        self.prefetch_levels = prefetch_levels
+        self.max_cached = max_cached
+        self.executor = ThreadPoolExecutor(executor_workers)
+        self.coalescer = Coalescer()
+        self.extractions = Coalescer()
+        # (recipe hash, rules version) -> (tokenized recipe, rules of every level)
+        self._rule_levels: OrderedDict[Hashable, Any] = OrderedDict()
+        # (recipe hash, number of rules, rules version) -> BackendResponse
+        self._responses: OrderedDict[Hashable, Dict[str, Any]] = OrderedDict()
+        self._prefetching = set()
+        self.counters = {'requests': 0, 'failed': 0, 'cached': 0, 'prefetched': 0, 'prefetch_failed': 0}
+
+    def _rules_version(self) -> Any:
+        # A RuleTable swaps its rules when a new version is published, what was derived from the previous version is not reused
+        return getattr(self.rules, 'version', None)
+
+    async def example(self, recipe: str, number_of_rules: int) -> Dict[str, Any]:
+        """
+            Returns the BackendResponse for the recipe. Identical requests in flight share one run, and the responses
+            already generated (or prefetched) are returned from memory.
+        """
+        self.counters['requests'] += 1
+        digest = hashlib.sha256(recipe.encode('utf-8')).hexdigest()
+        key = (digest, number_of_rules, self._rules_version())
+        response = _lru_get(self._responses, key)
+        if response is not None:
+            self.counters['cached'] += 1
+        else:
+            try:
+                response = await self.coalescer.run(key, lambda: self._generate(recipe, digest, number_of_rules, key))
+            except Exception:
+                self.counters['failed'] += 1
+                raise
+        self._prefetch_around(recipe, digest, number_of_rules)
+        return response
+
+    def _extract(self, recipe: str):
+        original = hfb.tokenize_recipe(recipe)
+        return original, hfb.extract_rules_levels(original.tokens, self.rules, self.levels, self.metric)
+
+    async def _rules_of(self, recipe: str, digest: str, number_of_rules: int):
+        # The rules of every level are extracted once per recipe, by the first request for any of its levels
+        key = (digest, self._rules_version())
+        extracted = _lru_get(self._rule_levels, key)
+        if extracted is None:
+            loop = asyncio.get_running_loop()
+            extracted = await self.extractions.run(key, lambda: loop.run_in_executor(self.executor, self._extract, recipe))
+            _lru_put(self._rule_levels, key, extracted, self.max_cached)
+        original, levels = extracted
+        if number_of_rules in levels:
+            return original, levels[number_of_rules]
+        return original, hfb.top_rules(levels[self.levels[-1]][1], number_of_rules)
+
+    async def _generate(self, recipe: str, digest: str, number_of_rules: int, key: Hashable) -> Dict[str, Any]:
+        original, (fulfilled_rules, suggestions) = await self._rules_of(recipe, digest, number_of_rules)
+        prompt = hfb.create_prompt(recipe, fulfilled_rules, suggestions)
+        response = await self.scheduler.run(
+            hfb.prompt_gpt_async,
+            prompt=prompt,
+            model=self.model,
+            client=self.client,
+            timeout=self.timeout,
+            estimated_tokens=estimate_tokens(prompt),
+        )
+        answer = response.choices[0].message.content
+        tokenized = hfb.tokenize_recipe(hfb.recipe_text(answer))
+        response = annotate(original, tokenized, suggestions).backend_response()
+        _lru_put(self._responses, key, response, self.max_cached)
+        return response
+
+    def _prefetch_around(self, recipe: str, digest: str, number_of_rules: int) -> None:
+        if self.prefetch_levels <= 0 or number_of_rules not in self.levels:
+            return
+        position = self.levels.index(number_of_rules)
+        adjacent = self.levels[max(position - self.prefetch_levels, 0):position] + self.levels[position + 1:position + 1 + self.prefetch_levels]
+        for level in adjacent:
+            key = (digest, level, self._rules_version())
+            if key in self._responses or key in self.coalescer:
+                continue
+            task = asyncio.create_task(self._prefetch(recipe, digest, level, key))
+            self._prefetching.add(task)
+            task.add_done_callback(self._prefetching.discard)
+
+    async def _prefetch(self, recipe: str, digest: str, number_of_rules: int, key: Hashable) -> None:
+        # Goes through the coalescer, a learner asking for this level meanwhile waits for this run
+        try:
+            await self.coalescer.run(key, lambda: self._generate(recipe, digest, number_of_rules, key))
+            self.counters['prefetched'] += 1
+        except Exception as e:
+            self.counters['prefetch_failed'] += 1
+            print(f'Could not prefetch the example with {number_of_rules} rules: {e!r}')
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            'started': self.coalescer.started,
+            'coalesced': self.coalescer.coalesced,
+            'in_flight': len(self.coalescer),
+            'prefetching': len(self._prefetching),
+            'scheduler': self.scheduler.stats(),
+        }
+
+    def close(self) -> None:
+        for task in self._prefetching:
+            task.cancel()
+        self.executor.shutdown(wait=False)
+
+
+def _lru_get(cache: OrderedDict, key: Hashable) -> Any:
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def _lru_put(cache: OrderedDict, key: Hashable, value: Any, max_size: int) -> None:
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+def parse_backend_input(data: str) -> Dict[str, Any]:
+    """
+        Parses and checks a BackendInput message.
+    """
+    try:
+        message = json.loads(data)
+    except json.JSONDecodeError:
+        raise InvalidInput('The message is not valid json')
+    if not isinstance(message, dict):
+        raise InvalidInput('The message should be a json object')
+    recipe = message.get('user_recipe')
+    number_of_rules = message.get('number_of_rules')
+    # The length the frontend checks: recipe.length in javascript, in UTF-16 code units and not stripped
+    if not isinstance(recipe, str) or not MIN_RECIPE_LENGTH <= len(recipe.encode('utf-16-le', 'surrogatepass')) // 2 <= MAX_RECIPE_LENGTH:
+        raise InvalidInput(f'user_recipe should be a text of {MIN_RECIPE_LENGTH} to {MAX_RECIPE_LENGTH} characters')
+    if isinstance(number_of_rules, bool) or not isinstance(number_of_rules, int) or not 1 <= number_of_rules <= MAX_RULES:
+        raise InvalidInput(f'number_of_rules should be an integer between 1 and {MAX_RULES}')
+    return {'user_recipe': recipe, 'number_of_rules': number_of_rules, 'user_id': message.get('user_id')}
+
+
+async def example_socket(request: web.Request) -> web.WebSocketResponse:
+    """
+        The /ws/example WebSocket: every BackendInput message is answered with a BackendResponse, or {'error': ...} which
+        the frontend shows to the learner, in the order the answers are ready. A 'ping' message is sent every ping_interval seconds to keep the connection open.
+    """
+    service: ExampleService = request.app[SERVICE]
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    send_lock = asyncio.Lock()
+    tasks = set()
+
+    async def send(data: str) -> None:
+        async with send_lock:
+            if not ws.closed:
+                await ws.send_str(data)
+
+    async def keepalive() -> None:
+        while True:
+            await asyncio.sleep(request.app[PING_INTERVAL])
+            await send('ping')
+
+    async def answer(data: str) -> None:
+        try:
+            message = parse_backend_input(data)
+            payload = await service.example(message['user_recipe'], message['number_of_rules'])
+        except InvalidInput as e:
+            payload = {'error': str(e)}
+        except Exception:
+            traceback.print_exc()
+            payload = {'error': 'The example could not be generated, please try again.'}
+        await send(json.dumps(payload))
+
+    pinger = asyncio.create_task(keepalive())
+    try:
+        async for message in ws:
+            if message.type == WSMsgType.TEXT:
+                if message.data in ('ping', 'pong'):
+                    continue
+                task = asyncio.create_task(answer(message.data))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif message.type == WSMsgType.ERROR:
+                break
+    finally:
+        # A shared pipeline run goes on for the other learners waiting for it (see Coalescer)
+        pinger.cancel()
+        for task in tasks:
+            task.cancel()
+    return ws
+
+
+async def trace(request: web.Request) -> web.Response:
+    """
+        POST /trace: buffers the BackendUserResult of a learner (or a list of them), written with the next batch.
+    """
+    try:
+        body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return web.json_response({'status': 'error', 'error': 'The body is not valid json'}, status=400)
+    records = body if isinstance(body, list) else [body]
+    if not all(isinstance(record, dict) for record in records):
+        return web.json_response({'status': 'error', 'error': 'The body should be a json object or a list of json objects'}, status=400)
+    received_at = time.time()
+    for record in records:
+        record['received_at'] = received_at
+    await request.app[TRACES].add(*records)
+    return web.json_response({'status': 'ok', 'received': len(records)})
+
+
+async def health(request: web.Request) -> web.Response:
+    traces = request.app[TRACES]
+    return web.json_response({
+        'status': 'ok',
+        'examples': request.app[SERVICE].stats(),
+        'traces': {'written': traces.written, 'buffered': len(traces.records), 'dropped': traces.dropped},
+    })
+
+
+@web.middleware
+async def cors(request: web.Request, handler) -> web.StreamResponse:
+    # The frontend is served from another origin and posts json, which needs a preflight request
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+    if not isinstance(response, web.WebSocketResponse):
+        response.headers['Access-Control-Allow-Origin'] = request.app[ALLOWED_ORIGIN]
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    return response
+
+
+def create_app(
+    rules: Any,
+    model: str = 'gpt-4',
+    trace_sink: Callable[[List[Dict[str, Any]]], None] | None = None,
+    scheduler: RequestScheduler | None = None,
+    client: AsyncGptClient | None = None,
+    ping_interval: float = 30.0,
+    allowed_origin: str = '*',
+    trace_batch_size: int = 500,
+    trace_max_delay: float = 2.0,
+    prefetch_levels: int = 0,
+) -> web.Application:
+    """
+        Creates the aiohttp application.
+
+        Inputs:
+            - rules: The rules, a RuleIndex (hfb.load_rule_index) or a RuleTable (hot-swapped when a new version is published).
+            - model: The GPT model.
+            - trace_sink: The function writing a batch of trace records. Default is trace_store.ParquetTraceSink('traces').
+            - scheduler: The RequestScheduler of the GPT requests. Default is a RequestScheduler with its default limits.
+            - client: The AsyncGptClient. Default is a new client with the OpenAI key of helpers_for_backend.
+            - ping_interval: The number of seconds between two 'ping' messages on a WebSocket.
+            - allowed_origin: The Access-Control-Allow-Origin of the http endpoints.
+            - trace_batch_size, trace_max_delay: See TraceBuffer.
+            - prefetch_levels: See ExampleService.
+    """
+    app = web.Application(middlewares=[cors])
+    app[PING_INTERVAL] = ping_interval
+    app[ALLOWED_ORIGIN] = allowed_origin
+
+    async def start(app: web.Application) -> None:
+        app[CLIENT] = client or AsyncGptClient(hfb.openai.api_key)
+        app[SERVICE] = ExampleService(rules, model, scheduler or RequestScheduler(), app[CLIENT], prefetch_levels=prefetch_levels)
+        app[TRACES] = TraceBuffer(trace_sink or ParquetTraceSink('traces'), trace_batch_size, trace_max_delay)
+        app[TRACES].start()
+
+    async def stop(app: web.Application) -> None:
+        await app[TRACES].close()
+        app[SERVICE].close()
+        app[SERVICE].scheduler.close()
+        await app[CLIENT].close()
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    app.add_routes([
+        web.get('/ws/example', example_socket),
+        web.post('/trace', trace),
+        web.get('/health', health),
+    ])
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the backend of the web app.')
+    parser.add_argument('--rules', default='rules_recipe_scale.rules', help='A rule store, or a directory of published versions (see rule_store.publish_rule_table)')
+    parser.add_argument('--model', default='gpt-4')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--traces', default='traces', help='The directory of the Parquet traces (see trace_store), or a .jsonl file the traces are appended to')
+    parser.add_argument('--requests-per-minute', type=float, default=500)
+    parser.add_argument('--tokens-per-minute', type=float, default=40_000)
+    parser.add_argument('--max-concurrency', type=int, default=64)
+    parser.add_argument('--prefetch-levels', type=int, default=0, help='The number of adjacent improvement levels generated in the background')
+    args = parser.parse_args()
+    if os.path.exists(os.path.join(args.rules, 'CURRENT')):
+        rules = hfb.RuleTable(args.rules)
+    else:
+        rules = hfb.load_rule_index(args.rules)
+    app = create_app(
+        rules,
+        args.model,
+        jsonl_sink(args.traces) if args.traces.endswith('.jsonl') else ParquetTraceSink(args.traces),
+        RequestScheduler(args.requests_per_minute, args.tokens_per_minute, args.max_concurrency),
+        prefetch_levels=args.prefetch_levels,
+    )
+    web.run_app(app, host=args.host, port=args.port)
@@ -0,0 +1,198 @@
+# Shared fixtures of the tests: a small synthetic rule table in the format of mlxtend's association_rules csv, and recipes
+# drawn from the same vocabulary, so that the fast paths (RuleIndex, rule store, batched and shared-memory extraction...)
+# can be compared with the reference implementations (extract_rules, preprocess_string...) in a few seconds.
+# corpus_csv is a small full_dataset.csv, for the miners and the preprocessing, compared with mlxtend and gensim.
+# stub_api is a local chat completions endpoint, for the clients talking to the API.
+
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+from typing import List, Dict, FrozenSet
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for path in (ROOT, os.path.join(ROOT, 'Rule Extraction'), os.path.join(ROOT, 'Example Gens')):
+    if path not in sys.path:
+        sys.path.append(path)
+# helpers_for_backend reads the key at import, and the tests never use the persistent completion cache
+os.environ.setdefault('OPENAI_APIKEY', 'test')
+os.environ['GELEX_COMPLETION_CACHE'] = ''
+
+import pandas as pd
+import pytest
+
+VOCABULARY = [
+    'salt', 'pepper', 'butter', 'sugar', 'flour', 'egg', 'milk', 'onion', 'garlic', 'oil', 'water', 'cream', 'chees',
+    'bake', 'oven', 'minut', 'stir', 'heat', 'pan', 'bowl', 'mix', 'add', 'chicken', 'beef', 'tomato', 'lemon',
+    'vanilla', 'chocol', 'rice', 'potato', 'carrot', 'celeri', 'parslei', 'thyme', 'basil', 'cinnamon',
+]
+METRICS = ['antecedent support', 'consequent support', 'support', 'confidence', 'lift', 'leverage', 'conviction', 'zhangs_metric']
+
+
+def frozenset_string(tokens) -> str:
+    return str(frozenset(tokens))
+
+
+def make_rules(n_rules: int = 600, seed: int = 0) -> pd.DataFrame:
+    """
+        Random rules, as read from the csv of mlxtend (antecedents and consequents are "frozenset({...})" strings).
+        The metrics are rounded so that there are ties, and antecedents and consequents repeat across rules.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(n_rules):
+        tokens = rng.sample(VOCABULARY, rng.randint(2, 4))
+        split = rng.randint(1, len(tokens) - 1)
+        row = {'antecedents': frozenset_string(tokens[:split]), 'consequents': frozenset_string(tokens[split:])}
+        for metric in METRICS:
+            row[metric] = round(rng.uniform(0, 3), 1)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+# Words of the directions of corpus_csv, drawn theme by theme so that the mined corpus has association rules
+THEMES = [
+    ['Preheat', 'the', 'oven', 'bake', 'minutes', 'flour', 'sugar', 'butter', 'eggs', 'vanilla'],
+    ['Heat', 'the', 'oil', 'pan', 'onions', 'garlic', 'stir', 'salt', 'pepper', 'chicken'],
+    ['Boil', 'the', 'water', 'pot', 'potatoes', 'salt', 'drain', 'minutes', 'butter', 'milk'],
+]
+
+
+def make_directions(n_recipes: int = 301, seed: int = 2) -> List[str]:
+    """
+        Random directions in the format of full_dataset.csv (the string representation of a list of steps).
+        Each recipe mostly draws its words from one theme, so that some itemsets are frequent and some rules have a high lift.
+    """
+    rng = random.Random(seed)
+    directions = []
+    for _ in range(n_recipes):
+        theme = rng.choice(THEMES)
+        words = [rng.choice(theme if rng.random() < 0.85 else sum(THEMES, [])) for _ in range(rng.randint(2, 12))]
+        steps = [' '.join(words[i:i + 4]) + '.' for i in range(0, len(words), 4)]
+        directions.append(str(steps))
+    return directions
+
+
+def mlxtend_itemsets(recipes: List[List[str]], min_support: float, max_len: int | None) -> Dict[FrozenSet[str], float]:
+    """
+        The frequent itemsets of the recipes (token lists) with their support, mined in memory as in data_explore.ipynb.
+    """
+    from mlxtend.preprocessing import TransactionEncoder
+    from mlxtend.frequent_patterns import fpgrowth
+    encoder = TransactionEncoder()
+    encoded = pd.DataFrame(encoder.fit(recipes).transform(recipes), columns=encoder.columns_)
+    itemsets = fpgrowth(encoded, min_support=min_support, use_colnames=True, max_len=max_len)
+    return dict(zip(itemsets['itemsets'], itemsets['support']))
+
+
+def make_recipes(n_recipes: int = 200, seed: int = 1):
+    """
+        Random preprocessed recipes (token lists, with repeated tokens).
+    """
+    rng = random.Random(seed)
+    return [[rng.choice(VOCABULARY) for _ in range(rng.randint(0, 25))] for _ in range(n_recipes)]
+
+
+@pytest.fixture(scope='session')
+def rules_csv(tmp_path_factory) -> str:
+    path = str(tmp_path_factory.mktemp('rules') / 'rules.csv')
+    make_rules().to_csv(path, index=False)
+    return path
+
+
+@pytest.fixture(scope='session')
+def rules_df(rules_csv) -> pd.DataFrame:
+    # As loaded by the notebooks: the antecedents are token lists and the rules are sorted by lift
+    import helpers_for_backend as hfb
+    return hfb.load_rule_data(rules_csv, 'lift')
+
+
+@pytest.fixture(scope='session')
+def recipes():
+    return make_recipes()
+
+
+@pytest.fixture(scope='session')
+def corpus_csv(tmp_path_factory) -> str:
+    path = str(tmp_path_factory.mktemp('corpus') / 'full_dataset.csv')
+    directions = make_directions()
+    pd.DataFrame({'title': [f'Recipe {i}' for i in range(len(directions))], 'directions': directions}).to_csv(path)
+    return path
+
+
+def completion(content: str, model: str = 'gpt-3.5-turbo') -> dict:
+    return {
+        'id': 'chatcmpl-test',
+        'object': 'chat.completion',
+        'created': 0,
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2},
+    }
+
+
+class StubApi:
+    """
+        A chat completions endpoint running in a thread, answering "echo: <last message>". The behaviour is chosen by the
+        path prefix of the api_base:
+            - <url>/v1: Answers right away, streams the answer 3 characters at a time if stream=True.
+            - <url>/truncated/v1: Same as above, but the answer is cut by max_tokens (finish_reason 'length').
+            - <url>/recipe/v1: Answers "<RECIPE>last message</RECIPE>", with some text around the tags.
+            - <url>/slow/<seconds>/v1: Answers after the given number of seconds.
+            - <url>/flaky/<key>/<failures>/<status>/v1: The first failures requests of each key fail with the status.
+        Every request is recorded in requests as (path, payload).
+    """
+    def __init__(self):
+        self.requests = []
+        self._failures = {}
+        self._ready = threading.Event()
+        threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True).start()
+        self._ready.wait()
+        self.api_base = self.url + '/v1'
+
+    async def _serve(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_post('/{prefix:.*}v1/chat/completions', self._handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{runner.addresses[0][1]}'
+        self._ready.set()
+        await asyncio.Event().wait()
+
+    async def _handle(self, request):
+        from aiohttp import web
+        payload = await request.json()
+        self.requests.append((request.path, payload))
+        prefix = request.match_info['prefix'].strip('/').split('/')
+        if prefix[0] == 'slow':
+            await asyncio.sleep(float(prefix[1]))
+        if prefix[0] == 'flaky':
+            key, failures, status = prefix[1], int(prefix[2]), int(prefix[3])
+            self._failures[key] = self._failures.get(key, 0) + 1
+            if self._failures[key] <= failures:
+                return web.json_response({'error': {'message': f'failure {self._failures[key]}'}}, status=status, headers={'Retry-After': '0'})
+        content = 'echo: ' + payload['messages'][-1]['content']
+        if prefix[0] == 'recipe':
+            content = f"Sure!\n<RECIPE>\n{payload['messages'][-1]['content']}\n</RECIPE>\n<EXPLANATION>\nDone.\n</EXPLANATION>"
+        if not payload.get('stream'):
+            return web.json_response(completion(content, payload['model']))
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for start in range(0, len(content), 3):
+            chunk = {'choices': [{'index': 0, 'delta': {'content': content[start:start + 3]}, 'finish_reason': None}]}
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+        # The last chunk has no content, only the finish_reason
+        chunk = {'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'length' if prefix[0] == 'truncated' else 'stop'}]}
+        await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+        await response.write(b'data: [DONE]\n\n')
+        return response
+
+
+@pytest.fixture(scope='session')
+def stub_api() -> StubApi:
+    return StubApi()
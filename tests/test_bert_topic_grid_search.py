@@ -0,0 +1,62 @@
+import importlib
+import sys
+import types
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def sweep(monkeypatch):
+    # umap, hdbscan and bertopic are heavy: the caching of the reductions is tested with a UMAP that keeps the first components
+    fits = []
+
+    class UMAP:
+        def __init__(self, n_neighbors, n_components, min_dist, metric):
+            self.n_components = n_components
+
+        def fit_transform(self, embeddings):
+            fits.append(len(embeddings))
+            return np.asarray(embeddings)[:, :self.n_components]
+
+    stubs = {'umap': {'UMAP': UMAP}, 'hdbscan': {'HDBSCAN': None}, 'bertopic': {'BERTopic': None}, 'bertopic.dimensionality': {'BaseDimensionalityReduction': None}}
+    for name, attributes in stubs.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, 'bert_topic_grid_search', raising=False)
+    module = importlib.import_module('bert_topic_grid_search')
+    monkeypatch.setitem(sys.modules, 'bert_topic_grid_search', module)
+    module.fits = fits
+    return module
+
+
+def test_reduction_is_reused_for_the_same_embeddings(sweep, tmp_path):
+    embeddings = np.random.default_rng(0).standard_normal((50, 6)).astype(np.float32)
+    path = sweep.reduce_embeddings(embeddings, 15, 2, 0.0, str(tmp_path))
+    assert sweep.reduce_embeddings(embeddings.copy(), 15, 2, 0.0, str(tmp_path), sweep.embeddings_fingerprint(embeddings)) == path
+    assert sweep.fits == [50]
+    np.testing.assert_array_equal(np.load(path), embeddings[:, :2])
+
+
+def test_reduction_of_other_embeddings_is_not_reused(sweep, tmp_path):
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((50, 6)).astype(np.float32)
+    path = sweep.reduce_embeddings(embeddings, 15, 2, 0.0, str(tmp_path))
+    # Same shape, other values
+    other = rng.standard_normal((50, 6)).astype(np.float32)
+    other_path = sweep.reduce_embeddings(other, 15, 2, 0.0, str(tmp_path))
+    assert other_path != path
+    np.testing.assert_array_equal(np.load(other_path), other[:, :2])
+    # Other rows
+    fewer_path = sweep.reduce_embeddings(embeddings[:30], 15, 2, 0.0, str(tmp_path))
+    assert np.load(fewer_path).shape == (30, 2)
+    assert sweep.fits == [50, 50, 30]
+
+
+def test_reduction_of_the_wrong_shape_is_fitted_again(sweep, tmp_path):
+    embeddings = np.random.default_rng(0).standard_normal((50, 6)).astype(np.float32)
+    path = sweep.reduce_embeddings(embeddings, 15, 2, 0.0, str(tmp_path))
+    np.save(path, np.zeros((10, 2), dtype=np.float32))
+    assert sweep.reduce_embeddings(embeddings, 15, 2, 0.0, str(tmp_path)) == path
+    np.testing.assert_array_equal(np.load(path), embeddings[:, :2])
+    assert sweep.fits == [50, 50]
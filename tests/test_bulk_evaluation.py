@@ -0,0 +1,71 @@
+import random
+import numpy as np
+import pandas as pd
+import pytest
+from gensim.parsing.preprocessing import preprocess_string
+from openai.util import convert_to_openai_object
+import helper
+import helpers_for_backend as hfb
+from bulk_evaluation import evaluate_generations, evaluate_comparison_results, tokenize_texts
+from conftest import THEMES, completion
+
+
+def random_text(rng: random.Random) -> str:
+    theme = rng.choice(THEMES)
+    return ' '.join(rng.choice(theme) + rng.choice(['', '', ',', '.']) for _ in range(rng.randint(3, 20)))
+
+
+@pytest.fixture(scope='module')
+def generations(rules_df):
+    rng = random.Random(7)
+    originals = [preprocess_string(random_text(rng)) or ['salt'] for _ in range(120)]
+    answers = [f'Sure!\n<RECIPE>\n{random_text(rng)}\n</RECIPE>\n<EXPLANATION>\nDone.\n</EXPLANATION>' for _ in originals]
+    suggestions = [hfb.extract_rules(tokens, rules_df, rng.choice([1, 3, 5, 10]))[1] for tokens in originals]
+    return originals, answers, suggestions
+
+
+def test_bulk_scores_match_the_row_by_row_functions(generations):
+    originals, answers, suggestions = generations
+    scores = evaluate_generations(originals, answers, suggestions, processes=1)
+    assert scores['n_suggestions'].sum() > 0 and 0 < scores['n_fulfilled'].sum() < scores['n_suggestions'].sum()
+    for row, (tokens, answer, recipe_suggestions) in enumerate(zip(originals, answers, suggestions)):
+        response = convert_to_openai_object(completion(answer))
+        fulfilled, not_fulfilled, percentage = hfb.get_fullfilled_percentage(response, recipe_suggestions)
+        original_in_new, new_in_original = helper.calculate_similarity(tokens, response)
+        score = scores.iloc[row]
+        assert (score['n_fulfilled'], score['n_not_fulfilled']) == (fulfilled, not_fulfilled)
+        assert score['fulfilled_percentage'] == pytest.approx(percentage)
+        assert score['original_in_new'] == pytest.approx(original_in_new)
+        assert score['new_in_original'] == pytest.approx(new_in_original)
+
+
+def test_rows_without_an_answer_are_unknown(generations):
+    originals, answers, suggestions = generations
+    answers = [None if row % 3 == 0 else answer for row, answer in enumerate(answers)]
+    scores = evaluate_generations(originals, answers, suggestions, processes=1)
+    assert scores.loc[::3, 'fulfilled_percentage'].isna().all() and scores.loc[::3, 'original_in_new'].isna().all()
+    assert not scores.loc[1::3, 'fulfilled_percentage'].isna().any()
+    with pytest.raises(ValueError):
+        evaluate_generations(originals, answers[:-1], suggestions)
+
+
+def test_parallel_tokenization_matches_preprocess_string():
+    rng = random.Random(8)
+    texts = [random_text(rng) for _ in range(50)]
+    assert tokenize_texts(texts, processes=2, chunk_size=7) == [preprocess_string(text) for text in texts]
+
+
+def test_comparison_results_use_the_rules_of_each_row(rules_df, generations):
+    originals, answers, _ = generations
+    recipes = pd.DataFrame({'preprocessed': originals})
+    results = [{'prompt_a': {3: [(0, answers[0], 0.0), (5, answers[5], 0.0)]}}, {'prompt_b': {10: [(5, None, 0.0)], 1: [(2, answers[2], 0.0)]}}]
+    scores = evaluate_comparison_results(results, recipes, rules_df)
+    keys = list(zip(scores['prompt_function'], scores['rule_count'], scores['row']))
+    assert keys == [('prompt_a', 3, 0), ('prompt_a', 3, 5), ('prompt_b', 10, 5), ('prompt_b', 1, 2)]
+    expected = evaluate_generations(
+        [originals[row] for _, _, row in keys],
+        [answers[0], answers[5], None, answers[2]],
+        [hfb.extract_rules(originals[row], rules_df, rule_count)[1] for _, rule_count, row in keys],
+        processes=1,
+    )
+    np.testing.assert_array_equal(scores[expected.columns].to_numpy(), expected.to_numpy())
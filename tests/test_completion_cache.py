@@ -0,0 +1,120 @@
+import os
+import asyncio
+import openai
+import pytest
+import completion_cache
+from completion_cache import CompletionCache, cached_completion, cached_completion_async, cached_completion_stream, cached_completion_stream_async
+from gpt_client import AsyncGptClient
+
+MESSAGES = [{'role': 'user', 'content': 'a recipe'}]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return CompletionCache(str(tmp_path / 'cache.sqlite'))
+
+
+@pytest.fixture
+def sync_api(stub_api, monkeypatch):
+    monkeypatch.setattr(openai, 'api_base', stub_api.api_base)
+    monkeypatch.setattr(openai, 'api_key', 'key')
+    return stub_api
+
+
+def test_empty_cache_is_used(cache, sync_api, monkeypatch):
+    # An explicitly passed empty cache must not be replaced by the default one
+    monkeypatch.setattr(completion_cache, 'default_cache', lambda: pytest.fail('the default cache was used'))
+    assert len(cache) == 0 and cache
+    first = cached_completion('gpt-3.5-turbo', MESSAGES, cache=cache, temperature=0)
+    second = cached_completion('gpt-3.5-turbo', MESSAGES, cache=cache, temperature=0)
+    assert first.choices[0].message.content == second.choices[0].message.content == 'echo: a recipe'
+    assert (cache.hits, cache.misses, len(cache)) == (1, 1, 1)
+    assert cache.stats()['saved_tokens'] == 2
+
+
+def test_async_cache_shares_entries_with_sync(cache, sync_api):
+    cached_completion('gpt-3.5-turbo', MESSAGES, cache=cache, temperature=0)
+    n_requests = len(sync_api.requests)
+
+    async def run():
+        async with AsyncGptClient('key', sync_api.api_base) as client:
+            # The timeout is not part of the key
+            return await cached_completion_async(client, 'gpt-3.5-turbo', MESSAGES, cache=cache, temperature=0, timeout=5)
+    assert asyncio.run(run()).choices[0].message.content == 'echo: a recipe'
+    assert len(sync_api.requests) == n_requests and cache.hits == 1
+
+
+def test_only_deterministic_requests_are_cached(cache, sync_api):
+    cached_completion('gpt-3.5-turbo', MESSAGES, cache=cache, temperature=0.7)
+    assert len(cache) == 0 and cache.misses == 0
+
+
+def test_keys_depend_on_the_whole_request():
+    key = CompletionCache.key('gpt-3.5-turbo', MESSAGES, temperature=0)
+    assert key == CompletionCache.key('gpt-3.5-turbo', [dict(MESSAGES[0])], temperature=0)
+    assert key != CompletionCache.key('gpt-4', MESSAGES, temperature=0)
+    assert key != CompletionCache.key('gpt-3.5-turbo', [{'role': 'user', 'content': 'a recipe!'}], temperature=0)
+    assert key != CompletionCache.key('gpt-3.5-turbo', MESSAGES, temperature=0, max_tokens=10)
+
+
+def test_streams_share_the_cache_entry(cache, sync_api):
+    assert ''.join(cached_completion_stream('gpt-3.5-turbo', MESSAGES, cache=cache, temperature=0)) == 'echo: a recipe'
+    assert cached_completion('gpt-3.5-turbo', MESSAGES, cache=cache, temperature=0).choices[0].message.content == 'echo: a recipe'
+    assert cache.hits == 1
+
+    async def run():
+        async with AsyncGptClient('key', sync_api.api_base) as client:
+            return [piece async for piece in cached_completion_stream_async(client, 'gpt-3.5-turbo', MESSAGES, cache=cache, temperature=0)]
+    assert asyncio.run(run()) == ['echo: a recipe']
+
+
+def test_truncated_streams_are_not_cached(cache, sync_api, monkeypatch):
+    monkeypatch.setattr(openai, 'api_base', sync_api.url + '/truncated/v1')
+    assert ''.join(cached_completion_stream('gpt-3.5-turbo', MESSAGES, cache=cache, temperature=0)) == 'echo: a recipe'
+
+    async def run():
+        async with AsyncGptClient('key', sync_api.url + '/truncated/v1') as client:
+            return [piece async for piece in cached_completion_stream_async(client, 'gpt-3.5-turbo', MESSAGES, cache=cache, temperature=0)]
+    assert ''.join(asyncio.run(run())) == 'echo: a recipe'
+    assert len(cache) == 0
+    # A complete answer is cached with the finish_reason of the stream
+    monkeypatch.setattr(openai, 'api_base', sync_api.api_base)
+    ''.join(cached_completion_stream('gpt-3.5-turbo', MESSAGES, cache=cache, temperature=0))
+    assert cache.get(CompletionCache.key('gpt-3.5-turbo', MESSAGES, temperature=0)).choices[0].finish_reason == 'stop'
+
+
+def test_eviction_and_expiry(tmp_path, monkeypatch):
+    cache = CompletionCache(str(tmp_path / 'cache.sqlite'), max_entries=10, ttl=60)
+    response = openai.util.convert_to_openai_object({'choices': []})
+    times = iter(range(100))
+    monkeypatch.setattr(completion_cache.time, 'time', lambda: float(next(times)))
+    for i in range(10):
+        cache.put(f'k{i}', response)
+    assert len(cache) == 10
+    # Full: the least recently used entries are evicted down to 9 entries
+    assert cache.get('k0') is not None
+    cache.put('k10', response)
+    assert len(cache) == 9 and cache.get('k1') is None and cache.get('k2') is None and cache.get('k3') is not None
+    cache.ttl = 0
+    assert cache.get('k3') is None
+    assert cache.evict_expired() == 8 and len(cache) == 0
+
+
+def test_entries_are_not_counted_on_every_put(tmp_path):
+    cache = CompletionCache(str(tmp_path / 'cache.sqlite'), max_entries=1000)
+    response = openai.util.convert_to_openai_object({'choices': []})
+    statements = []
+    cache.connection.set_trace_callback(statements.append)
+    for i in range(50):
+        cache.put(f'k{i}', response)
+    assert not [statement for statement in statements if 'COUNT' in statement]
+    assert cache._entries == len(cache) == 50
+
+def test_default_path_is_in_the_user_cache(tmp_path, monkeypatch):
+    # Not in the working directory of the process, and the directory is created on first use
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.chdir(tmp_path)
+    path = completion_cache.user_cache_path()
+    assert path == str(tmp_path / 'cache' / 'gelex' / 'completion_cache.sqlite')
+    assert len(CompletionCache(path)) == 0
+    assert os.listdir(tmp_path) == ['cache'] and os.path.exists(path)
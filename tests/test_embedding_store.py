@@ -0,0 +1,78 @@
+import os
+import zlib
+import numpy as np
+import pytest
+from embedding_store import EmbeddingStore
+
+DIM = 8
+
+
+class FakeEncoder:
+    """
+        Encodes a text as a vector derived from its crc32, and records the size of every batch.
+    """
+    def __init__(self, fail_after: int | None = None):
+        self.batches = []
+        self.fail_after = fail_after
+
+    def __call__(self, texts):
+        if self.fail_after is not None and len(self.batches) >= self.fail_after:
+            raise RuntimeError('interrupted')
+        self.batches.append(len(texts))
+        return np.stack([embed(text) for text in texts])
+
+
+def embed(text: str) -> np.ndarray:
+    return np.random.default_rng(zlib.crc32(text.encode())).standard_normal(DIM).astype(np.float32)
+
+
+def test_fill_encodes_in_batches_and_only_once(tmp_path):
+    ids = list(range(100, 150))
+    texts = [f'recipe {i}' for i in ids]
+    store = EmbeddingStore(str(tmp_path), 'fake/model')
+    encoder = FakeEncoder()
+    assert store.fill(ids, texts, batch_size=8, encoder=encoder, save_every=2) == 50
+    assert max(encoder.batches) <= 8 and sum(encoder.batches) == 50
+    expected = np.stack([embed(text) for text in texts])
+    np.testing.assert_array_equal(store.get(ids), expected)
+    np.testing.assert_array_equal(store.get(ids[::-1]), expected[::-1])
+
+    # Reopened, with more recipes: only the new ones are encoded
+    store = EmbeddingStore(str(tmp_path), 'fake/model')
+    assert len(store) == 50
+    more_ids = ids + [200, 201]
+    encoder = FakeEncoder()
+    assert store.fill(more_ids, [f'recipe {i}' for i in more_ids], batch_size=8, encoder=encoder) == 2
+    assert encoder.batches == [2]
+    np.testing.assert_array_equal(store.get([201, 100]), np.stack([embed('recipe 201'), embed('recipe 100')]))
+    with pytest.raises(KeyError):
+        store.get([999])
+
+
+def test_float16_store(tmp_path):
+    store = EmbeddingStore(str(tmp_path), 'fake', dtype=np.float16)
+    store.fill(['a', 'b'], ['x', 'y'], encoder=FakeEncoder())
+    assert store.array().dtype == np.float16 and store.get(['a']).dtype == np.float32
+    np.testing.assert_allclose(store.get(['a', 'b']), np.stack([embed('x'), embed('y')]), rtol=1e-3, atol=1e-3)
+    with pytest.raises(ValueError):
+        EmbeddingStore(str(tmp_path), 'fake', dtype=np.float32)
+
+
+def test_interrupted_fill_keeps_the_saved_batches(tmp_path):
+    ids = list(range(20))
+    texts = [str(i) for i in ids]
+    store = EmbeddingStore(str(tmp_path), 'fake')
+    # Two batches are written, the third one fails
+    with pytest.raises(RuntimeError):
+        store.fill(ids, texts, batch_size=5, encoder=FakeEncoder(fail_after=2), save_every=2)
+    # Leftovers of a write that did not reach meta.json
+    with open(os.path.join(store.path, 'embeddings.bin'), 'ab') as f:
+        f.write(b'\x00' * 7)
+    with open(os.path.join(store.path, 'ids.jsonl'), 'ab') as f:
+        f.write(b'12\n13')
+    store = EmbeddingStore(str(tmp_path), 'fake')
+    assert store.ids == ids[:10]
+    assert store.fill(ids, texts, batch_size=5, encoder=FakeEncoder()) == 10
+    store = EmbeddingStore(str(tmp_path), 'fake')
+    assert store.ids == ids
+    np.testing.assert_array_equal(store.get(ids), np.stack([embed(text) for text in texts]))
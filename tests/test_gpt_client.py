@@ -0,0 +1,81 @@
+import asyncio
+import gc
+import warnings
+import openai
+import pytest
+from gpt_client import AsyncGptClient
+
+MESSAGES = [{'role': 'user', 'content': 'hello there'}]
+
+
+async def _complete(client: AsyncGptClient, **params):
+    return await client.chat_completion(MESSAGES, **params)
+
+
+def test_completion(stub_api):
+    async def run():
+        async with AsyncGptClient('key', stub_api.api_base) as client:
+            return await asyncio.gather(*[_complete(client) for _ in range(5)])
+    for response in asyncio.run(run()):
+        assert response.choices[0].message.content == 'echo: hello there'
+
+
+def test_stream(stub_api):
+    async def run():
+        async with AsyncGptClient('key', stub_api.api_base) as client:
+            return [chunk.choices[0] async for chunk in client.chat_completion_stream(MESSAGES)]
+    choices = asyncio.run(run())
+    # As with the API, the last chunk only has the finish_reason
+    assert ''.join(choice.delta.get('content', '') for choice in choices) == 'echo: hello there'
+    assert [choice.finish_reason for choice in choices[-2:]] == [None, 'stop']
+
+
+def test_timeout(stub_api):
+    async def run():
+        async with AsyncGptClient('key', stub_api.url + '/slow/2/v1') as client:
+            await _complete(client, timeout=0.2)
+    with pytest.raises(openai.error.Timeout):
+        asyncio.run(run())
+
+
+@pytest.mark.parametrize('status, error', [
+    (429, openai.error.RateLimitError),
+    (503, openai.error.ServiceUnavailableError),
+    (500, openai.error.APIError),
+    (401, openai.error.AuthenticationError),
+])
+def test_errors_are_the_openai_errors(stub_api, status, error):
+    async def run():
+        async with AsyncGptClient('key', f'{stub_api.url}/flaky/errors-{status}/1/{status}/v1') as client:
+            with pytest.raises(error) as raised:
+                await _complete(client)
+            assert raised.value.http_status == status
+            # The connection pool survives the error, the request can be retried
+            return await _complete(client)
+    assert asyncio.run(run()).choices[0].message.content == 'echo: hello there'
+
+
+def test_connection_error():
+    async def run():
+        # Nothing listens on port 9 of localhost
+        async with AsyncGptClient('key', 'http://127.0.0.1:9/v1') as client:
+            await _complete(client)
+    with pytest.raises(openai.error.APIConnectionError):
+        asyncio.run(run())
+
+
+def test_session_of_a_finished_loop_is_closed(stub_api):
+    # A client reused across asyncio.run calls, as in a notebook
+    client = AsyncGptClient('key', stub_api.api_base)
+    asyncio.run(_complete(client))
+    first_session = client._session
+    connector = first_session.connector
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        asyncio.run(_complete(client))
+        assert client._session is not first_session
+        assert first_session.closed and connector.closed
+        del first_session, connector
+        gc.collect()
+    assert not [w for w in caught if 'Unclosed' in str(w.message) or 'close()' in str(w.message)]
+    asyncio.run(client.close())
@@ -0,0 +1,86 @@
+import os
+import pandas as pd
+import pytest
+import helpers_for_backend as hfb
+from helpers_for_backend import RuleTable
+from incremental_mining import IncrementalMiner
+from rule_mining import tokenize_directions
+from rule_store import publish_rule_table, list_rule_versions, current_rule_version
+from conftest import mlxtend_itemsets
+
+MIN_SUPPORT = 0.05
+MAX_LEN = 3
+
+
+def _supports(miner: IncrementalMiner) -> dict:
+    return {frozenset(miner.tokens[token] for token in itemset): count / miner.n_recipes for itemset, count in miner.frequent_itemsets().items()}
+
+
+def _assert_same_itemsets(miner: IncrementalMiner, recipes):
+    expected = mlxtend_itemsets(recipes, MIN_SUPPORT, MAX_LEN)
+    supports = _supports(miner)
+    assert supports.keys() == expected.keys()
+    for itemset, support in expected.items():
+        assert supports[itemset] == pytest.approx(support)
+
+
+def test_incremental_matches_full_mining(corpus_csv, tmp_path):
+    data = pd.read_csv(corpus_csv)
+    initial_csv = str(tmp_path / 'initial.csv')
+    data.iloc[:200].to_csv(initial_csv, index=False)
+    recipes = [tokenize_directions(directions) for directions in data['directions']]
+    state_dir = str(tmp_path / 'state')
+    os.makedirs(state_dir)
+    miner = IncrementalMiner.create(initial_csv, state_dir, MIN_SUPPORT, MAX_LEN, chunksize=64, processes=2)
+    _assert_same_itemsets(miner, recipes[:200])
+
+    # A batch like the corpus, then one that makes new itemsets frequent, with tokens never seen before
+    miner.add_recipes(recipes[200:])
+    _assert_same_itemsets(miner, recipes)
+    batch = [['water', 'boil', 'pot', 'saffron'], ['saffron', 'pot', 'water'], ['boil', 'pot', 'saffron']] * 20
+    stats = miner.add_recipes(batch, processes=2)
+    assert stats['new_frequent'] > 0 and stats['recounted'] > 0
+    _assert_same_itemsets(miner, recipes + batch)
+
+    # The saved state gives the same counts, and the same rules
+    loaded = IncrementalMiner.load(state_dir)
+    assert _supports(loaded) == _supports(miner)
+    pd.testing.assert_frame_equal(loaded.rules(min_threshold=1.2), miner.rules(min_threshold=1.2))
+
+
+def test_rule_table_swaps_published_versions(rules_csv, recipes, tmp_path):
+    raw = pd.read_csv(rules_csv)
+    rules_dir = str(tmp_path / 'rules')
+    first, second = raw.iloc[:300], raw.iloc[300:]
+    assert publish_rule_table(first, rules_dir, keep=2) == 'v000001'
+    table = RuleTable(rules_dir, check_every=0)
+    assert table.version == 'v000001'
+    expected = hfb.load_rule_data(os.path.join(rules_dir, 'v000001.csv'), 'lift')
+    assert [hfb.extract_rules(recipe, table, 5) for recipe in recipes] == [hfb.extract_rules(recipe, expected, 5) for recipe in recipes]
+
+    # A new version is served on the next call, without building a new RuleTable
+    publish_rule_table(second, rules_dir, keep=2)
+    expected = hfb.load_rule_data(os.path.join(rules_dir, 'v000002.csv'), 'lift')
+    assert [hfb.extract_rules(recipe, table, 5) for recipe in recipes] == [hfb.extract_rules(recipe, expected, 5) for recipe in recipes]
+    assert table.version == current_rule_version(rules_dir) == 'v000002'
+
+    # Only the last keep versions are kept
+    publish_rule_table(first, rules_dir, keep=2)
+    assert list_rule_versions(rules_dir) == ['v000002', 'v000003']
+    assert not os.path.exists(os.path.join(rules_dir, 'v000001.rules'))
+    # keep=1 only keeps the new version, keep=0 would keep everything
+    publish_rule_table(second, rules_dir, keep=1)
+    assert list_rule_versions(rules_dir) == ['v000004']
+    with pytest.raises(ValueError):
+        publish_rule_table(second, rules_dir, keep=0)
+    assert list_rule_versions(rules_dir) == ['v000004']
+
+
+def test_rule_table_keeps_serving_when_a_version_is_broken(rules_csv, tmp_path):
+    rules_dir = str(tmp_path / 'rules')
+    publish_rule_table(pd.read_csv(rules_csv), rules_dir)
+    table = RuleTable(rules_dir, check_every=0)
+    index = table.get()
+    with open(os.path.join(rules_dir, 'CURRENT'), 'w') as f:
+        f.write('v999999')
+    assert table.get() is index and table.version == 'v000001'
@@ -0,0 +1,88 @@
+import pandas as pd
+import pytest
+import helper
+import helpers_for_backend as hfb
+import metric_testing
+from metric_testing import metric_test, load_metric_results, create_tasks, parallel_process
+from rule_index import extract_rules_batch
+from rule_arrays import SharedRuleView, load_rule_arrays
+from rule_store import convert_rule_data
+
+
+@pytest.fixture(scope='module')
+def recipes_df(recipes):
+    return pd.DataFrame({'id': range(1000, 1000 + len(recipes)), 'preprocessed': recipes})
+
+
+def _expected(rules_df, recipes_df, metrics, rule_count):
+    # The reference: extract_rules on the DataFrame sorted by each metric, one recipe at a time
+    expected = {}
+    for metric in metrics:
+        by_metric = rules_df(metric) if callable(rules_df) else rules_df.sort_values(metric, ascending=False)
+        for recipe_id, recipe in zip(recipes_df['id'], recipes_df['preprocessed']):
+            expected[(recipe_id, metric)] = hfb.extract_rules(recipe, by_metric, rule_count, metric)
+    return expected
+
+
+def _results(path):
+    results = {}
+    for recipe_id, metric, rule_set, rule_dict in load_metric_results(path):
+        assert (recipe_id, metric) not in results
+        results[(recipe_id, metric)] = (rule_set, rule_dict)
+    return results
+
+
+def test_metric_test_matches_extract_rules(rules_df, recipes_df, tmp_path):
+    metrics = ['lift', 'confidence']
+    path = metric_test(metrics, rules_df, recipes_df, helper.extract_rules, rule_count=5,
+                       output_path=str(tmp_path / 'results.pkl'), processes=2, chunks_per_process=3)
+    assert _results(path) == _expected(rules_df, recipes_df, metrics, 5)
+
+
+@pytest.mark.parametrize('metrics', [['confidence', 'lift'], ['lift', 'zhangs_metric', 'support']])
+def test_shared_arrays_match_extract_rules(rules_df, recipes_df, metrics, tmp_path):
+    # rules_df is sorted by lift: the first metric must not take the order of the DataFrame
+    path = metric_test(metrics, rules_df, recipes_df, extract_rules_batch, rule_count=5,
+                       output_path=str(tmp_path / 'results.pkl'), processes=2, chunks_per_process=3)
+    assert _results(path) == _expected(rules_df, recipes_df, metrics, 5)
+
+
+def test_shared_arrays_from_a_store(rules_csv, recipes_df, tmp_path):
+    index = hfb.load_rule_index(convert_rule_data(rules_csv, str(tmp_path / 'rules.rules')), 'lift')
+    path = metric_test(['confidence', 'lift'], index, recipes_df, extract_rules_batch, rule_count=3,
+                       output_path=str(tmp_path / 'results.pkl'), processes=2)
+    # The orders of a store are those of the csv sorted by each metric, ties included
+    by_metric = lambda metric: hfb.load_rule_data(rules_csv, metric)
+    assert _results(path) == _expected(by_metric, recipes_df, ['confidence', 'lift'], 3)
+
+
+@pytest.mark.parametrize('rule_extractor', [helper.extract_rules, extract_rules_batch])
+def test_parallel_process_matches_extract_rules(rules_df, recipes_df, rule_extractor, monkeypatch):
+    estimate_costs = metric_testing.estimate_costs
+    calls = []
+    monkeypatch.setattr(metric_testing, 'estimate_costs', lambda *args: calls.append(args) or estimate_costs(*args))
+    metrics = ['lift', 'confidence', 'zhangs_metric']
+    tasks = create_tasks(recipes_df, metrics, 2, rules_df, 5, rule_extractor)
+    # The costs are estimated once, and the tasks only carry positions
+    assert len(calls) == 1
+    assert all(isinstance(value, (str, int, float)) for task in tasks for value in task)
+    results = parallel_process(tasks, 2)
+    # One list per task, in the order of the tasks (metric by metric)
+    assert [{metric for _, metric, _ in result} for result in results] == [{task[0]} for task in tasks]
+    flat = {(recipe_id, metric): extracted for result in results for recipe_id, metric, extracted in result}
+    assert len(flat) == len(recipes_df) * len(metrics)
+    assert flat == _expected(rules_df, recipes_df, metrics, 5)
+
+
+def test_rules_are_mapped_for_every_extractor(rules_df, recipes_df):
+    # The DataFrame is not sent to the workers, the rows of each metric are built from the mapped arrays
+    tokens = recipes_df['preprocessed'].tolist()
+    with metric_testing._worker_state(rules_df, tokens, ['lift', 'confidence'], 5, helper.extract_rules) as initargs:
+        assert initargs[1:] == (['lift', 'confidence'], 5, helper.extract_rules)
+        arrays = load_rule_arrays(initargs[0])
+        for metric in ['lift', 'confidence']:
+            rows = [row for _, row in SharedRuleView(arrays, metric).iterrows()]
+            expected = rules_df.sort_values(metric, ascending=False)
+            assert [set(row['antecedents']) for row in rows] == [set(antecedents) for antecedents in expected['antecedents']]
+            assert [row['consequents'] for row in rows] == expected['consequents'].tolist()
+            assert [row[metric] for row in rows] == expected[metric].tolist()
@@ -0,0 +1,119 @@
+import ast
+import importlib
+import sys
+import types
+import pandas as pd
+import pytest
+
+
+class Tree(list):
+    def __init__(self, label, children):
+        super().__init__(children)
+        self._label = label
+
+    def label(self):
+        return self._label
+
+    def leaves(self):
+        return list(self)
+
+
+class Taggers:
+    """
+        Stand-ins for the NLTK taggers: the tokens are the words, the tag of a word depends on suffix, and the capitalized
+        words in a row are an entity labelled label.
+    """
+    def __init__(self):
+        self.suffix = ''
+        self.label = 'GPE'
+
+    def word_tokenize(self, text):
+        return text.replace('.', ' .').split()
+
+    def pos_tag(self, tokens):
+        return [(token, ('NNP' if token[:1].isupper() else 'NN') + self.suffix) for token in tokens]
+
+    def ne_chunk(self, tagged):
+        nodes = []
+        for token, tag in tagged:
+            if tag.startswith('NNP'):
+                if nodes and isinstance(nodes[-1], Tree):
+                    nodes[-1].append((token, tag))
+                else:
+                    nodes.append(Tree(self.label, [(token, tag)]))
+            else:
+                nodes.append((token, tag))
+        return Tree('S', nodes)
+
+    def entities(self, tokens):
+        return [(' '.join(token for token, _ in node), node.label()) for node in self.ne_chunk(self.pos_tag(tokens)) if isinstance(node, Tree)]
+
+
+@pytest.fixture
+def ner(monkeypatch):
+    # nltk is not needed to test the shards and the stages, the pool workers are forked with the stubs
+    taggers = Taggers()
+    stubs = {
+        'nltk': {'download': lambda resource, quiet=False: True},
+        'nltk.tokenize': {'word_tokenize': lambda text: taggers.word_tokenize(text)},
+        'nltk.tag': {'pos_tag': lambda tokens: taggers.pos_tag(tokens)},
+        'nltk.chunk': {'ne_chunk': lambda tagged: taggers.ne_chunk(tagged)},
+        'nltk.tree': {'Tree': Tree},
+    }
+    for name, attributes in stubs.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, 'ner_pipeline', raising=False)
+    module = importlib.import_module('ner_pipeline')
+    monkeypatch.setitem(sys.modules, 'ner_pipeline', module)
+    module.taggers = taggers
+    return module
+
+
+def _recipes(corpus_csv):
+    data = pd.read_csv(corpus_csv)
+    return data.index.tolist(), [' '.join(ast.literal_eval(directions)) for directions in data['directions']]
+
+
+def test_shards_match_the_taggers(ner, corpus_csv, tmp_path):
+    output_dir = ner.run_ner_pipeline(corpus_csv, str(tmp_path / 'ner'), shard_size=40, processes=2)
+    ids, texts = _recipes(corpus_csv)
+    recipes = list(ner.NerShards(output_dir).recipes())
+    assert [recipe['id'] for recipe in recipes] == ids
+    taggers = ner.taggers
+    for recipe, text in zip(recipes, texts):
+        tokens = taggers.word_tokenize(text)
+        assert recipe['tokens'] == tokens
+        assert recipe['pos'] == taggers.pos_tag(tokens)
+        assert recipe['entities'] == taggers.entities(tokens)
+    assert any(recipe['entities'] for recipe in recipes)
+
+
+def test_forcing_a_stage_invalidates_the_later_ones(ner, corpus_csv, tmp_path):
+    output_dir = ner.run_ner_pipeline(corpus_csv, str(tmp_path / 'ner'), shard_size=100, processes=2)
+    ner.taggers.suffix = '-2'
+    ner.taggers.label = 'ORG'
+    # Only pos is run again, the entities found with the previous tags are not valid anymore
+    ner.run_ner_pipeline(corpus_csv, output_dir, stages=['pos'], shard_size=100, processes=2, force=['pos'])
+    for shard in ner.NerShards(output_dir):
+        assert shard.entities is None
+        assert all(tag.endswith('-2') for tag in shard.tags)
+    # Asking for ner runs it again, on the new tags
+    ner.run_ner_pipeline(corpus_csv, output_dir, stages=['ner'], shard_size=100, processes=2)
+    _, texts = _recipes(corpus_csv)
+    entities = [recipe['entities'] for recipe in ner.NerShards(output_dir).recipes()]
+    assert entities == [ner.taggers.entities(ner.taggers.word_tokenize(text)) for text in texts]
+    assert any(label == 'ORG' for recipe in entities for _, label in recipe)
+
+
+def test_only_unfinished_shards_are_run(ner, corpus_csv, tmp_path):
+    output_dir = ner.run_ner_pipeline(corpus_csv, str(tmp_path / 'ner'), stages=['pos'], shard_size=100, processes=2, shards=[0, 2])
+    assert [shard.path[-1] for shard in ner.NerShards(output_dir)] == ['0', '2']
+    ner.taggers.suffix = '-2'
+    ner.run_ner_pipeline(corpus_csv, output_dir, stages=['pos'], shard_size=100, processes=2)
+    tags = [shard.tags for shard in ner.NerShards(output_dir)]
+    # Shards 0 and 2 were done before the change, 1 and 3 after
+    assert [all(tag.endswith('-2') for tag in shard_tags) for shard_tags in tags] == [False, True, False, True]
+    with pytest.raises(ValueError):
+        ner.run_ner_pipeline(corpus_csv, output_dir, shard_size=50, processes=1)
@@ -0,0 +1,59 @@
+import asyncio
+import random
+import openai
+import pytest
+import helpers_for_backend as hfb
+from helpers_for_backend import RecipeStreamParser, PipelineOutput
+from completion_cache import CompletionCache
+from gpt_client import AsyncGptClient
+
+ANSWERS = [
+    'Here is the recipe:\n<RECIPE>\nIngredients:\n- salt\nInstructions:\n1. Add the salt.\n</RECIPE>\n<EXPLANATION>\nSalt.\n</EXPLANATION>',
+    '<RECIPE>no end tag',
+    'no tags at all',
+    '<RECIPE></RECIPE>',
+    'a < b <RECIPE>x </RECIPE y</RECIPE> after',
+]
+
+
+def _split(text: str, rng: random.Random):
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(0, 12)))) if len(text) > 1 else []
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+@pytest.mark.parametrize('answer', ANSWERS)
+def test_parser_extracts_the_recipe_whatever_the_pieces(answer):
+    rng = random.Random(0)
+    expected = answer.split('<RECIPE>', 1)[1].split('</RECIPE>', 1)[0] if '<RECIPE>' in answer else ''
+    for _ in range(200):
+        parser = RecipeStreamParser()
+        text = ''.join(parser.feed(piece) for piece in _split(answer, rng)) + parser.flush()
+        assert text == expected
+
+
+@pytest.fixture
+def recipe_api(stub_api, monkeypatch):
+    monkeypatch.setattr(openai, 'api_base', stub_api.url + '/recipe/v1')
+    monkeypatch.setattr(openai, 'api_key', 'key')
+    return stub_api
+
+
+def test_stream_gives_the_same_output_as_the_pipeline(rules_df, recipes, recipe_api, tmp_path):
+    recipe = recipes[3]
+    items = list(hfb.complete_pipeline_stream(recipe, ' '.join(recipe), rules_df, cache=CompletionCache(str(tmp_path / 'c.sqlite'))))
+    output = items[-1]
+    assert isinstance(output, PipelineOutput) and all(isinstance(item, str) for item in items[:-1])
+    assert ''.join(items[:-1]).strip() == hfb.recipe_text(output.new_recipe)
+    assert output == hfb.complete_pipeline(recipe, ' '.join(recipe), rules_df)
+
+
+def test_async_stream_gives_the_same_output_as_the_pipeline(rules_df, recipes, recipe_api):
+    recipe = recipes[3]
+
+    async def run():
+        async with AsyncGptClient('key', recipe_api.url + '/recipe/v1') as client:
+            items = [item async for item in hfb.complete_pipeline_stream_async(recipe, ' '.join(recipe), rules_df, client=client)]
+            return items, await hfb.complete_pipeline_async(recipe, ' '.join(recipe), rules_df, client=client)
+    items, output = asyncio.run(run())
+    assert items[-1] == output
+    assert ''.join(items[:-1]).strip() == hfb.recipe_text(output.new_recipe)
@@ -0,0 +1,59 @@
+import ast
+import os
+import shutil
+import pandas as pd
+import pytest
+from gensim.parsing.preprocessing import preprocess_string
+from preprocessed_corpus import preprocess_corpus, load_preprocessed, preprocessed_column
+
+
+@pytest.fixture
+def csv_path(corpus_csv, tmp_path):
+    # A copy, the corpora are written next to the csv
+    path = str(tmp_path / 'full_dataset.csv')
+    shutil.copy(corpus_csv, path)
+    return path
+
+
+def test_corpus_matches_preprocess_string(csv_path):
+    corpus = load_preprocessed(preprocess_corpus(csv_path, chunksize=70, processes=2))
+    data = pd.read_csv(csv_path)
+    expected = [preprocess_string(' '.join(ast.literal_eval(directions))) for directions in data['directions']]
+    assert len(corpus) == len(expected)
+    assert [corpus[i] for i in range(len(corpus))] == expected
+    assert corpus.recipe_ids.tolist() == data.index.tolist()
+    series = corpus.to_series()
+    assert series.tolist() == expected and series.index.tolist() == data.index.tolist()
+    # The transactions of the miners: each token once per recipe
+    matrix = corpus.binary_matrix(10, 50)
+    assert matrix.shape == (40, len(corpus.tokens)) and matrix.data.max() == 1
+    assert [{corpus.tokens[t] for t in matrix[i].indices} for i in range(40)] == [set(recipe) for recipe in expected[10:50]]
+
+
+def test_ids_and_plain_text(tmp_path):
+    path = str(tmp_path / 'relex_examples.csv')
+    texts = ['Preheat the oven, then bake for 10 minutes.', '', 'Stir the onions and the garlic in hot oil.']
+    pd.DataFrame({'recipe_id': ['a', 'b', 'c'], 'recipe': texts}).to_csv(path, index=False)
+    series = preprocessed_column(path, column='recipe', id_column='recipe_id', parse_list=False, processes=1)
+    assert series.index.tolist() == ['a', 'b', 'c']
+    assert series.tolist() == [preprocess_string(text) for text in texts]
+
+
+def test_corpus_is_reused_until_the_csv_changes(csv_path):
+    path = preprocess_corpus(csv_path, processes=1)
+    written = os.stat(os.path.join(path, 'meta.json')).st_mtime_ns
+    assert preprocess_corpus(csv_path, processes=1) == path
+    assert os.stat(os.path.join(path, 'meta.json')).st_mtime_ns == written
+
+    data = pd.read_csv(csv_path, index_col=0)
+    data.loc[0, 'directions'] = str(['Whisk the cream.'])
+    data.to_csv(csv_path)
+    assert preprocess_corpus(csv_path, processes=1) == path
+    assert load_preprocessed(path)[0] == preprocess_string('Whisk the cream.')
+
+
+def test_incomplete_corpus_is_rejected(csv_path):
+    path = preprocess_corpus(csv_path, processes=1)
+    os.remove(os.path.join(path, 'meta.json'))
+    with pytest.raises(FileNotFoundError):
+        load_preprocessed(path)
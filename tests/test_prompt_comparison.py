@@ -0,0 +1,94 @@
+import json
+import openai
+import numpy as np
+import pandas as pd
+import pytest
+from openai.util import convert_to_openai_object
+import prompt_comparison_mp as pcm
+from request_scheduler import RequestScheduler
+from conftest import completion
+
+
+class FakePrompt:
+    """
+        A prompt function answering every prompt with the same recipe, counting the prompts sent per model.
+    """
+    def __init__(self):
+        self.calls = []
+        self.__name__ = 'prompt_fake'
+
+    def __call__(self, prompt, print_response=False, model='gpt-4'):
+        self.calls.append(model)
+        return convert_to_openai_object(completion('<RECIPE>add the salt and pepper to the butter</RECIPE>', model))
+
+
+@pytest.fixture
+def relex_examples(recipes):
+    return pd.DataFrame({'preprocessed': recipes[:6], 'recipe': [' '.join(recipe) for recipe in recipes[:6]]})
+
+
+def _run(prompt, relex_examples, rules_df, log_path, **kwargs):
+    # numpy rule counts, as from np.arange, are written to the log as ints
+    tasks = pcm.create_tasks([prompt], np.array([1, 3]), relex_examples, rules_df)
+    return pcm.parallel_process(tasks, log_path=log_path, **kwargs)
+
+
+def test_resumes_from_the_log(relex_examples, rules_df, tmp_path):
+    log_path = str(tmp_path / 'run.jsonl')
+    prompt = FakePrompt()
+    results = _run(prompt, relex_examples, rules_df, log_path)
+    assert len(prompt.calls) == 12
+    assert all(json.loads(line)['rule_count'] in (1, 3) for line in open(log_path))
+    # Nothing is sent again, and the results are rebuilt from the log
+    assert _run(prompt, relex_examples, rules_df, log_path) == results
+    assert len(prompt.calls) == 12
+    assert pcm.load_results(log_path) == results[0]
+
+
+def test_other_model_or_recipes_are_not_resumed(relex_examples, rules_df, tmp_path):
+    log_path = str(tmp_path / 'run.jsonl')
+    prompt = FakePrompt()
+    _run(prompt, relex_examples, rules_df, log_path)
+    _run(prompt, relex_examples, rules_df, log_path, model='gpt-3.5-turbo')
+    assert prompt.calls.count('gpt-3.5-turbo') == 12
+    # Another recipe at row 0: only that row is sent again, for both rule counts
+    changed = relex_examples.copy()
+    changed.loc[0, 'recipe'] = 'another recipe'
+    _run(prompt, changed, rules_df, log_path)
+    assert prompt.calls.count('gpt-4') == 14
+    assert set(pcm.load_results(log_path, model='gpt-3.5-turbo')['prompt_fake']) == {1, 3}
+
+
+def test_older_logs_and_cut_lines_are_ignored(relex_examples, rules_df, tmp_path):
+    log_path = tmp_path / 'run.jsonl'
+    # A line without model nor recipe digest, and a line cut by a crash
+    log_path.write_text(json.dumps({'prompt_function': 'prompt_fake', 'rule_count': 1, 'row': 0, 'new_recipe': 'old', 'fulfilled': None}) + '\n{"prompt_fun')
+    prompt = FakePrompt()
+    _run(prompt, relex_examples, rules_df, str(log_path))
+    assert len(prompt.calls) == 12
+
+
+def test_failed_row_is_sent_once(relex_examples, rules_df, tmp_path):
+    # A non-transient error is neither retried by the scheduler nor by the row, the row is logged as failed
+    calls = []
+
+    def prompt_invalid(prompt, print_response=False, model='gpt-4'):
+        calls.append(prompt)
+        raise openai.error.InvalidRequestError('context length exceeded', 'messages')
+
+    log_path = str(tmp_path / 'run.jsonl')
+    results = _run(prompt_invalid, relex_examples, rules_df, log_path)
+    assert len(calls) == 12
+    assert results[0]['prompt_invalid'][1] == [(i, None, None) for i in range(6)]
+    assert all(json.loads(line)['new_recipe'] is None for line in open(log_path))
+
+
+def test_shared_scheduler_is_left_open(relex_examples, rules_df, tmp_path):
+    scheduler = RequestScheduler()
+    prompt = FakePrompt()
+    _run(prompt, relex_examples, rules_df, str(tmp_path / 'a.jsonl'), scheduler=scheduler)
+    executor = scheduler._executor
+    assert executor is not None
+    _run(prompt, relex_examples, rules_df, str(tmp_path / 'b.jsonl'), scheduler=scheduler)
+    assert scheduler._executor is executor and scheduler.counters['requests'] == 24
+    scheduler.close()
@@ -0,0 +1,71 @@
+import random
+from recipe_annotations import annotate, match_tokens, _myers, suggested_tokens
+from recipe_tokenizer import RecipeTokenizer
+
+
+def lcs_length(a, b) -> int:
+    lengths = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in range(len(a)):
+        for j in range(len(b)):
+            lengths[i + 1][j + 1] = lengths[i][j] + 1 if a[i] == b[j] else max(lengths[i][j + 1], lengths[i + 1][j])
+    return lengths[-1][-1]
+
+
+def is_subsequence(sequence, of) -> bool:
+    remaining = iter(of)
+    return all(any(element == other for other in remaining) for element in sequence)
+
+
+def random_pairs(n: int, seed: int = 5):
+    # b is a with random insertions, deletions and substitutions, over a small alphabet so that ids repeat
+    rng = random.Random(seed)
+    for _ in range(n):
+        a = [rng.randrange(rng.choice([3, 8, 30])) for _ in range(rng.randint(0, 40))]
+        b = []
+        for element in a:
+            action = rng.random()
+            if action < 0.15:
+                continue
+            b.append(rng.randrange(30) if action < 0.25 else element)
+            while rng.random() < 0.2:
+                b.append(rng.randrange(30))
+        yield a, b
+
+
+def test_matches_are_a_common_subsequence():
+    for a, b in random_pairs(500):
+        matched = match_tokens(a, b)
+        assert len(matched) == len(b)
+        assert is_subsequence([element for element, kept in zip(b, matched) if kept], a)
+
+
+def test_myers_is_optimal():
+    # Without anchors, the matches are a longest common subsequence
+    for a, b in random_pairs(500, seed=6):
+        matched = [False] * len(b)
+        if a and b:
+            _myers(a, b, 0, len(a), 0, len(b), matched)
+        assert sum(matched) == lcs_length(a, b)
+        assert is_subsequence([element for element, kept in zip(b, matched) if kept], a)
+
+
+def test_prefix_suffix_and_anchors_keep_the_common_tokens():
+    a = [1, 2, 3, 4, 5, 6, 7]
+    assert match_tokens(a, a) == [True] * 7
+    assert match_tokens(a, [1, 2, 9, 3, 4, 5, 9, 6, 7]) == [True, True, False, True, True, True, False, True, True]
+    assert match_tokens([], [1, 2]) == [False, False]
+    assert match_tokens([1, 2], []) == []
+
+
+def test_annotate_added_words():
+    tokenizer = RecipeTokenizer()
+    original = tokenizer.tokenize('Ingredients: flour, sugar. Instructions: Mix the flour and the sugar.')
+    generated = tokenizer.tokenize('Ingredients: flour, sugar, vanilla. Instructions: Mix the flour, the vanilla and the sugar. Add more flour.')
+    suggestions = {frozenset({'sugar'}): ("frozenset({'vanilla'})", 2.0)}
+    annotation = annotate(original, generated, suggestions)
+    # flour is in the user recipe, but the third one was added
+    assert annotation.annotations == {'vanilla.': [('vanilla', 3)], 'vanilla': [('vanilla', 9)], 'Add': [('add', 13)], 'flour.': [('flour', 15)]}
+    assert annotation.suggested == [3, 9]
+    assert annotation.ing_seperated == 'flour, sugar, vanilla.'
+    assert suggested_tokens(suggestions) == {'vanilla'}
+    assert annotation.backend_response()['example_recipe'] == generated.text
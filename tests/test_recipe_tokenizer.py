@@ -0,0 +1,71 @@
+import ast
+import random
+import pandas as pd
+import pytest
+from gensim.parsing.preprocessing import preprocess_string
+from openai.util import convert_to_openai_object
+import helpers_for_backend as hfb
+from recipe_tokenizer import RecipeTokenizer
+from conftest import completion
+
+PIECES = ['Preheat', 'the', 'oven', 'to', '350', 'degrees', 'F.', "don't", 'stir-fry', '1/2', 'cup', '(optional)',
+          'crème', 'brûlée', 'minutes;', 'BAKE', 'onions,', '<b>', '</b>', '<', '>', 'a<b', 'c>d', '&amp;', '...', '2x']
+SEPARATORS = [' ', ' ', ' ', '\n', '\t', '  ', '\xa0', '']
+
+
+def random_texts(n: int, seed: int = 3):
+    rng = random.Random(seed)
+    return [''.join(rng.choice(PIECES) + rng.choice(SEPARATORS) for _ in range(rng.randint(0, 30))) for _ in range(n)]
+
+
+@pytest.mark.parametrize('max_words', [5, 100_000])
+def test_tokens_match_preprocess_string(corpus_csv, max_words):
+    tokenizer = RecipeTokenizer(max_words=max_words)
+    texts = random_texts(500) + [' '.join(ast.literal_eval(directions)) for directions in pd.read_csv(corpus_csv)['directions']]
+    for text in texts:
+        assert tokenizer(text) == preprocess_string(text), text
+    assert tokenizer.stats()['words'] <= max_words
+
+
+def test_tokens_point_to_their_words():
+    tokenizer = RecipeTokenizer()
+    for text in random_texts(200, seed=4):
+        fallbacks = tokenizer.fallbacks
+        tokenized = tokenizer.tokenize(text)
+        assert tokenized.words == text.split()
+        for token, word_index, (start, end) in zip(tokenized.tokens, tokenized.word_indexes, tokenized.spans):
+            assert text[start:end] == tokenized.words[word_index]
+            # A tag spanning several words is tokenized as a whole, its tokens are only aligned to the words
+            if tokenizer.fallbacks == fallbacks:
+                assert token in preprocess_string(tokenized.words[word_index])
+    assert tokenizer.fallbacks > 0
+
+
+def test_annotations():
+    tokenized = RecipeTokenizer().tokenize('Heat the oil, then fry the onions in the oil.')
+    assert tokenized.annotations() == {'Heat': [('heat', 0)], 'oil,': [('oil', 2)], 'fry': [('fry', 4)], 'onions': [('onion', 6)], 'oil.': [('oil', 9)]}
+    assert tokenized.annotations({'oil'}) == {'oil,': [('oil', 2)], 'oil.': [('oil', 9)]}
+
+
+def test_memo_is_bounded_and_counted():
+    tokenizer = RecipeTokenizer(max_words=3)
+    tokenizer('salt pepper salt salt')
+    assert tokenizer.stats()['hits'] == 2 and tokenizer.stats()['misses'] == 2
+    tokenizer('butter sugar flour')
+    # salt was the least recently used word
+    assert list(tokenizer._memo) == ['butter', 'sugar', 'flour']
+    assert tokenizer.stats()['hit_rate'] == pytest.approx(2 / 7)
+
+
+def test_fullfilled_percentage_matches_preprocess_string():
+    text = 'Preheat the oven. Bake the cakes for 20 minutes, then add the cream.'
+    response = convert_to_openai_object(completion(f'Sure!\n<RECIPE>\n{text}\n</RECIPE>'))
+    suggestions = {
+        'a': ("frozenset({'oven', 'bake'})", 0), 'b': ("frozenset({'cream'})", 1), 'c': ("frozenset({'butter', 'cake'})", 2),
+    }
+    tokens = set(preprocess_string(text))
+    fullfilled = sum(eval(rule).issubset(tokens) for rule, _ in suggestions.values())
+    expected = (fullfilled, 3 - fullfilled, fullfilled / 3)
+    assert expected == (2, 1, 2 / 3)
+    assert hfb.get_fullfilled_percentage(response, suggestions) == expected
+    assert hfb.get_fullfilled_percentage(response, suggestions, hfb.tokenize_recipe(text)) == expected
@@ -0,0 +1,92 @@
+import asyncio
+import time
+import openai
+import pytest
+from gpt_client import AsyncGptClient
+from request_scheduler import RequestScheduler, TokenBucket, estimate_tokens
+
+MESSAGES = [{'role': 'user', 'content': 'a recipe'}]
+
+
+def _scheduler(**kwargs) -> RequestScheduler:
+    return RequestScheduler(requests_per_minute=60_000, tokens_per_minute=10_000_000, base_delay=0.01, **kwargs)
+
+
+def _send(scheduler: RequestScheduler, api_base: str):
+    async def run():
+        async with AsyncGptClient('key', api_base) as client:
+            return await scheduler.run(client.chat_completion, MESSAGES)
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_transient_errors_are_retried(stub_api, status):
+    scheduler = _scheduler()
+    response = _send(scheduler, f'{stub_api.url}/flaky/retry-{status}/2/{status}/v1')
+    assert response.choices[0].message.content == 'echo: a recipe'
+    assert scheduler.counters['retries'] == 2 and scheduler.counters['failed'] == 0
+    assert scheduler.counters['rate_limited'] == (2 if status == 429 else 0)
+    # The real usage of the response is recorded
+    assert scheduler.counters['tokens'] == 2
+
+
+def test_timeouts_are_retried(stub_api):
+    scheduler = _scheduler(max_retries=1)
+
+    async def run():
+        async with AsyncGptClient('key', stub_api.url + '/slow/1/v1') as client:
+            return await scheduler.run(client.chat_completion, MESSAGES, timeout=0.1)
+    with pytest.raises(openai.error.Timeout):
+        asyncio.run(run())
+    assert scheduler.counters['requests'] == 2 and scheduler.counters['failed'] == 1
+
+
+def test_other_errors_are_not_retried(stub_api):
+    scheduler = _scheduler()
+    with pytest.raises(openai.error.InvalidRequestError):
+        _send(scheduler, f'{stub_api.url}/flaky/invalid/1/400/v1')
+    assert scheduler.counters['retries'] == 0 and scheduler.counters['failed'] == 1
+
+
+def test_gives_up_after_max_retries(stub_api):
+    scheduler = _scheduler(max_retries=2)
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        _send(scheduler, f'{stub_api.url}/flaky/down/10/503/v1')
+    assert scheduler.counters['requests'] == 3
+
+
+def test_concurrency_limit_and_reuse_across_loops():
+    scheduler = _scheduler(max_concurrency=2)
+    in_flight = []
+
+    async def request(i):
+        in_flight.append(i)
+        peak = len(in_flight)
+        await asyncio.sleep(0.01)
+        in_flight.remove(i)
+        return peak
+
+    async def run():
+        return await asyncio.gather(*[scheduler.run(request, i) for i in range(8)])
+    # Every asyncio.run has its own loop, the semaphore of the previous one can't be used
+    for _ in range(2):
+        assert max(asyncio.run(run())) == 2
+
+
+def test_regular_functions_run_in_threads():
+    scheduler = _scheduler()
+
+    async def run():
+        return await asyncio.gather(*[scheduler.run(time.sleep, 0.05) for _ in range(4)])
+    start = time.perf_counter()
+    asyncio.run(run())
+    scheduler.close()
+    assert time.perf_counter() - start < 0.2
+
+
+def test_token_bucket():
+    bucket = TokenBucket(per_minute=60, capacity=2)
+    assert bucket.reserve(1) == 0 and bucket.reserve(1) == 0
+    # Empty: the next unit is available in about a second
+    assert bucket.reserve(1) == pytest.approx(1, abs=0.05)
+    assert estimate_tokens('a' * 400, completion_tokens=100) == 100 + 4 + 100
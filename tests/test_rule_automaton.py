@@ -0,0 +1,37 @@
+import shutil
+import pytest
+import helper
+from helper import RuleAutomaton, find_patterns
+
+
+@pytest.fixture(scope='module')
+def data_dir(rules_csv, tmp_path_factory):
+    directory = tmp_path_factory.mktemp('data')
+    shutil.copy(rules_csv, directory / 'rules_recipe_scale.csv')
+    return str(directory)
+
+
+def test_automaton_matches_regex_patterns(data_dir, recipes):
+    _, to_be_joined, _ = helper.load_required_data(data_dir)
+    _, automaton, _ = helper.load_required_data(data_dir, automaton=True)
+    for recipe in recipes:
+        assert find_patterns(recipe, automaton) == find_patterns(recipe, to_be_joined)
+
+
+@pytest.mark.parametrize('recipe', [
+    ['boil'],
+    ['boil', 'oil'],
+    ['oil', 'boil'],
+    ['boiled', 'water'],
+    ['soil', 'water', 'boil'],
+    ['waterboil'],
+    [],
+])
+def test_overlapping_words(recipe):
+    rules = [['oil'], ['oil', 'boil'], ['water', 'oil'], ['boil', 'water'], ['il', 'oil']]
+    to_be_joined = [
+        '.*'.join(permutation)
+        for rule in rules
+        for permutation in ([rule] if len(rule) == 1 else [rule, rule[::-1]])
+    ]
+    assert find_patterns(recipe, RuleAutomaton(rules)) == find_patterns(recipe, to_be_joined)
@@ -0,0 +1,57 @@
+import pytest
+import helpers_for_backend as hfb
+from rule_index import RuleIndex, extract_rules_from_index, extract_rules_batch, compile_rules
+
+
+@pytest.mark.parametrize('rule_count', [1, 3, 10, 1000])
+def test_index_matches_dataframe_scan(rules_df, recipes, rule_count):
+    index = RuleIndex.from_dataframe(rules_df, 'lift')
+    for recipe in recipes:
+        assert extract_rules_from_index(recipe, index, rule_count) == hfb.extract_rules(recipe, rules_df, rule_count, 'lift')
+
+
+def test_extract_rules_accepts_index(rules_df, recipes):
+    index = RuleIndex.from_dataframe(rules_df, 'lift')
+    for recipe in recipes[:20]:
+        assert hfb.extract_rules(recipe, index, 5) == hfb.extract_rules(recipe, rules_df, 5)
+
+
+@pytest.mark.parametrize('metric', ['confidence', 'support', 'zhangs_metric'])
+def test_index_switches_metric(rules_df, recipes, metric):
+    # One index sorted by lift serves the other metrics like a DataFrame sorted by them
+    index = RuleIndex.from_dataframe(rules_df, 'lift')
+    by_metric = rules_df.sort_values(metric, ascending=False)
+    for recipe in recipes:
+        assert extract_rules_from_index(recipe, index, 5, metric) == hfb.extract_rules(recipe, by_metric, 5, metric)
+
+
+def test_unknown_tokens_are_ignored(rules_df):
+    index = RuleIndex.from_dataframe(rules_df, 'lift')
+    recipe = ['salt', 'pepper', 'unknowntoken', 'butter']
+    assert extract_rules_from_index(recipe, index, 3) == hfb.extract_rules(recipe, rules_df, 3)
+    assert extract_rules_from_index([], index, 3) == (set(), {})
+
+
+@pytest.mark.parametrize('metric', ['lift', 'confidence'])
+def test_batch_matches_dataframe_scan(rules_df, recipes, metric):
+    by_metric = rules_df.sort_values(metric, ascending=False)
+    expected = [hfb.extract_rules(recipe, by_metric, 5, metric) for recipe in recipes]
+    assert extract_rules_batch(recipes, RuleIndex.from_dataframe(rules_df, 'lift'), 5, metric, batch_size=64) == expected
+    assert extract_rules_batch(recipes, rules_df, 5, metric) == expected
+
+
+def test_unsorted_dataframe_is_sorted_by_the_metric(rules_df, recipes):
+    # A DataFrame in any order gives the rules of the DataFrame sorted by the metric
+    shuffled = rules_df.sample(frac=1, random_state=0)
+    expected = [hfb.extract_rules(recipe, shuffled.sort_values('lift', ascending=False), 5) for recipe in recipes]
+    assert [extract_rules_from_index(recipe, RuleIndex.from_dataframe(shuffled, 'lift'), 5) for recipe in recipes] == expected
+    assert extract_rules_batch(recipes, shuffled, 5, 'lift') == expected
+    # Without a metric, a DataFrame is sorted by lift as in extract_rules
+    assert extract_rules_batch(recipes, shuffled, 5) == expected
+
+
+def test_compile_rules_compiles_a_dataframe_once(rules_df):
+    index = compile_rules(rules_df)
+    assert compile_rules(rules_df) is index
+    assert compile_rules(index) is index
+    assert compile_rules(rules_df.copy()) is not index
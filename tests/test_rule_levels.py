@@ -0,0 +1,26 @@
+import pytest
+import helpers_for_backend as hfb
+from rule_index import RuleIndex
+
+
+@pytest.mark.parametrize('metric', ['lift', 'confidence'])
+def test_levels_match_extract_rules(rules_df, recipes, metric):
+    by_metric = rules_df.sort_values(metric, ascending=False)
+    index = RuleIndex.from_dataframe(rules_df, 'lift')
+    for recipe in recipes[:80]:
+        levels = hfb.extract_rules_levels(recipe, index, metric=metric)
+        assert sorted(levels) == hfb.RULE_COUNTS
+        for rule_count, extracted in levels.items():
+            assert extracted == hfb.extract_rules(recipe, by_metric, rule_count, metric)
+        assert hfb.extract_rules_levels(recipe, by_metric, [2, 7], metric) == {
+            rule_count: hfb.extract_rules(recipe, by_metric, rule_count, metric) for rule_count in (2, 7)
+        }
+
+
+def test_top_rules_are_prefixes(rules_df, recipes):
+    # Any number of rules up to the largest level can be derived from it
+    index = RuleIndex.from_dataframe(rules_df, 'lift')
+    for recipe in recipes:
+        _, suggestions = hfb.extract_rules(recipe, index, 30)
+        for rule_count in range(1, 31):
+            assert hfb.top_rules(suggestions, rule_count) == hfb.extract_rules(recipe, index, rule_count)
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+from mlxtend.frequent_patterns import association_rules
+import helpers_for_backend as hfb
+from rule_mining import RULE_COLUMNS, add_rule_metrics, tokenize_directions, write_transactions, save_partition, mine_frequent_itemsets, mine_rules
+from conftest import mlxtend_itemsets
+
+MIN_SUPPORT = 0.05
+MAX_LEN = 3
+
+
+@pytest.fixture(scope='module')
+def corpus_recipes(corpus_csv):
+    return [tokenize_directions(directions) for directions in pd.read_csv(corpus_csv)['directions']]
+
+
+def _by_rule(rules: pd.DataFrame) -> dict:
+    return {
+        (frozenset(antecedents), frozenset(consequents)): values
+        for antecedents, consequents, values in zip(rules['antecedents'], rules['consequents'], rules[RULE_COLUMNS[2:]].to_numpy())
+    }
+
+
+@pytest.mark.parametrize('chunksize', [40, 1000])
+def test_partitioned_itemsets_match_fpgrowth(corpus_csv, corpus_recipes, chunksize, tmp_path):
+    # Several partitions (SON) or a single one give the itemsets of fpgrowth over the whole corpus
+    partitions, tokens = write_transactions(corpus_csv, str(tmp_path), chunksize=chunksize, processes=2)
+    itemsets, n_recipes = mine_frequent_itemsets(partitions, len(tokens), MIN_SUPPORT, MAX_LEN, processes=2)
+    assert n_recipes == len(corpus_recipes)
+    mined = {frozenset(tokens[token] for token in itemset): count / n_recipes for itemset, count in itemsets.items()}
+    expected = mlxtend_itemsets(corpus_recipes, MIN_SUPPORT, MAX_LEN)
+    assert mined.keys() == expected.keys()
+    for itemset, support in expected.items():
+        assert mined[itemset] == pytest.approx(support)
+
+
+def test_partition_without_its_first_token(tmp_path):
+    # Token 0 is not frequent in the partition, the frequent tokens do not start at 0
+    recipes = [[0, 1, 2]] + [[1, 2, 3]] * 10 + [[2, 3]] * 10
+    partition = str(tmp_path / 'partition_0')
+    save_partition(partition, recipes)
+    itemsets, n_recipes = mine_frequent_itemsets([partition], 4, 0.3, MAX_LEN, processes=1)
+    assert n_recipes == len(recipes)
+    assert itemsets == {frozenset([1]): 11, frozenset([2]): 21, frozenset([3]): 20, frozenset([1, 2]): 11, frozenset([1, 3]): 10,
+                        frozenset([2, 3]): 20, frozenset([1, 2, 3]): 10}
+
+
+@pytest.mark.parametrize('preprocessed', [True, False])
+def test_mined_rules_match_association_rules(corpus_csv, corpus_recipes, preprocessed, tmp_path):
+    output_path = str(tmp_path / 'rules.csv')
+    rules = mine_rules(corpus_csv, output_path, MIN_SUPPORT, MAX_LEN, min_threshold=1.2, chunksize=40, processes=2, preprocessed=preprocessed)
+    itemsets = mlxtend_itemsets(corpus_recipes, MIN_SUPPORT, MAX_LEN)
+    frequent = pd.DataFrame({'support': list(itemsets.values()), 'itemsets': list(itemsets)})
+    expected = _by_rule(association_rules(frequent, len(corpus_recipes), metric='lift', min_threshold=1.2))
+    mined = _by_rule(rules)
+    assert len(expected) > 0 and mined.keys() == expected.keys()
+    for rule, values in expected.items():
+        np.testing.assert_allclose(mined[rule], values)
+    # The csv is the one load_rule_data reads, and its store was written next to it
+    loaded = hfb.load_rule_data(output_path, 'lift')
+    assert len(loaded) == len(rules)
+    assert len(hfb.load_rule_index(output_path[:-len('.csv')] + '.rules', 'lift').consequents) == len(rules)
+
+
+def test_rule_metrics_of_an_antecedent_in_every_recipe():
+    # antecedent support 1 and leverage 0: the denominator of zhangs_metric is 0, mlxtend gives 0
+    itemsets = {frozenset('a'): 1.0, frozenset('c'): 0.5, frozenset('ac'): 0.5}
+    frequent = pd.DataFrame({'support': list(itemsets.values()), 'itemsets': list(itemsets)})
+    expected = association_rules(frequent, 10, metric='support', min_threshold=0)
+    rules = add_rule_metrics(expected[['antecedents', 'consequents', 'antecedent support', 'consequent support', 'support']].copy())
+    assert rules['zhangs_metric'].tolist() == expected['zhangs_metric'].tolist() == [0.0, 0.0]
+    np.testing.assert_allclose(rules[RULE_COLUMNS[2:]].to_numpy(), expected[RULE_COLUMNS[2:]].to_numpy())
@@ -0,0 +1,88 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import helpers_for_backend as hfb
+from rule_store import convert_rule_data, load_rule_store, parse_frozenset, sort_order
+
+
+@pytest.fixture(scope='module')
+def store_path(rules_csv, tmp_path_factory):
+    return convert_rule_data(rules_csv, str(tmp_path_factory.mktemp('store') / 'rules.rules'))
+
+
+def test_parse_frozenset_matches_eval(rules_csv):
+    raw = pd.read_csv(rules_csv)
+    for text in pd.concat([raw['antecedents'], raw['consequents']]):
+        assert parse_frozenset(text) == eval(text)
+    assert parse_frozenset('frozenset()') == frozenset()
+    assert parse_frozenset("frozenset({'it\\'s', \"a b\"})") == frozenset({"it's", 'a b'})
+
+
+@pytest.mark.parametrize('text', ["__import__('os').getcwd()", "frozenset({1, 2})", "{'salt'}", "frozenset({'salt'}) or 1"])
+def test_parse_frozenset_rejects_other_expressions(text):
+    with pytest.raises(ValueError):
+        parse_frozenset(text)
+
+
+def test_store_loads_like_the_csv(rules_csv, store_path):
+    from_csv = hfb.load_rule_data(rules_csv, 'lift')
+    from_store = hfb.load_rule_data(store_path, 'lift')
+    assert from_store.index.tolist() == from_csv.index.tolist()
+    assert from_store['consequents'].tolist() == from_csv['consequents'].tolist()
+    assert [frozenset(x) for x in from_store['antecedents']] == [frozenset(x) for x in from_csv['antecedents']]
+    for column in ['support', 'confidence', 'lift', 'zhangs_metric']:
+        np.testing.assert_array_equal(from_store[column].to_numpy(), from_csv[column].to_numpy())
+
+
+def test_store_index_matches_dataframe_scan(rules_df, recipes, store_path):
+    index = hfb.load_rule_index(store_path, 'lift')
+    for recipe in recipes:
+        assert hfb.extract_rules(recipe, index, 5) == hfb.extract_rules(recipe, rules_df, 5)
+
+
+def test_corrupted_store_is_rejected(rules_csv, tmp_path):
+    store_path = convert_rule_data(rules_csv, str(tmp_path / 'rules.rules'))
+    ids = np.load(os.path.join(store_path, 'antecedent_ids.npy'))
+    ids[0] = 10_000
+    np.save(os.path.join(store_path, 'antecedent_ids.npy'), ids)
+    with pytest.raises(ValueError):
+        load_rule_store(store_path)
+
+
+@pytest.mark.parametrize('key, name', [('metrics', '../../outside'), ('metrics', 'lift/../lift'), ('orders', 'antecedent support'), ('orders', '/tmp/x')])
+def test_unknown_metric_names_are_rejected(rules_csv, tmp_path, key, name):
+    # The names of meta.json become file names
+    store_path = convert_rule_data(rules_csv, str(tmp_path / 'rules.rules'))
+    with open(os.path.join(store_path, 'meta.json')) as f:
+        meta = json.load(f)
+    meta[key].append(name)
+    with open(os.path.join(store_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    with pytest.raises(ValueError, match='unknown'):
+        load_rule_store(store_path)
+
+
+@pytest.mark.parametrize('metric', ['lift', 'confidence', 'zhangs_metric', 'support', 'leverage', 'conviction'])
+def test_precomputed_orders_match_pandas_sort(rules_csv, store_path, metric):
+    raw = pd.read_csv(rules_csv)
+    store = load_rule_store(store_path)
+    assert metric in store.orders
+    np.testing.assert_array_equal(store.order(metric), raw.sort_values(metric, ascending=False).index.to_numpy())
+
+
+def test_sort_order_puts_nans_last():
+    values = np.array([1.0, np.nan, 3.0, 1.0, 2.0])
+    order = sort_order(values)
+    np.testing.assert_array_equal(order, pd.Series(values).sort_values(ascending=False).index.to_numpy())
+    assert order[-1] == 1
+
+
+@pytest.mark.parametrize('metric', ['confidence', 'conviction', 'antecedent support'])
+def test_store_index_serves_every_metric(rules_csv, recipes, store_path, metric):
+    # 'antecedent support' has no precomputed order, it is sorted on first use
+    index = hfb.load_rule_index(store_path, 'lift')
+    by_metric = hfb.load_rule_data(rules_csv, metric)
+    for recipe in recipes:
+        assert hfb.extract_rules(recipe, index, 5, metric) == hfb.extract_rules(recipe, by_metric, 5, metric)
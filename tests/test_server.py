@@ -0,0 +1,114 @@
+import asyncio
+import json
+import pytest
+from aiohttp.test_utils import TestServer, TestClient
+from gpt_client import AsyncGptClient
+from request_scheduler import RequestScheduler
+from rule_index import RuleIndex
+from server import create_app, parse_backend_input, InvalidInput, SERVICE
+
+# The application keys are plain strings, aiohttp >= 3.9 warns about them
+pytestmark = pytest.mark.filterwarnings('ignore::aiohttp.web.NotAppKeyWarning')
+
+RECIPE = 'Preheat the oven. Mix the flour, the sugar and the butter in a bowl, add the eggs and bake for 20 minutes.'
+
+
+async def _with_client(app, test):
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        return await test(client)
+    finally:
+        await client.close()
+
+
+@pytest.fixture
+def make_app(rules_df, stub_api):
+    def make(**kwargs):
+        client = AsyncGptClient('key', stub_api.url + '/recipe/v1')
+        return create_app(RuleIndex.from_dataframe(rules_df, 'lift'), client=client, scheduler=RequestScheduler(), **kwargs)
+    return make
+
+
+def test_example_socket(make_app):
+    records = []
+    app = make_app(trace_sink=records.extend)
+
+    async def test(client):
+        async with client.ws_connect('/ws/example') as ws:
+            message = {'user_recipe': RECIPE, 'number_of_rules': 3, 'user_id': 'learner'}
+            # The same submission twice, and an invalid one
+            await ws.send_str(json.dumps(message))
+            await ws.send_str(json.dumps(message))
+            await ws.send_str(json.dumps({'user_recipe': 'too short', 'number_of_rules': 3}))
+            answers = [json.loads(await ws.receive_str(timeout=10)) for _ in range(3)]
+        return answers, app[SERVICE].stats()
+
+    answers, stats = asyncio.run(_with_client(app, test))
+    errors = [answer for answer in answers if 'error' in answer]
+    examples = [answer for answer in answers if 'error' not in answer]
+    assert len(errors) == 1 and 'user_recipe' in errors[0]['error']
+    assert len(examples) == 2 and examples[0] == examples[1]
+    assert set(examples[0]) == {'annotations', 'ing_seperated', 'example_recipe'}
+    assert stats['requests'] == 2 and stats['started'] == 1
+
+
+def test_trace_and_health(make_app):
+    records = []
+    app = make_app(trace_sink=records.extend, trace_batch_size=10)
+
+    async def test(client):
+        response = await client.post('/trace', json=[{'user_id': 'a', 'score': 1}, {'user_id': 'b', 'score': 2}])
+        assert response.status == 200 and (await response.json())['received'] == 2
+        assert (await client.post('/trace', data='{not json')).status == 400
+        assert (await client.post('/trace', json=[1, 2])).status == 400
+        response = await client.get('/health')
+        assert response.headers['Access-Control-Allow-Origin'] == '*'
+        return (await response.json())['traces']
+
+    assert asyncio.run(_with_client(app, test)) == {'written': 0, 'buffered': 2, 'dropped': 0}
+    # Written when the application stops
+    assert [record['user_id'] for record in records] == ['a', 'b']
+    assert all('received_at' in record for record in records)
+
+
+def test_preflight_request(make_app):
+    app = make_app(trace_sink=lambda records: None, allowed_origin='https://example.org')
+
+    async def test(client):
+        response = await client.options('/trace')
+        return response.status, response.headers
+
+    status, headers = asyncio.run(_with_client(app, test))
+    assert status == 200
+    assert headers['Access-Control-Allow-Origin'] == 'https://example.org'
+    assert 'POST' in headers['Access-Control-Allow-Methods']
+
+
+def test_trace_is_accepted_when_the_write_fails(make_app):
+    written = []
+
+    def failing_sink(records):
+        # The first write fails
+        if not written:
+            written.append(None)
+            raise OSError('disk full')
+        written.extend(records)
+    app = make_app(trace_sink=failing_sink, trace_batch_size=1)
+
+    async def test(client):
+        response = await client.post('/trace', json={'user_id': 'a'})
+        assert response.status == 200
+        return (await (await client.get('/health')).json())['traces']
+
+    # The record is kept for the next write, the learner's request does not fail
+    assert asyncio.run(_with_client(app, test)) == {'written': 0, 'buffered': 1, 'dropped': 0}
+    assert [record['user_id'] for record in written[1:]] == ['a']
+
+
+def test_recipe_length_is_the_one_of_the_frontend():
+    # recipe.length in javascript: not stripped, and in UTF-16 code units
+    assert parse_backend_input(json.dumps({'user_recipe': ' ' * 10 + 'a' * 15, 'number_of_rules': 3}))['user_recipe'] == ' ' * 10 + 'a' * 15
+    assert parse_backend_input(json.dumps({'user_recipe': '\U0001F373' * 13, 'number_of_rules': 3}))
+    with pytest.raises(InvalidInput):
+        parse_backend_input(json.dumps({'user_recipe': 'a' * 24, 'number_of_rules': 3}))
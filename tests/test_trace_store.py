@@ -0,0 +1,98 @@
+import asyncio
+import datetime
+import json
+import pyarrow.parquet as pq
+import pytest
+import trace_store
+from trace_store import ParquetTraceSink, TraceWriteError, load_traces
+from server import TraceBuffer
+
+DAY_1 = datetime.datetime(2023, 10, 1, 23, 59, tzinfo=datetime.timezone.utc).timestamp()
+DAY_2 = datetime.datetime(2023, 10, 2, 0, 1, tzinfo=datetime.timezone.utc).timestamp()
+
+
+def record(user: str, received_at: float, event: str = 'finishReview') -> dict:
+    details = {'mode': 'rule', 'improvementLevel': '3', 'timestamp': 't', 'selectedIndexes': {'0': 'salt'}, 'sentences': ['Add salt.']}
+    return {'user': user, 'event': event, 'details': details, 'received_at': received_at}
+
+
+def test_traces_are_partitioned_by_day(tmp_path):
+    sink = ParquetTraceSink(str(tmp_path))
+    sink([record('a', DAY_1), record('b', DAY_2, 'startReview')])
+    sink([record('c', DAY_1)])
+    # Nothing is visible before the files are closed
+    assert load_traces(str(tmp_path)).empty
+    sink.close()
+    traces = load_traces(str(tmp_path))
+    assert traces['user'].tolist() == ['a', 'c', 'b']
+    assert traces['day'].tolist() == ['2023-10-01', '2023-10-01', '2023-10-02']
+    assert traces['improvement_level'].tolist() == [3, 3, 3]
+    assert load_traces(str(tmp_path), start='2023-10-02')['user'].tolist() == ['b']
+    assert load_traces(str(tmp_path), events=['finishReview'], columns=['user'])['user'].tolist() == ['a', 'c']
+
+
+class FailingWriter(pq.ParquetWriter):
+    # Fails the first write to a file of the given day
+    failures = {}
+
+    def write_table(self, table, *args, **kwargs):
+        for day, left in self.failures.items():
+            if f'day={day}' in self.where and left:
+                self.failures[day] -= 1
+                raise OSError('disk full')
+        return super().write_table(table, *args, **kwargs)
+
+
+def test_failed_day_is_written_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(FailingWriter, 'failures', {'2023-10-02': 1})
+    monkeypatch.setattr(trace_store.pq, 'ParquetWriter', FailingWriter)
+    sink = ParquetTraceSink(str(tmp_path))
+    batch = [record('a', DAY_1), record('b', DAY_2), record('c', DAY_1)]
+    with pytest.raises(TraceWriteError) as raised:
+        sink(batch)
+    assert [r['user'] for r in raised.value.records] == ['b']
+    sink(raised.value.records)
+    sink.close()
+    assert sorted(load_traces(str(tmp_path))['user']) == ['a', 'b', 'c']
+
+
+def test_buffer_keeps_the_unwritten_records(tmp_path, monkeypatch):
+    monkeypatch.setattr(FailingWriter, 'failures', {'2023-10-02': 1})
+    monkeypatch.setattr(trace_store.pq, 'ParquetWriter', FailingWriter)
+    sink = ParquetTraceSink(str(tmp_path))
+
+    async def run():
+        buffer = TraceBuffer(sink, max_records=3)
+        # The write triggered by add fails for day 2, add does not raise
+        await buffer.add(record('a', DAY_1), record('b', DAY_2), record('c', DAY_1))
+        state = buffer.written, [r['user'] for r in buffer.records]
+        await buffer.close()
+        return state, buffer.written
+
+    (written, buffered), total = asyncio.run(run())
+    assert written == 2 and buffered == ['b']
+    assert total == 3
+    assert sorted(load_traces(str(tmp_path))['user']) == ['a', 'b', 'c']
+
+
+def test_bad_record_does_not_block_the_batch(tmp_path):
+    huge, infinite, surrogate = record('huge', DAY_1), record('infinite', DAY_1), record('\ud800', DAY_1)
+    huge['details']['improvementLevel'] = 10**12
+    infinite['details']['improvementLevel'] = float('inf')
+    sink = ParquetTraceSink(str(tmp_path))
+
+    async def run():
+        buffer = TraceBuffer(sink, max_records=2)
+        for r in [record('a', DAY_1), huge, surrogate, record('b', DAY_1), infinite, record('c', DAY_1)]:
+            await buffer.add(r)
+        state = buffer.written, len(buffer.records)
+        await buffer.close()
+        return state
+
+    assert asyncio.run(run()) == (6, 0)
+    assert sink.written == 5 and sink.rejected == 1
+    traces = load_traces(str(tmp_path))
+    assert traces['user'].tolist() == ['a', 'huge', 'b', 'infinite', 'c']
+    assert traces['improvement_level'].isna().tolist() == [False, True, False, True, False]
+    with open(tmp_path / trace_store.REJECTED_FILE) as f:
+        assert [json.loads(line)['user'] for line in f] == ['\ud800']
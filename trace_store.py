@@ -0,0 +1,266 @@
+# The traces of the web app (the BackendUserResult posted by the frontend to /trace), stored as compressed Parquet files
+# partitioned by day: <root>/day=YYYY-MM-DD/part-*.parquet
+# The server hands the records to a ParquetTraceSink in batches (see server.TraceBuffer): each batch is one row group, appended to
+# the open file of its day. A file is written under a hidden name and renamed once it is complete, so the readers only see
+# complete files: files are closed every roll_interval seconds, after max_rows_per_file rows and when the server stops.
+# The records that can't be converted to TRACE_SCHEMA are set aside in <root>/_rejected.jsonl, so that they don't block the others.
+#
+# Usage:
+#   traces = load_traces('traces', start='2023-10-01', events=['finishReview'])
+
+import datetime
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from typing import List, Dict, Any, Iterable
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# The columns of a trace, the fields of BackendUserResult and of its details (see app/src/types/BackendTypes.d.ts)
+TRACE_SCHEMA = pa.schema([
+    ('received_at', pa.timestamp('ms', tz='UTC')),
+    ('user', pa.string()),
+    ('event', pa.string()),
+    ('mode', pa.string()),
+    ('improvement_level', pa.int32()),
+    ('client_timestamp', pa.string()),
+    # json, the frontend sends a map {sentence index: word}
+    ('selected_indexes', pa.string()),
+    ('original_recipe', pa.string()),
+    ('improved_recipe', pa.string()),
+    ('sentences', pa.list_(pa.string())),
+    # The whole record as json, for the fields that have no column
+    ('record', pa.string()),
+])
+
+_PARTITIONING = ds.partitioning(pa.schema([('day', pa.string())]), flavor='hive')
+# The errors of pyarrow when a value does not fit its column, e.g. a string with a lone surrogate
+_CONVERSION_ERRORS = (pa.ArrowException, ValueError, TypeError, OverflowError)
+# Ignored by load_traces, like the files starting with '.'
+REJECTED_FILE = '_rejected.jsonl'
+
+
+def _as_text(value: Any) -> str | None:
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _as_int(value: Any) -> int | None:
+    # None outside of int32 (improvement_level), int(inf) raises an OverflowError
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return value if -2**31 <= value < 2**31 else None
+
+
+def _to_table(records: List[Dict[str, Any]], rows: List[Dict[str, Any]]):
+    # Returns the table of the rows, the records converted and the records that can't be
+    try:
+        return pa.Table.from_pylist(rows, schema=TRACE_SCHEMA), records, []
+    except _CONVERSION_ERRORS:
+        pass
+    # A single bad row fails the whole conversion, the rows are converted one by one to find the bad ones
+    tables, converted, rejected = [], [], []
+    for record, row in zip(records, rows):
+        try:
+            tables.append(pa.Table.from_pylist([row], schema=TRACE_SCHEMA))
+            converted.append(record)
+        except _CONVERSION_ERRORS:
+            rejected.append(record)
+    return pa.concat_tables(tables) if tables else None, converted, rejected
+
+
+def trace_row(record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+        Flattens a trace record (a BackendUserResult with the received_at time of the server) into a row of TRACE_SCHEMA.
+    """
+    details = record.get('details')
+    details = details if isinstance(details, dict) else {}
+    sentences = details.get('sentences')
+    return {
+        'received_at': datetime.datetime.fromtimestamp(record.get('received_at', time.time()), datetime.timezone.utc),
+        'user': _as_text(record.get('user')),
+        'event': _as_text(record.get('event')),
+        'mode': _as_text(details.get('mode')),
+        'improvement_level': _as_int(details.get('improvementLevel')),
+        'client_timestamp': _as_text(details.get('timestamp')),
+        'selected_indexes': None if details.get('selectedIndexes') is None else json.dumps(details['selectedIndexes']),
+        'original_recipe': _as_text(details.get('originalRecipe')),
+        'improved_recipe': _as_text(details.get('improvedRecipe')),
+        'sentences': [_as_text(sentence) for sentence in sentences] if isinstance(sentences, list) else None,
+        'record': json.dumps(record),
+    }
+
+
+class TraceWriteError(Exception):
+    """
+        Raised by ParquetTraceSink when only part of a batch was written: records are the records that were not written,
+        the others must not be written again.
+    """
+    def __init__(self, records: List[Dict[str, Any]]):
+        super().__init__(f'{len(records)} trace records were not written')
+        self.records = records
+
+
+class ParquetTraceSink:
+    """
+        A TraceBuffer sink writing the records to Parquet files partitioned by day (of received_at, in UTC).
+        Calling it with a list of records appends one row group per day to the open file of that day. If a day can't be written,
+        its file is closed and a TraceWriteError with the records of the days not written yet is raised. The records that can't
+        be converted to TRACE_SCHEMA are appended to <root>/_rejected.jsonl instead (counted in rejected), they are not retried.
+
+        Inputs:
+            - root: The directory of the traces.
+            - compression: The Parquet compression. Default is 'zstd'.
+            - roll_interval: The number of seconds after which an open file is closed (and becomes visible to load_traces).
+                             The records of an open file are lost if the process is killed, this bounds how many.
+            - max_rows_per_file: The number of rows after which an open file is closed.
+    """
+    def __init__(self, root: str, compression: str = 'zstd', roll_interval: float = 60.0, max_rows_per_file: int = 1_000_000):
+        self.root = root
+        self.compression = compression
+        self.roll_interval = roll_interval
+        self.max_rows_per_file = max_rows_per_file
+        self.written = 0
+        self.rejected = 0
+        # day -> [writer, hidden path, final path, opened at, rows]
+        self._open: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, records: List[Dict[str, Any]]) -> None:
+        records_by_day: Dict[str, List[Dict[str, Any]]] = {}
+        rows_by_day: Dict[str, List[Dict[str, Any]]] = {}
+        rejected = []
+        for record in records:
+            try:
+                row = trace_row(record)
+                day = row['received_at'].strftime('%Y-%m-%d')
+            except _CONVERSION_ERRORS:
+                rejected.append(record)
+                continue
+            records_by_day.setdefault(day, []).append(record)
+            rows_by_day.setdefault(day, []).append(row)
+        # Converted before anything is written, so that a day is written in one go
+        tables = {}
+        for day, rows in rows_by_day.items():
+            table, records_by_day[day], bad = _to_table(records_by_day[day], rows)
+            rejected.extend(bad)
+            if table is not None:
+                tables[day] = table
+        with self._lock:
+            if rejected:
+                self._reject(rejected)
+            days = list(tables)
+            for i, day in enumerate(days):
+                try:
+                    open_file = self._open.get(day) or self._open_file(day)
+                    open_file[0].write_table(tables[day])
+                except Exception as e:
+                    # The days before are written, only the records of this day and of the next ones are left
+                    if day in self._open:
+                        self._close_file(day)
+                    raise TraceWriteError([record for left in days[i:] for record in records_by_day[left]]) from e
+                open_file[4] += tables[day].num_rows
+                self.written += tables[day].num_rows
+            self._roll()
+
+    def _reject(self, records: List[Dict[str, Any]]) -> None:
+        self.rejected += len(records)
+        path = os.path.join(self.root, REJECTED_FILE)
+        print(f'{len(records)} trace records could not be converted, they are set aside in {path}')
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            with open(path, 'a') as f:
+                f.write(''.join(json.dumps(record, default=repr) + '\n' for record in records))
+        except Exception:
+            traceback.print_exc()
+
+    def _open_file(self, day: str) -> list:
+        directory = os.path.join(self.root, f'day={day}')
+        os.makedirs(directory, exist_ok=True)
+        name = f'part-{time.strftime("%Y%m%dT%H%M%S")}-{uuid.uuid4().hex[:8]}.parquet'
+        # load_traces ignores the files starting with '.'
+        hidden = os.path.join(directory, '.' + name)
+        self._open[day] = [pq.ParquetWriter(hidden, TRACE_SCHEMA, compression=self.compression), hidden, os.path.join(directory, name), time.monotonic(), 0]
+        return self._open[day]
+
+    def _roll(self, force: bool = False) -> None:
+        for day, (_, _, _, opened_at, rows) in list(self._open.items()):
+            if force or rows >= self.max_rows_per_file or time.monotonic() - opened_at >= self.roll_interval:
+                self._close_file(day)
+
+    def _close_file(self, day: str) -> None:
+        writer, hidden, path, _, _ = self._open.pop(day)
+        try:
+            writer.close()
+            os.replace(hidden, path)
+        except Exception:
+            # The rows already written are in the hidden file, which is left for inspection
+            print(f'Could not close {hidden}:')
+            traceback.print_exc()
+
+    def roll(self) -> None:
+        """
+            Closes the files that are open for longer than roll_interval. Called periodically by TraceBuffer, so that the
+            files are closed even when no new trace comes in.
+        """
+        with self._lock:
+            self._roll()
+
+    def close(self) -> None:
+        """
+            Closes all the open files.
+        """
+        with self._lock:
+            self._roll(force=True)
+
+
+def load_traces(
+    root: str,
+    start: str | None = None,
+    end: str | None = None,
+    users: Iterable[str] | None = None,
+    events: Iterable[str] | None = None,
+    columns: List[str] | None = None,
+) -> pd.DataFrame:
+    """
+        Loads the traces written by ParquetTraceSink, for the analysis notebooks. Only the files of the requested days are read.
+
+        Inputs:
+            - root: The directory of the traces.
+            - start, end: The first and last day to load, as 'YYYY-MM-DD' (UTC). Default is None, i.e. no bound.
+            - users: Only load the traces of these users. Default is None, i.e. every user.
+            - events: Only load these events (e.g. ['finishReview']). Default is None, i.e. every event.
+            - columns: The columns to load (see TRACE_SCHEMA, plus 'day'). Default is None, i.e. every column.
+
+        Output:
+            - The traces sorted by received_at, type: pd.DataFrame. selected_indexes and record are json strings (use json.loads).
+    """
+    if not os.path.isdir(root):
+        return pd.DataFrame(columns=columns or TRACE_SCHEMA.names + ['day'])
+    dataset = ds.dataset(root, schema=TRACE_SCHEMA.append(pa.field('day', pa.string())), format='parquet', partitioning=_PARTITIONING)
+    conditions = []
+    if start is not None:
+        conditions.append(ds.field('day') >= start)
+    if end is not None:
+        conditions.append(ds.field('day') <= end)
+    if users is not None:
+        conditions.append(ds.field('user').isin(list(users)))
+    if events is not None:
+        conditions.append(ds.field('event').isin(list(events)))
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+    if columns is not None and 'received_at' not in columns:
+        table = dataset.to_table(columns=columns + ['received_at'], filter=condition)
+    else:
+        table = dataset.to_table(columns=columns, filter=condition)
+    traces = table.to_pandas().sort_values('received_at', kind='stable').reset_index(drop=True)
+    return traces[columns] if columns is not None else traces